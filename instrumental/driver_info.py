@@ -17,6 +17,11 @@ driver_info = OrderedDict([
         'classes': [],
         'imports': ['cffi'],
     }),
+    ('cameras.simulated', {
+        'params': ['serial'],
+        'classes': ['SimulatedCamera'],
+        'imports': [],
+    }),
     ('cameras.tsi', {
         'params': ['serial', 'number'],
         'classes': ['TSI_Camera'],
@@ -5,12 +5,26 @@ Package containing a driver module/class for each supported camera type.
 """
 import abc
 import json
+import time
 import os.path
 import numpy as np
 from .. import Instrument
 from ... import Q_, conf
-from ...errors import Error
-
+from ...errors import Error, TimeoutError
+from ...log import get_logger
+from ..util import check_units
+from ._frames import (Frame, FrameRingBuffer, FrameQueue, FrameStream, CapturedImages,
+                      grab_frame, check_out_array)
+from ._hotpixels import HotPixelMap
+from ._calibration import RunningStats, DarkCalibration
+from ._correction import FlatFieldCorrection
+from ._recording import NpyFrameWriter, FrameRecorder, load_recording
+from ._store import ChunkedFrameWriter, ChunkedFrameReader
+from ._pipeline import (Pipeline, Stage, Analysis, Crop, Bin, Subtract, LUT, Statistics,
+                        Function)
+from ._sync import CameraGroup, FrameBundle
+
+log = get_logger(__name__)
 
 
 class Camera(Instrument):
@@ -62,7 +76,17 @@ class Camera(Instrument):
         pass
 
     _hot_pixels = None
+    _dark_calibration = None
     _defaults = None
+    _frame_buffer = None
+    _frame_buffer_len = 0
+    _stream = None
+    _correction = None
+
+    #: Optional `Pipeline` of processing stages applied to the frames yielded by `frames()`. It
+    #: isn't applied by `record()` or `calibrate_dark()`, which work on the sensor's frames.
+    pipeline = None
+    _frame_geometry = (0, 0, 1, 1)  # (left, top, hbin, vbin) of the current ROI
 
     @abc.abstractmethod
     def start_capture(self, **kwds):
@@ -84,7 +108,7 @@ class Camera(Instrument):
         """
 
     @abc.abstractmethod
-    def get_captured_image(self, timeout='1s', copy=True):
+    def get_captured_image(self, timeout='1s', copy=True, stack=False, out=None):
         """Get the image array(s) from the last capture sequence.
 
         Returns an image numpy array (or tuple of arrays for a multi-exposure sequence). The array
@@ -92,6 +116,10 @@ class Camera(Instrument):
         Typically the dtype will be `uint8`, or sometimes `uint16` in the case of 16-bit
         monochromatic cameras.
 
+        With ``stack=True``, the whole sequence is instead returned as a single array of shape
+        *(n_frames, height, width)*, even for a single frame. It is allocated once, and each
+        image is copied straight from the SDK's buffer into its slice.
+
         Parameters
         ----------
         timeout : Quantity([time]) or None, optional
@@ -100,10 +128,17 @@ class Camera(Instrument):
         copy : bool, optional
             Whether to copy the image memory or directly reference the underlying buffer. It is
             recommended to use *True* (the default) unless you know what you're doing.
+        stack : bool, optional
+            Whether to return the sequence as one contiguous 3D array. Implies `copy`.
+        out : numpy.ndarray, optional
+            Preallocated array to copy the image(s) into, instead of allocating new ones. It must
+            have shape *(n_frames, height, width)* (or just *(height, width)* for a single frame)
+            and the dtype the images would otherwise have, or an Error is raised. The sequence is
+            then returned as `out`, as with ``stack=True``.
         """
 
     @abc.abstractmethod
-    def grab_image(self, timeouts='1s', copy=True, **kwds):
+    def grab_image(self, timeouts='1s', copy=True, stack=False, out=None, **kwds):
         """Perform a capture and return the resulting image array(s).
 
         This is essentially a convenience function that calls `start_capture()` then
@@ -118,6 +153,13 @@ class Camera(Instrument):
         copy : bool, optional
             Whether to copy the image memory or directly reference the underlying buffer. It is
             recommended to use *True* (the default) unless you know what you're doing.
+        stack : bool, optional
+            Whether to return the sequence as one contiguous 3D array. Implies `copy`.
+        out : numpy.ndarray, optional
+            Preallocated array to copy the image(s) into, instead of allocating new ones. It must
+            have shape *(n_frames, height, width)* (or just *(height, width)* for a single frame)
+            and the dtype the images would otherwise have, or an Error is raised. The sequence is
+            then returned as `out`, as with ``stack=True``.
 
         You can specify other parameters of the capture as keyword arguments. These include:
 
@@ -184,17 +226,337 @@ class Camera(Instrument):
         """
 
     @abc.abstractmethod
-    def latest_frame(self, copy=True):
+    def latest_frame(self, copy=True, out=None):
         """Get the latest image frame in live mode.
 
         Returns the image array received on the most recent successful call to `wait_for_frame()`.
+        To avoid allocating a new array for every frame, pass a preallocated array as `out`::
+
+            >>> out = np.empty((cam.height, cam.width), np.uint16)
+            >>> while cam.wait_for_frame():
+            ...     cam.latest_frame(out=out)
 
         Parameters
         ----------
         copy : bool, optional
             Whether to copy the image memory or directly reference the underlying buffer. It is
             recommended to use *True* (the default) unless you know what you're doing.
+        out : numpy.ndarray, optional
+            Array to copy the image into, which is then returned. Its shape and dtype must match
+            the image's, or an Error is raised.
+        """
+
+    def _latest_frame_info(self):
+        """Get the hardware (frame number, timestamp) of the last frame from `latest_frame()`
+
+        Drivers whose SDK reports per-frame metadata should override this. Either value may be
+        None if it is unavailable. Timestamps are in seconds, according to the camera's clock.
+        """
+        return None, None
+
+    def latest_stats(self, statistics):
+        """Compute statistics of the latest frame in live mode, without copying it.
+
+        Analyzes the frame from the most recent successful call to `wait_for_frame()` directly in
+        the underlying buffer, which is much cheaper than getting a copy via `latest_frame()` when
+        only a few numbers per frame are needed.
+
+        Parameters
+        ----------
+        statistics : Statistics
+            The statistics stage to compute the frame's statistics with. Reuse the same one
+            across frames, as it caches its coordinate grids and buffers.
+
+        Returns
+        -------
+        stats : dict
+            The results of `Statistics.analyze()`
+        """
+        return statistics.analyze(self.latest_frame(copy=False))
+
+    @check_units(timeout='?s')
+    def frames(self, n=None, timeout='1s', **kwds):
+        """Iterate over live video frames.
+
+        Returns an iterator that yields `Frame` objects, holding each image array along with its
+        sequence number, host timestamp, and, if the driver supports it, the camera's own frame
+        number and timestamp. Gaps in the camera's frame numbers are counted in each frame's
+        ``dropped`` attribute and logged as warnings. Live video is started when iteration begins
+        and stopped when it ends (including when breaking out of the loop early). If the camera
+        has a `pipeline`, each frame is run through it on the pipeline's worker threads::
+
+            >>> for frame in cam.frames(n=1000, exposure_time='5ms'):
+            ...     process(frame.array)
+
+        Parameters
+        ----------
+        n : int, optional
+            Number of frames to yield. If None (the default), iterate until the loop is exited.
+        timeout : Quantity([time]), optional
+            Maximum time to wait for each frame before raising a TimeoutError. If None, wait
+            forever.
+
+        See `grab_image()` for the set of available kwds.
+        """
+        if self._stream is not None:
+            raise Error("Can't iterate over frames while a stream is running")
+        frames = self._iter_frames(n, timeout, kwds)
+        if self.pipeline is not None:
+            frames = self.pipeline.imap(frames)
+        return frames
+
+    def _iter_frames(self, n, timeout, kwds, correct=True):
+        """Yield `n` live frames. If `correct` is False, the frames are left uncorrected."""
+        correction = self._correction
+        if not correct:
+            self._correction = None
+        self.start_live_video(**kwds)
+        try:
+            seq = 0
+            last_hw_seq = None
+            while n is None or seq < n:
+                if not self.wait_for_frame(timeout=timeout):
+                    raise TimeoutError("Timed out while waiting for frame {}".format(seq))
+                frame = grab_frame(self, seq, last_hw_seq)
+                last_hw_seq = frame.hw_seq
+                seq += 1
+                yield frame
+        finally:
+            self.stop_live_video()
+            self._correction = correction
+
+    @check_units(duration='?s')
+    def record(self, path, n_frames=None, duration=None, maxlen=64, compress=False, **kwds):
+        """Record live video frames straight to a memory-mapped ``.npy`` file.
+
+        Live frames are handed to a background writer thread through a bounded queue,
+        so memory use stays fixed however long the recording is. The frames can be read back,
+        without loading them all into memory, using `load_recording()` or
+        ``np.load(path, mmap_mode='r')``. Each frame's sequence number, timestamps and hardware
+        frame info, along with the exposure time, ROI and the stats below, are saved in a
+        ``.json`` file of the same name. The camera's `pipeline` isn't applied, so the recording
+        holds the full frames of the ROI.
+
+        With `compress`, the frames are instead written to a chunked frame store, compressed by
+        the writer thread, with the metadata stored in the file's index. Read it back lazily with
+        `load_recording()`. This typically shrinks 12-bit frames several times over, at the cost
+        of CPU time in the writer, so check that ``frames_per_s`` keeps up with your camera.
+
+        Parameters
+        ----------
+        path : str
+            Path of the ``.npy`` file to write
+        n_frames : int, optional
+            Number of frames to record. Space for them is preallocated up front.
+        duration : Quantity([time]), optional
+            How long to record for. At least one of `n_frames` and `duration` must be given.
+        maxlen : int, optional
+            Maximum number of frames waiting to be written. If the disk can't keep up and the queue
+            fills, the oldest queued frames are dropped.
+        compress : bool, optional
+            Whether to write a compressed frame store instead of a ``.npy`` file
+
+        See `grab_image()` for the set of available kwds.
+
+        Returns
+        -------
+        stats : dict
+            The number of frames written (``n_frames``), the number dropped because the writer
+            fell behind (``n_dropped``) or reported missing by the camera (``n_camera_dropped``),
+            ``elapsed_s``, ``frames_per_s``, the sustained write throughput
+            (``write_MB_per_s``), and the ``compression_ratio``
         """
+        if n_frames is None and duration is None:
+            raise ValueError("Must give n_frames and/or duration")
+        if self._stream is not None:
+            raise Error("Can't record while a stream is running")
+        if self._frame_buffer_len and self._frame_buffer_len < maxlen + 2:
+            raise Error("The frame buffer must have at least maxlen+2 slots, or queued frames "
+                        "would be overwritten")
+
+        defaults = self._defaults or self.DEFAULT_KWDS
+        exposure_time = kwds.get('exposure_time', defaults['exposure_time'])
+        metadata = {'exposure_time': str(Q_(exposure_time))}
+        recorder = FrameRecorder(path, n_frames, maxlen, metadata, compress)
+
+        deadline = None
+        try:
+            for frame in self._iter_frames(n_frames, Q_('1s'), kwds):
+                if frame.seq == 0:
+                    left, top, hbin, vbin = self._frame_geometry
+                    height, width = frame.array.shape
+                    recorder.metadata['roi'] = {
+                        'left': left, 'top': top, 'right': left + width, 'bot': top + height,
+                        'hbin': int(hbin), 'vbin': int(vbin)}
+                recorder.put(frame)
+                if duration is not None:
+                    if deadline is None:
+                        deadline = frame.timestamp + duration.m_as('s')
+                    elif frame.timestamp >= deadline:
+                        break
+        finally:
+            stats = recorder.close()
+
+        if stats['n_dropped'] or stats['n_camera_dropped']:
+            log.warning("Recording dropped %d frame(s) while writing, and the camera dropped %d",
+                        stats['n_dropped'], stats['n_camera_dropped'])
+        return stats
+
+    def enable_frame_buffer(self, n_frames=16):
+        """Copy live frames into a preallocated ring buffer of `n_frames` slots.
+
+        While enabled, `latest_frame()` copies each frame out of the SDK's memory exactly once,
+        into the next slot of a `FrameRingBuffer`, and returns a read-only view of that slot
+        (regardless of `copy`). A view stays valid until `n_frames` newer frames have arrived. The
+        buffer is allocated on the first frame and only reallocated if the frame shape or dtype
+        changes, so memory use stays fixed during long runs of live video.
+
+        The buffer itself is available as `frame_buffer`, which gives access to frame sequence
+        numbers, timestamps and the count of overwritten frames.
+        """
+        if n_frames < 1:
+            raise ValueError("Frame buffer must have at least one slot")
+        self._frame_buffer_len = n_frames
+        self._frame_buffer = None
+
+    def disable_frame_buffer(self):
+        """Stop using the frame ring buffer and release its memory"""
+        self._frame_buffer_len = 0
+        self._frame_buffer = None
+
+    @property
+    def frame_buffer(self):
+        """The `FrameRingBuffer` used for live frames, or None if none has been allocated"""
+        return self._frame_buffer
+
+    def _output_frame(self, array, copy=True, out=None):
+        """Prepare an array that references SDK memory for handing to the user
+
+        Drivers should call this with a (non-copied) view of the SDK's buffer. If `out` is given,
+        the frame is written into it.
+        """
+        if out is not None:
+            out = self._output_image(array, out=out)
+            if self._frame_buffer_len:
+                self._push_frame(out)
+            return out
+
+        if self._correction is not None:
+            # The corrected frame is either freshly allocated or copied into the ring buffer, so
+            # the correction's own buffer can be reused when the user doesn't want a copy
+            corr = self._correction
+            reuse_buffer = bool(self._frame_buffer_len) or not copy
+            array = self._correct_frame(array, out=corr.buffer if reuse_buffer else None)
+            copy = False
+
+        if self._frame_buffer_len:
+            return self._push_frame(array)
+        return np.copy(array) if copy else array
+
+    def _push_frame(self, array):
+        """Copy `array` into the frame buffer, returning the buffer's read-only view of it"""
+        ring = self._frame_buffer
+        if ring is None or not ring.matches(array.shape, array.dtype):
+            ring = FrameRingBuffer(self._frame_buffer_len, array.shape, array.dtype)
+            self._frame_buffer = ring
+        return ring.push(array, time.time()).array
+
+    def enable_correction(self, dark=None, flat=None):
+        """Apply dark subtraction and/or flat-field division to every frame.
+
+        Once enabled, images returned by `get_captured_image()`, `grab_image()` and
+        `latest_frame()` are float32 arrays of ``(image - dark) / flat``, where `flat` is
+        normalized to a mean of one. The calibration arrays are cut down to the ROI and binning
+        of the current acquisition when it starts, so each frame is corrected without allocating
+        temporaries. With ``latest_frame(copy=False)``, the result is written into a preallocated
+        buffer that is reused for the next frame.
+
+        Parameters
+        ----------
+        dark : array, optional
+            Dark frame. Defaults to the dark frame of the camera's `DarkCalibration`, if it has
+            one.
+        flat : array, optional
+            Dark-subtracted flat field
+
+        Both arrays may either match the shape of the frames, or cover the full unbinned sensor.
+        See `FlatFieldCorrection` for details.
+        """
+        if dark is None and self._dark_calibration is not None:
+            dark = self._dark_calibration.dark
+        self._correction = FlatFieldCorrection(dark, flat)
+
+    def disable_correction(self):
+        """Stop applying dark/flat-field correction"""
+        self._correction = None
+
+    def _correct_frame(self, array, out=None):
+        """Apply the dark/flat-field correction to `array`, writing the result into `out`"""
+        corr = self._correction
+        corr.prepare(array.shape, *self._frame_geometry)
+        return corr.apply(array, out=out)
+
+    def _output_image(self, array, copy=True, out=None):
+        """Prepare a captured image that references SDK memory for handing to the user
+
+        Applies the dark/flat-field correction, if enabled. If `out` is given, the image is
+        written into it, after checking that its shape and dtype match.
+        """
+        if out is not None:
+            dtype = array.dtype if self._correction is None else np.float32
+            check_out_array(out, array.shape, dtype)
+        if self._correction is not None:
+            return self._correct_frame(array, out)
+        if out is not None:
+            np.copyto(out, array)
+            return out
+        return np.copy(array) if copy else array
+
+    def start_stream(self, maxlen=64, policy='drop_oldest', **kwds):
+        """Start live video, with a background thread that queues up every frame.
+
+        Returns a `FrameStream`, which yields `Frame` objects in order of arrival. Unlike polling
+        `wait_for_frame()` and `latest_frame()`, frames aren't missed when the consumer is briefly
+        slower than the camera, as long as the queue doesn't fill up. While streaming, the
+        acquisition thread owns the camera, so don't call the live-video methods directly.
+
+        Parameters
+        ----------
+        maxlen : int, optional
+            Maximum number of frames to hold in the queue
+        policy : str, optional
+            What to do when the queue is full: 'drop_oldest' discards the oldest queued frame,
+            while 'block' pauses the acquisition thread until there is room (so the camera SDK may
+            drop frames instead).
+
+        See `grab_image()` for the set of available kwds.
+        """
+        if self._stream is not None:
+            raise Error("A stream is already running. Stop it first using `stop_stream()`")
+        if self._frame_buffer_len and self._frame_buffer_len < maxlen + 2:
+            raise Error("The frame buffer must have at least maxlen+2 slots, or queued frames "
+                        "would be overwritten")
+
+        stream = FrameStream(self, maxlen, policy)
+        self.start_live_video(**kwds)
+        stream.start()
+        self._stream = stream
+        return stream
+
+    def stop_stream(self):
+        """Stop the background acquisition thread and live video mode"""
+        if self._stream is None:
+            return
+        try:
+            self._stream.stop()
+        finally:
+            self._stream = None
+            self.stop_live_video()
+
+    @property
+    def stream(self):
+        """The currently running `FrameStream`, or None"""
+        return self._stream
 
     def set_defaults(self, **kwds):
         if self._defaults is None:
@@ -220,6 +582,8 @@ class Camera(Instrument):
         if fill_coords:
             self.fill_all_coords(kwds, ('width', 'cx', 'left', 'right'))
             self.fill_all_coords(kwds, ('height', 'cy', 'top', 'bot'))
+            self._frame_geometry = (int(kwds['left']), int(kwds['top']), kwds['hbin'],
+                                    kwds['vbin'])
 
     def fill_all_coords(self, kwds, names):
         n_args = sum(kwds[n] is not None for n in names)
@@ -282,10 +646,7 @@ class Camera(Instrument):
         stddev = np.sqrt(np.var(img))
 
         threshold = avg + stddevs*stddev
-        pixels = np.argwhere(img > threshold)
-
-        # Cast to avoid the indices being longs in Py2
-        self._hot_pixels = pixels.astype('int32', copy=False).tolist()
+        self._hot_pixels = HotPixelMap(np.argwhere(img > threshold))
 
     def save_hot_pixels(self, path=None):
         """Save a file listing the hot pixels."""
@@ -300,36 +661,88 @@ class Camera(Instrument):
                 path = 'hotpixel.json'
 
         with open(path, 'w') as f:
-            json.dump({'hot_pixels': self._hot_pixels}, f)
+            json.dump({'hot_pixels': self._hot_pixels.tolist()}, f)
 
         new_path = os.path.abspath(path)
         if self._alias and self._param_dict.get('hotpixel_file', None) != new_path:
             self._param_dict['hotpixel_file'] = new_path
             self.save_instrument(self._alias, force=True)
 
-    def _correct_hot_pixels(self, img):
-        """Correct hot pixels by averaging their neighbors."""
+    def calibrate_dark(self, n_frames=100, stddevs=5, **kwds):
+        """Build a dark frame, noise map and hot pixel list from a series of dark frames.
+
+        Streams `n_frames` frames in live video mode, accumulating the running per-pixel mean and
+        variance in a fixed amount of memory. A pixel is marked as hot if its mean or its noise is
+        more than `stddevs` robust standard deviations above the typical pixel's, so pixels that
+        are only intermittently hot are caught too. The sensor should be covered while this runs.
+
+        The hot pixels found replace the camera's current list. Use `save_calibration()` to save
+        the results so they are loaded automatically the next time the camera is opened.
+
+        Returns a `DarkCalibration`. See `grab_image()` for the set of available kwds.
+        """
+        if n_frames < 2:
+            raise ValueError("At least two frames are needed to calibrate")
+
+        # Calibrate from the raw sensor frames, ignoring any enabled correction
+        if self._stream is not None:
+            raise Error("Can't calibrate while a stream is running")
+        stats = None
+        for frame in self._iter_frames(n_frames, Q_('1s'), kwds, correct=False):
+            if stats is None:
+                stats = RunningStats(frame.array.shape)
+            stats.add(frame.array)
+
+        calib = DarkCalibration.from_stats(stats, stddevs)
+        self._dark_calibration = calib
+        self._hot_pixels = HotPixelMap(calib.hot_pixels)
+        return calib
+
+    @property
+    def dark_calibration(self):
+        """The camera's current `DarkCalibration`, or None"""
+        return self._dark_calibration
+
+    def save_calibration(self, path=None):
+        """Save the dark calibration made by `calibrate_dark()` as a ``.npz`` file."""
+        if self._dark_calibration is None:
+            raise Error("No existing dark calibration to save. Generate one first by using "
+                        "`calibrate_dark()`")
+
+        if not path:
+            if self._alias:
+                path = os.path.join(conf.user_conf_dir, 'darkcal_{}.npz'.format(self._alias))
+            else:
+                path = 'darkcal.npz'
+
+        self._dark_calibration.save(path)
+
+        new_path = os.path.abspath(path)
+        if self._alias and self._param_dict.get('calibration_file', None) != new_path:
+            self._param_dict['calibration_file'] = new_path
+            self.save_instrument(self._alias, force=True)
+
+    def _correct_hot_pixels(self, img, in_place=False):
+        """Correct hot pixels by averaging their neighbors.
+
+        If `in_place` is True, `img` must be a writeable, C-contiguous array, and is modified
+        directly instead of being copied.
+        """
         if self._hot_pixels is None:
             raise Error("Could not correct hot pixels because we have no existing list of hot "
                         "pixels. Generate one first by using `find_hot_pixels()`")
 
-        if len(img.shape) != 2:
-            raise NotImplementedError("Hot pixel correction currently implemented only for "
-                                      "monochrome sensors")
-
         # TODO: Probably shouldn't include adjacent hot pixels
-        img = img.copy()
-        for y, x in self._hot_pixels:
-            left = max(0, x-1)
-            right = min(img.shape[1], x+2)
-            top = max(0, y-1)
-            bot = min(img.shape[0], y+2)
-            img[y, x] = (img[top:bot, left:right].sum() - img[y, x])/((bot-top)*(right-left)-1)
-        return img
+        return self._hot_pixels.correct(img, in_place)
 
 
 def _init_instrument(cam, params):
     if 'hotpixel_file' in params:
         with open(params['hotpixel_file']) as f:
             hotpixel_data = json.load(f)
-            cam._hot_pixels = hotpixel_data['hot_pixels']
+            cam._hot_pixels = HotPixelMap(hotpixel_data['hot_pixels'])
+
+    if 'calibration_file' in params:
+        calib = DarkCalibration.load(params['calibration_file'])
+        cam._dark_calibration = calib
+        cam._hot_pixels = HotPixelMap(calib.hot_pixels)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Multi-frame dark calibration of camera sensors.
+"""
+import numpy as np
+
+__all__ = ['RunningStats', 'DarkCalibration']
+
+
+class RunningStats(object):
+    """Per-pixel running mean and variance of a stream of frames.
+
+    Uses Welford's algorithm, which is numerically stable and needs only a fixed amount of memory
+    (a few float64 arrays the size of one frame), no matter how many frames are added.
+
+    Parameters
+    ----------
+    shape : tuple of ints
+        Shape of each frame
+    """
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.n = 0
+        self._mean = np.zeros(self.shape)
+        self._m2 = np.zeros(self.shape)  # Sum of squared deviations from the mean
+        self._delta = np.empty(self.shape)
+        self._delta2 = np.empty(self.shape)
+
+    def add(self, frame):
+        """Add a frame to the statistics"""
+        if frame.shape != self.shape:
+            raise ValueError("Frame shape {} doesn't match {}".format(frame.shape, self.shape))
+        self.n += 1
+        np.subtract(frame, self._mean, out=self._delta)
+        np.divide(self._delta, self.n, out=self._delta2)
+        self._mean += self._delta2
+        np.subtract(frame, self._mean, out=self._delta2)
+        self._delta *= self._delta2
+        self._m2 += self._delta
+
+    @property
+    def mean(self):
+        """Per-pixel mean"""
+        return self._mean
+
+    @property
+    def variance(self):
+        """Per-pixel (sample) variance"""
+        if self.n < 2:
+            raise ValueError("At least two frames are needed to compute a variance")
+        return self._m2 / (self.n - 1)
+
+    @property
+    def std(self):
+        """Per-pixel (sample) standard deviation"""
+        return np.sqrt(self.variance)
+
+
+def _outliers(values, stddevs):
+    """Mask of values more than `stddevs` robust standard deviations above the median"""
+    median = np.median(values)
+    sigma = 1.4826 * np.median(np.abs(values - median))  # From the median absolute deviation
+    return values > median + stddevs * max(sigma, np.finfo(float).eps)
+
+
+class DarkCalibration(object):
+    """Dark frame, noise map and hot pixel mask of a camera sensor.
+
+    Usually created by `Camera.calibrate_dark()`.
+
+    Attributes
+    ----------
+    dark : numpy.ndarray of float32
+        Per-pixel mean of the dark frames
+    noise : numpy.ndarray of float32
+        Per-pixel temporal standard deviation of the dark frames
+    hot_mask : numpy.ndarray of bool
+        Mask of the hot pixels
+    n_frames : int
+        Number of frames the calibration was built from
+    """
+    def __init__(self, dark, noise, hot_mask, n_frames):
+        self.dark = np.asarray(dark, np.float32)
+        self.noise = np.asarray(noise, np.float32)
+        self.hot_mask = np.asarray(hot_mask, bool)
+        self.n_frames = n_frames
+
+    @classmethod
+    def from_stats(cls, stats, stddevs=5):
+        """Create a calibration from a `RunningStats`.
+
+        A pixel is considered hot if either its mean or its noise is more than `stddevs` robust
+        standard deviations above that of a typical pixel. The latter catches pixels that are only
+        hot some of the time, which a single frame would often miss.
+        """
+        noise = stats.std
+        hot_mask = _outliers(stats.mean, stddevs) | _outliers(noise, stddevs)
+        return cls(stats.mean, noise, hot_mask, stats.n)
+
+    @property
+    def hot_pixels(self):
+        """(y, x) coordinates of the hot pixels, as an Nx2 array"""
+        return np.argwhere(self.hot_mask)
+
+    def save(self, path):
+        """Save the calibration as a ``.npz`` file"""
+        hot_pixels = self.hot_pixels.astype(np.int32)
+        with open(path, 'wb') as f:
+            np.savez(f, dark=self.dark, noise=self.noise, hot_pixels=hot_pixels,
+                     n_frames=self.n_frames)
+
+    @classmethod
+    def load(cls, path):
+        """Load a calibration saved by `save()`"""
+        with np.load(path) as data:
+            dark = data['dark']
+            hot_mask = np.zeros(dark.shape, bool)
+            hot_mask[tuple(data['hot_pixels'].T)] = True
+            return cls(dark, data['noise'], hot_mask, int(data['n_frames']))
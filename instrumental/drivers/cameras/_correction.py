@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Dark-frame and flat-field correction of camera images.
+"""
+import numpy as np
+from ...errors import Error
+
+__all__ = ['FlatFieldCorrection']
+
+
+def _bin(arr, vbin, hbin, reduce):
+    height, width = arr.shape[0] // vbin, arr.shape[1] // hbin
+    blocks = arr[:height*vbin, :width*hbin].reshape((height, vbin, width, hbin))
+    return reduce(blocks, axis=(1, 3))
+
+
+class FlatFieldCorrection(object):
+    """Dark subtraction and flat-field division of camera frames.
+
+    Computes ``(frame - dark) / flat`` as float32, where `flat` is normalized to a mean of one.
+    The dark frame and the reciprocal of the flat field are cut down to the frame's ROI and binning
+    once, when `prepare()` is called with a new geometry. Each frame is then converted into the
+    output array and corrected in place, with no temporaries.
+
+    Parameters
+    ----------
+    dark : array, optional
+        Dark frame, i.e. the mean of frames taken with the sensor covered
+    flat : array, optional
+        Dark-subtracted flat field, i.e. the mean of frames of a uniformly lit target
+
+    Both arrays may either match the shape of the frames being corrected, or cover the full,
+    unbinned sensor, in which case they are cropped to the ROI and binned as needed. When binning,
+    dark frames are summed and flat fields averaged over each bin. This doesn't account for
+    read-out offsets, so for precise work use calibration frames taken with the same binning.
+    """
+    def __init__(self, dark=None, flat=None):
+        if dark is None and flat is None:
+            raise ValueError("Must provide a dark frame and/or a flat field")
+
+        self.dark = None if dark is None else np.asarray(dark, np.float32)
+        if flat is None:
+            self.flat = None
+        else:
+            flat = np.asarray(flat, np.float32)
+            self.flat = flat / flat.mean()
+
+        self._geometry = None
+        self._dark = None
+        self._gain = None
+        self.buffer = None
+
+    def _fit(self, arr, shape, left, top, hbin, vbin, reduce):
+        if arr.shape == shape:
+            return arr
+
+        y0, x0 = top * vbin, left * hbin
+        y1, x1 = y0 + shape[0] * vbin, x0 + shape[1] * hbin
+        if y1 > arr.shape[0] or x1 > arr.shape[1]:
+            raise Error("Calibration frame of shape {} doesn't cover the ROI of a {} frame at "
+                        "({}, {}) with binning {}x{}".format(arr.shape, shape, left, top, hbin,
+                                                             vbin))
+        arr = arr[y0:y1, x0:x1]
+        if hbin > 1 or vbin > 1:
+            arr = _bin(arr, vbin, hbin, reduce)
+        return np.ascontiguousarray(arr, np.float32)
+
+    def prepare(self, shape, left=0, top=0, hbin=1, vbin=1):
+        """Set up the correction arrays and output buffer for frames of the given geometry.
+
+        `left` and `top` give the position of the ROI in units of binned pixels. Does nothing if
+        the geometry is unchanged since the last call.
+        """
+        geometry = (tuple(shape), left, top, hbin, vbin)
+        if geometry == self._geometry:
+            return
+        shape = tuple(shape)
+
+        if self.dark is not None:
+            self._dark = self._fit(self.dark, shape, left, top, hbin, vbin, np.sum)
+        if self.flat is not None:
+            flat = self._fit(self.flat, shape, left, top, hbin, vbin, np.mean)
+            with np.errstate(divide='ignore'):
+                gain = np.where(flat > 0, 1. / flat, 0.)
+            self._gain = gain.astype(np.float32)
+
+        self.buffer = np.empty(shape, np.float32)
+        self._geometry = geometry
+
+    def apply(self, frame, out=None):
+        """Correct `frame`, writing the float32 result into `out`.
+
+        If `out` is None, a new array is allocated. `prepare()` must have been called for the
+        frame's geometry first.
+        """
+        if self._geometry is None or frame.shape != self._geometry[0]:
+            raise Error("Correction isn't prepared for frames of shape {}".format(frame.shape))
+        if out is None:
+            out = np.empty(frame.shape, np.float32)
+
+        # Converting first and then working purely in float32 is much faster than letting the
+        # ufuncs cast the integer frame on the fly
+        np.copyto(out, frame)
+        if self._dark is not None:
+            np.subtract(out, self._dark, out=out)
+        if self._gain is not None:
+            np.multiply(out, self._gain, out=out)
+        return out
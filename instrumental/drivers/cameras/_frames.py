@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Frame containers shared by the camera drivers.
+"""
+import time
+import threading
+from collections import deque
+import numpy as np
+from ..util import unit_mag
+from ...errors import Error, TimeoutError
+from ...log import get_logger
+
+log = get_logger(__name__)
+
+__all__ = ['Frame', 'FrameRingBuffer', 'FrameQueue', 'FrameStream']
+
+
+class Frame(object):
+    """A single camera frame along with its bookkeeping info.
+
+    Attributes
+    ----------
+    array : numpy.ndarray
+        The image data. When the frame comes from a `FrameRingBuffer`, this is a read-only view
+        that stays valid until its slot is reused, i.e. until ``len(buffer)`` newer frames have
+        been pushed.
+    seq : int
+        Sequence number of the frame, counting from zero
+    timestamp : float or None
+        Host time (as given by `time.time()`) at which the frame was received
+    hw_seq : int or None
+        Frame number reported by the camera itself, if the driver supports it
+    hw_timestamp : float or None
+        Time in seconds at which the camera captured the frame, according to the camera's own
+        clock, if the driver supports it
+    dropped : int
+        Number of frames that the camera's frame counter indicates were lost between the previous
+        frame and this one. Always zero if `hw_seq` is unavailable.
+    results : dict or None
+        Measurements made by the `Analysis` stages of the camera's `Pipeline`, keyed by stage
+        name, if the frame went through one
+    """
+    __slots__ = ('array', 'seq', 'timestamp', 'hw_seq', 'hw_timestamp', 'dropped', 'results')
+
+    def __init__(self, array, seq, timestamp=None, hw_seq=None, hw_timestamp=None, dropped=0):
+        self.array = array
+        self.seq = seq
+        self.timestamp = timestamp
+        self.hw_seq = hw_seq
+        self.hw_timestamp = hw_timestamp
+        self.dropped = dropped
+        self.results = None
+
+    def __repr__(self):
+        return '<Frame seq={} shape={} dtype={}>'.format(self.seq, self.array.shape,
+                                                         self.array.dtype)
+
+
+def grab_frame(camera, seq, last_hw_seq=None):
+    """Get the camera's latest frame as a `Frame`, along with its hardware metadata.
+
+    Must be called after a successful `wait_for_frame()`. `last_hw_seq` is the hardware frame
+    number of the previously grabbed frame, and is used to detect dropped frames.
+    """
+    timestamp = time.time()
+    array = camera.latest_frame(copy=True)
+    hw_seq, hw_timestamp = camera._latest_frame_info()
+
+    dropped = 0
+    if hw_seq is not None and last_hw_seq is not None:
+        dropped = max(hw_seq - last_hw_seq - 1, 0)
+        if dropped:
+            log.warning("Camera dropped %d frame(s) before frame %d", dropped, seq)
+    return Frame(array, seq, timestamp, hw_seq, hw_timestamp, dropped)
+
+
+def check_out_array(out, shape, dtype):
+    """Raise an Error unless `out` can hold an image of the given shape and dtype"""
+    if out.shape != tuple(shape) or out.dtype != dtype:
+        raise Error("Output array of shape {} and dtype {} doesn't match image of shape {} and "
+                    "dtype {}".format(out.shape, out.dtype, tuple(shape), np.dtype(dtype)))
+
+
+class CapturedImages(object):
+    """Collects the images of a capture sequence for a driver's `get_captured_image()`
+
+    Drivers `add()` each image as a view of SDK memory. The images are copied (and corrected)
+    via `Camera._output_image()`, either into separate arrays or, if `stack` is True, straight
+    into the slices of one preallocated ``(n_images, height, width)`` array. Images left over
+    from an earlier, timed-out call can be passed as `prefix`.
+
+    A user-supplied `out` array is used in place of the stack. It may also be a single
+    ``(height, width)`` array when the sequence has only one image.
+    """
+    def __init__(self, camera, n_images, copy=True, stack=False, prefix=(), out=None):
+        self.camera = camera
+        self.n_images = len(prefix) + n_images
+        self.copy = copy
+        self.stack = stack or out is not None
+        self._images = []
+        self._stack = None
+        self._out = out
+        self._single_out = out if out is not None and out.ndim == 2 else None
+
+        if self._single_out is not None:
+            if self.n_images != 1:
+                raise Error("A sequence of {} images needs an output array of shape "
+                            "({}, height, width)".format(self.n_images, self.n_images))
+            self._out = out[np.newaxis]
+
+        for image in prefix:  # Already processed, so only needs copying when stacking
+            if self.stack:
+                slot = self._slot(image)
+                np.copyto(slot, image)
+                image = slot
+            self._images.append(image)
+
+    def __len__(self):
+        return len(self._images)
+
+    def _slot(self, array):
+        if self._stack is None:
+            dtype = array.dtype if self.camera._correction is None else np.float32
+            shape = (self.n_images,) + array.shape
+            if self._out is None:
+                self._stack = np.empty(shape, dtype)
+            else:
+                check_out_array(self._out, shape, dtype)
+                self._stack = self._out
+        return self._stack[len(self._images)]
+
+    def add(self, array, owned=False):
+        """Add an image. Set `owned` if `array` is already a private copy of the SDK's memory."""
+        if self.stack:
+            image = self.camera._output_image(array, out=self._slot(array))
+        else:
+            image = self.camera._output_image(array, copy=(self.copy and not owned))
+        self._images.append(image)
+
+    @property
+    def images(self):
+        """List of the images added so far"""
+        return list(self._images)
+
+    def result(self):
+        """The return value for `get_captured_image()`"""
+        if self._single_out is not None:
+            return self._single_out
+        elif self.stack:
+            return self._stack[:len(self._images)]
+        elif len(self._images) == 1:
+            return self._images[0]
+        else:
+            return tuple(self._images)
+
+
+class FrameRingBuffer(object):
+    """Ring of preallocated frame slots.
+
+    Frames are copied into the buffer once via `push()`, and are handed out as read-only views
+    into its memory, so the amount of memory used stays fixed no matter how long the camera runs.
+    Once the buffer is full, each new frame overwrites the oldest one. Frames that get overwritten
+    before being read via `read()` are counted in `n_overwritten`.
+
+    Parameters
+    ----------
+    size : int
+        Number of frame slots
+    shape : tuple of ints
+        Shape of each frame
+    dtype : numpy.dtype or str
+        Data type of each frame
+    """
+    def __init__(self, size, shape, dtype):
+        if size < 1:
+            raise ValueError("Ring buffer must have at least one slot")
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._data = np.empty((size,) + self.shape, self.dtype)
+        self._timestamps = [None] * size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """Discard all frames and reset the sequence numbering and counters"""
+        with self._lock:
+            self._next_seq = 0  # Sequence number of the next frame to be pushed
+            self._read_seq = 0  # Sequence number of the oldest unread frame
+            self.n_overwritten = 0
+
+    def matches(self, shape, dtype):
+        """Whether frames of the given shape and dtype fit in this buffer"""
+        return tuple(shape) == self.shape and np.dtype(dtype) == self.dtype
+
+    @property
+    def nbytes(self):
+        """Total size of the frame memory, in bytes"""
+        return self._data.nbytes
+
+    @property
+    def n_pushed(self):
+        """Total number of frames pushed since the last `clear()`"""
+        return self._next_seq
+
+    @property
+    def n_unread(self):
+        """Number of frames that have been pushed, but not yet returned by `read()`"""
+        return self._next_seq - self._read_seq
+
+    def push(self, array, timestamp=None):
+        """Copy `array` into the next slot, returning it as a `Frame`"""
+        if array.shape != self.shape or array.dtype != self.dtype:
+            raise Error("Frame of shape {} and dtype {} doesn't match ring buffer of shape {} and "
+                        "dtype {}".format(array.shape, array.dtype, self.shape, self.dtype))
+
+        with self._lock:
+            seq = self._next_seq
+            if seq - self._read_seq >= len(self._data):
+                # The oldest unread frame lives in the slot we're about to fill
+                self._read_seq = seq - len(self._data) + 1
+                self.n_overwritten += 1
+
+        i = seq % len(self._data)
+        np.copyto(self._data[i], array)
+        self._timestamps[i] = timestamp
+
+        with self._lock:
+            self._next_seq = seq + 1
+        return self._frame(seq)
+
+    def _frame(self, seq):
+        i = seq % len(self._data)
+        view = self._data[i]
+        view.flags.writeable = False
+        return Frame(view, seq, self._timestamps[i])
+
+    def get(self, seq):
+        """Get the frame with sequence number `seq`, if it is still held in the buffer"""
+        with self._lock:
+            if not (self._next_seq - len(self._data) <= seq < self._next_seq):
+                raise Error("Frame {} is not in the ring buffer".format(seq))
+            return self._frame(seq)
+
+    def latest(self):
+        """Get the most recently pushed frame, or None if the buffer is empty"""
+        with self._lock:
+            if self._next_seq == 0:
+                return None
+            return self._frame(self._next_seq - 1)
+
+    def read(self):
+        """Get the oldest unread frame and mark it as read, or return None if there are none"""
+        with self._lock:
+            if self._read_seq == self._next_seq:
+                return None
+            frame = self._frame(self._read_seq)
+            self._read_seq += 1
+            return frame
+
+
+class FrameQueue(object):
+    """Bounded, thread-safe FIFO queue of frames.
+
+    Parameters
+    ----------
+    maxlen : int
+        Maximum number of frames held by the queue
+    policy : str
+        What `put()` does when the queue is full. With 'drop_oldest', the oldest queued frame is
+        discarded (and counted in `n_dropped`). With 'block', `put()` waits until the consumer
+        makes room.
+    """
+    POLICIES = ('drop_oldest', 'block')
+
+    def __init__(self, maxlen, policy='drop_oldest'):
+        if policy not in self.POLICIES:
+            raise ValueError("policy must be one of {}".format(self.POLICIES))
+        if maxlen < 1:
+            raise ValueError("maxlen must be at least 1")
+        self.maxlen = maxlen
+        self.policy = policy
+        self.n_dropped = 0
+        self._frames = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        """Close the queue, waking up any waiting producer or consumer"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def put(self, frame):
+        """Add a frame to the back of the queue. Returns False if the queue has been closed."""
+        with self._cond:
+            while len(self._frames) >= self.maxlen and not self._closed:
+                if self.policy == 'drop_oldest':
+                    self._frames.popleft()
+                    self.n_dropped += 1
+                else:
+                    self._cond.wait()
+
+            if self._closed:
+                return False
+            self._frames.append(frame)
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """Remove and return the frame at the front of the queue.
+
+        Waits up to `timeout` seconds (forever if None) for a frame to arrive. Returns None if the
+        timeout is reached, or if the queue is closed and empty.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._frames and not self._closed:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+
+            if not self._frames:
+                return None
+            frame = self._frames.popleft()
+            self._cond.notify_all()
+            return frame
+
+
+class FrameStream(object):
+    """Live video stream fed by a background acquisition thread.
+
+    Created via `Camera.start_stream()`. The thread waits on the camera's frame events, copies each
+    frame as soon as it arrives, and pushes it onto a bounded `FrameQueue` along with its sequence
+    number, host timestamp and any hardware metadata the driver provides. As long as the consumer
+    keeps up on average, no frames are lost, even if it is occasionally slower than the frame
+    period.
+
+    Iterating over the stream yields `Frame` objects until the stream is stopped::
+
+        >>> stream = cam.start_stream(maxlen=100)
+        >>> for frame in stream:
+        ...     process(frame.array)
+    """
+    POLL_INTERVAL = '100ms'  # How often the thread checks whether it should stop
+
+    def __init__(self, camera, maxlen=64, policy='drop_oldest'):
+        self.camera = camera
+        self.queue = FrameQueue(maxlen, policy)
+        self.n_acquired = 0
+        self.n_missed = 0  # Frames lost by the camera, according to its frame counter
+        self.error = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='FrameStream')
+        self._thread.daemon = True
+
+    @property
+    def n_dropped(self):
+        """Number of frames discarded because the queue was full"""
+        return self.queue.n_dropped
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        cam = self.camera
+        last_hw_seq = None
+        try:
+            while not self._stop_event.is_set():
+                if not cam.wait_for_frame(timeout=self.POLL_INTERVAL):
+                    continue
+                frame = grab_frame(cam, self.n_acquired, last_hw_seq)
+                last_hw_seq = frame.hw_seq
+                self.n_acquired += 1
+                self.n_missed += frame.dropped
+                if not self.queue.put(frame):
+                    break
+        except Exception as e:
+            log.exception("Error in frame acquisition thread")
+            self.error = e
+        finally:
+            self.queue.close()
+
+    def stop(self):
+        """Stop the acquisition thread. Frames still in the queue can still be read."""
+        self._stop_event.set()
+        self.queue.close()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    @unit_mag(timeout='?s')
+    def get(self, timeout=None):
+        """Get the next frame from the queue.
+
+        Raises a TimeoutError if no frame arrives within `timeout`, and raises StopIteration once
+        the stream has been stopped and the queue is empty. If the acquisition thread hit an
+        error, it is re-raised here.
+        """
+        frame = self.queue.get(timeout)
+        if frame is None:
+            if self.error is not None:
+                raise self.error
+            if self.queue.closed:
+                raise StopIteration
+            raise TimeoutError("Timed out while waiting for the next frame")
+        return frame
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except StopIteration:
+                return
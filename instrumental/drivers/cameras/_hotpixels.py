@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Vectorized hot pixel correction.
+"""
+import numpy as np
+
+__all__ = ['HotPixelMap']
+
+# Offsets of the eight neighbors of a pixel
+_NEIGHBOR_OFFSETS = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dy, dx) != (0, 0)]
+
+
+class HotPixelMap(object):
+    """A list of hot pixels, precompiled into index arrays for fast correction.
+
+    Each hot pixel is replaced by the mean of its (up to eight) neighbors, as read from the
+    uncorrected image. The flat indices of each hot pixel and its neighbors, along with the
+    neighbor weights, are computed once per image shape, so correcting a frame takes just a
+    gather, a weighted sum and a scatter.
+
+    Parameters
+    ----------
+    pixels : sequence of (y, x) pairs
+        Coordinates of the hot pixels
+    """
+    def __init__(self, pixels):
+        pixels = np.asarray(pixels, dtype=np.intp).reshape(-1, 2)
+        self.pixels = pixels
+        self._shape = None
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def tolist(self):
+        """The hot pixel coordinates as a list of [y, x] lists"""
+        return self.pixels.astype('int32').tolist()
+
+    def _compile(self, shape):
+        height, width = shape
+        ys, xs = self.pixels[:, 0], self.pixels[:, 1]
+        inside = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+        ys, xs = ys[inside], xs[inside]
+
+        n_ys = ys[:, None] + np.array([dy for dy, dx in _NEIGHBOR_OFFSETS])
+        n_xs = xs[:, None] + np.array([dx for dy, dx in _NEIGHBOR_OFFSETS])
+        valid = (n_ys >= 0) & (n_ys < height) & (n_xs >= 0) & (n_xs < width)
+
+        targets = ys * width + xs
+        # Out-of-bounds neighbors point at the hot pixel itself, and are masked out of the sum
+        neighbors = np.where(valid, n_ys * width + n_xs, targets[:, None])
+        counts = valid.sum(axis=1)
+
+        self._targets = targets
+        self._neighbors = neighbors
+        self._mask = valid.astype(float)
+        self._counts = np.maximum(counts, 1)
+        self._shape = tuple(shape)
+
+    def correct(self, img, in_place=False):
+        """Replace each hot pixel in `img` with the mean of its neighbors.
+
+        Returns the corrected image, which is `img` itself if `in_place` is True.
+        """
+        if img.ndim != 2:
+            raise NotImplementedError("Hot pixel correction currently implemented only for "
+                                      "monochrome sensors")
+        if img.shape != self._shape:
+            self._compile(img.shape)
+
+        if not in_place:
+            img = img.copy()
+        elif not img.flags.c_contiguous:
+            raise ValueError("In-place hot pixel correction requires a C-contiguous image")
+
+        flat = img.reshape(-1)
+        sums = (flat[self._neighbors] * self._mask).sum(axis=1)
+        flat[self._targets] = sums / self._counts
+        return img
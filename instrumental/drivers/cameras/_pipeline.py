@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Composable per-frame processing pipelines.
+"""
+from __future__ import division
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from ...errors import Error
+
+__all__ = ['Pipeline', 'Stage', 'Analysis', 'Crop', 'Bin', 'Subtract', 'LUT', 'Statistics',
+           'Function']
+
+
+class Stage(object):
+    """A single step of a `Pipeline`.
+
+    Subclasses implement `output_spec()`, which gives the shape and dtype of the stage's output for
+    a given input, and `process()`. If `allocates` is True, the pipeline preallocates an output
+    buffer of that shape and dtype for the stage and passes it to `process()`. Otherwise, the stage
+    returns a view of its input and is passed ``out=None``.
+    """
+    allocates = True
+
+    @property
+    def name(self):
+        return type(self).__name__.lower()
+
+    def output_spec(self, shape, dtype):
+        """Get the (shape, dtype) of the output for an input of the given shape and dtype"""
+        return shape, dtype
+
+    def process(self, frame, out):
+        """Process `frame`, writing the result into `out`, and return the result"""
+        raise NotImplementedError
+
+
+class Analysis(Stage):
+    """A stage that measures each frame without changing it.
+
+    Subclasses implement `analyze()`, whose return value is stored in the frame's results under
+    the stage's `name`.
+    """
+    allocates = False
+
+    def process(self, frame, out):
+        return frame
+
+    def analyze(self, frame):
+        raise NotImplementedError
+
+
+class Crop(Stage):
+    """Crop frames to the region ``[top:bot, left:right]``, without copying"""
+    allocates = False
+
+    def __init__(self, left, top, right, bot):
+        self.left, self.top, self.right, self.bot = left, top, right, bot
+
+    def output_spec(self, shape, dtype):
+        if self.right > shape[1] or self.bot > shape[0]:
+            raise Error("Crop region extends beyond frames of shape {}".format(shape))
+        return (self.bot - self.top, self.right - self.left), dtype
+
+    def process(self, frame, out):
+        return frame[self.top:self.bot, self.left:self.right]
+
+
+class Bin(Stage):
+    """Software binning, summing (or averaging) each `vbin` x `hbin` block of pixels.
+
+    Sums of integer frames are accumulated in at least 32 bits so they can't overflow, while
+    averages are float32. Rows and columns that don't fill a whole block are dropped.
+    """
+    def __init__(self, hbin, vbin, mean=False):
+        self.hbin, self.vbin, self.mean = hbin, vbin, mean
+
+    def output_spec(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        if self.mean:
+            out_dtype = np.dtype(np.float32)
+        elif dtype.kind in 'ui':
+            out_dtype = np.promote_types(dtype, 'u4' if dtype.kind == 'u' else 'i4')
+        else:
+            out_dtype = dtype
+        return (shape[0] // self.vbin, shape[1] // self.hbin), out_dtype
+
+    def process(self, frame, out):
+        height, width = out.shape
+        blocks = frame[:height*self.vbin, :width*self.hbin]
+        blocks = blocks.reshape((height, self.vbin, width, self.hbin))
+        np.sum(blocks, axis=(1, 3), out=out)
+        if self.mean:
+            out /= self.hbin * self.vbin
+        return out
+
+
+class Subtract(Stage):
+    """Subtract a background frame, giving float32 output"""
+    def __init__(self, background):
+        self.background = np.asarray(background, np.float32)
+
+    def output_spec(self, shape, dtype):
+        if tuple(shape) != self.background.shape:
+            raise Error("Background of shape {} doesn't match frames of shape {}".format(
+                self.background.shape, shape))
+        return shape, np.dtype(np.float32)
+
+    def process(self, frame, out):
+        np.copyto(out, frame)
+        np.subtract(out, self.background, out=out)
+        return out
+
+
+class LUT(Stage):
+    """Map each pixel value of integer frames through a lookup table.
+
+    Parameters
+    ----------
+    lut : array
+        The lookup table, indexed by pixel value. Its dtype determines the output dtype.
+    """
+    def __init__(self, lut):
+        self.lut = np.asarray(lut)
+
+    @classmethod
+    def linear(cls, low, high, bits=16):
+        """Table that linearly scales `low`..`high` to 0..255, clipping values outside that range"""
+        values = np.arange(2**bits, dtype=float)
+        scaled = (values - low) * (255. / max(high - low, 1))
+        return cls(np.clip(scaled, 0, 255).astype(np.uint8))
+
+    def output_spec(self, shape, dtype):
+        if np.dtype(dtype).kind not in 'ui':
+            raise Error("LUT stage requires integer frames, not {}".format(dtype))
+        return shape, self.lut.dtype
+
+    def process(self, frame, out):
+        return np.take(self.lut, frame, out=out, mode='clip')
+
+
+class Statistics(Analysis):
+    """Measure the intensity, centroid, second moments and ROI sums of each frame.
+
+    The results are a dict with the following keys:
+
+    - ``'mean'``, ``'sum'``: mean and total pixel value
+    - ``'min'``, ``'max'``: minimum and maximum pixel value
+    - ``'centroid'``: intensity centroid, as (y, x)
+    - ``'variance'``: variance of the intensity distribution along each axis, as (y, x)
+    - ``'covariance'``: covariance of the intensity distribution's y and x
+    - ``'roi_sums'``: tuple of the raw pixel sums of each of `rois`
+
+    Positions and (co)variances are in pixels of the full frame. Those that depend on the total
+    are None if it is zero. The sum and moments are computed from the frame's row and column
+    sums, along with its x-weighted row sums for the covariance, using coordinate vectors that
+    are cached per frame shape. Each frame is converted into a reused float32 buffer first, so no
+    full-size temporaries are allocated per frame.
+
+    Besides being used as a stage of a `Pipeline`, the statistics of live frames can be computed
+    without copying them via `Camera.latest_stats()`::
+
+        >>> stats = Statistics(threshold=100, rois=[(0, 0, 64, 64)])
+        >>> cam.start_live_video()
+        >>> while cam.wait_for_frame():
+        ...     print(cam.latest_stats(stats)['centroid'])
+
+    Parameters
+    ----------
+    threshold : float, optional
+        Background level subtracted from every pixel before computing the mean, sum and moments,
+        with negative values clipped to zero
+    downsample : int, optional
+        Compute everything but the ROI sums from every `downsample`-th pixel along each axis
+    rois : list of (left, top, right, bot) tuples, optional
+        Regions of the full frame to sum the raw pixel values of
+    """
+    def __init__(self, threshold=None, downsample=1, rois=()):
+        self.threshold = threshold
+        self.downsample = max(int(downsample), 1)
+        self.rois = [tuple(int(v) for v in roi) for roi in rois]
+        self._grids = {}
+        self._local = threading.local()
+
+    def _grid(self, shape):
+        """Ones and coordinate vectors for the rows and columns of a sampled frame"""
+        try:
+            return self._grids[shape]
+        except KeyError:
+            ys = np.arange(shape[0], dtype=np.float32) * self.downsample
+            xs = np.arange(shape[1], dtype=np.float32) * self.downsample
+            grid = self._grids[shape] = (np.ones_like(ys), np.ones_like(xs), ys, xs)
+            return grid
+
+    def _weights(self, sample):
+        """The sample as float32, with the threshold applied, in this thread's buffer"""
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None or buf.shape != sample.shape:
+            buf = self._local.buffer = np.empty(sample.shape, np.float32)
+
+        if self.threshold is None:
+            np.copyto(buf, sample)
+        else:
+            np.subtract(sample, self.threshold, out=buf, dtype=np.float32)
+            np.maximum(buf, 0, out=buf)
+        return buf
+
+    def analyze(self, frame):
+        """Compute the statistics of a (height, width) frame, as a dict"""
+        step = self.downsample
+        sample = frame[::step, ::step] if step > 1 else frame
+        weights = self._weights(sample)
+        ones_y, ones_x, ys, xs = self._grid(sample.shape)
+
+        # Row sums, x-weighted row sums and column sums as BLAS matrix-vector products, which are
+        # much faster than sum()
+        rows = weights.dot(ones_x).astype(float)
+        rows_x = weights.dot(xs).astype(float)
+        cols = ones_y.dot(weights).astype(float)
+        total = rows.sum()
+        centroid = variance = covariance = None
+        if total > 0:
+            cy = rows.dot(ys) / total
+            cx = cols.dot(xs) / total
+            centroid = (cy, cx)
+            variance = (rows.dot(ys * ys) / total - cy**2, cols.dot(xs * xs) / total - cx**2)
+            covariance = rows_x.dot(ys) / total - cx * cy
+
+        return {
+            'mean': total / sample.size,
+            'min': sample.min(),
+            'max': sample.max(),
+            'sum': total,
+            'centroid': centroid,
+            'variance': variance,
+            'covariance': covariance,
+            'roi_sums': tuple(frame[top:bot, left:right].sum(dtype=float)
+                              for left, top, right, bot in self.rois),
+        }
+
+
+class Function(Stage):
+    """Apply a user function to each frame.
+
+    `func` is called as ``func(frame)``. If it returns an array, that becomes the stage's output.
+    If it returns None, the frame is passed through unchanged (e.g. for callbacks). Since the
+    output is whatever `func` returns, no buffer is preallocated for it.
+    """
+    allocates = False
+
+    def __init__(self, func, name=None):
+        self.func = func
+        self._name = name
+
+    @property
+    def name(self):
+        return self._name or getattr(self.func, '__name__', 'function')
+
+    def output_spec(self, shape, dtype):
+        return None, None  # Unknown until the function runs
+
+    def process(self, frame, out):
+        result = self.func(frame)
+        return frame if result is None else result
+
+
+class Pipeline(object):
+    """A sequence of processing stages applied to each camera frame.
+
+    Output buffers for each stage are preallocated per worker thread, based on the shapes and
+    dtypes the stages declare, so steady-state processing doesn't allocate intermediate arrays.
+    Only the final output of each frame is freshly allocated, since it is handed to the user.
+
+    When set as a camera's `~Camera.pipeline`, frames from `~Camera.frames()` are processed on a
+    pool of worker threads. Since NumPy releases the GIL for most operations, processing frame N
+    overlaps with acquiring frame N+1 and beyond, while frames are still yielded in order. Each
+    yielded `Frame` holds the processed array, and any `Analysis` results in its ``results``
+    dict::
+
+        >>> cam.pipeline = Pipeline([Crop(100, 100, 612, 612), Bin(2, 2), Statistics()])
+        >>> for frame in cam.frames(n=100):
+        ...     print(frame.results['statistics']['centroid'])
+
+    Parameters
+    ----------
+    stages : list of `Stage`
+        The stages to apply, in order
+    n_workers : int, optional
+        Number of worker threads
+    """
+    def __init__(self, stages, n_workers=2):
+        self.stages = list(stages)
+        self.n_workers = n_workers
+        self._local = threading.local()
+        self._pool = None
+
+    def _plan(self, shape, dtype):
+        """Compute the output spec of each stage, returning a list of (shape, dtype) pairs"""
+        specs = []
+        for stage in self.stages:
+            if shape is None:
+                if stage.allocates:
+                    raise Error("Stage '{}' can't follow a stage with unknown output shape"
+                                .format(stage.name))
+            else:
+                shape, dtype = stage.output_spec(tuple(shape), np.dtype(dtype))
+            specs.append((shape, dtype))
+        return specs
+
+    def _buffers(self, shape, dtype):
+        """This thread's scratch buffers for input of the given shape and dtype"""
+        cache = getattr(self._local, 'buffers', None)
+        if cache is None:
+            cache = self._local.buffers = {}
+
+        key = (tuple(shape), np.dtype(dtype))
+        if key not in cache:
+            specs = self._plan(shape, dtype)
+            allocating = [i for i, stage in enumerate(self.stages) if stage.allocates]
+            last = allocating[-1] if allocating else None
+            # The final allocating stage gets a fresh buffer per frame, which the user then owns
+            cache[key] = [np.empty(*spec) if (stage.allocates and i != last) else None
+                          for i, (stage, spec) in enumerate(zip(self.stages, specs))], last, specs
+        return cache[key]
+
+    def process(self, array):
+        """Run `array` through all stages, returning the (output array, results dict)"""
+        buffers, last, specs = self._buffers(array.shape, array.dtype)
+        results = {}
+        for i, stage in enumerate(self.stages):
+            out = buffers[i]
+            if i == last:
+                out = np.empty(*specs[i])
+            array = stage.process(array, out)
+            if isinstance(stage, Analysis):
+                results[stage.name] = stage.analyze(array)
+        return array, results
+
+    def _process_frame(self, frame):
+        frame.array, frame.results = self.process(frame.array)
+        return frame
+
+    def imap(self, frames, max_pending=None):
+        """Process an iterable of `Frame` objects on the worker pool, yielding them in order.
+
+        Up to `max_pending` frames (by default, twice the number of workers) are processed
+        concurrently while the next ones are being pulled from `frames`.
+        """
+        if self._pool is None:
+            self._pool = ThreadPool(self.n_workers)
+        max_pending = max_pending or 2 * self.n_workers
+
+        pending = deque()
+        try:
+            for frame in frames:
+                pending.append(self._pool.apply_async(self._process_frame, (frame,)))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            for result in pending:
+                result.wait()  # Don't leave workers writing into frames we've abandoned
+            if hasattr(frames, 'close'):
+                frames.close()
+
+    def close(self):
+        """Shut down the worker threads"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
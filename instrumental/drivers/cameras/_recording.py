@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Recording camera frames directly to disk.
+"""
+from __future__ import division
+import os
+import json
+import time
+import struct
+import threading
+import numpy as np
+from ...errors import Error
+from ...log import get_logger
+from ._frames import FrameQueue
+from ._store import ChunkedFrameWriter, ChunkedFrameReader, is_chunked_file
+
+log = get_logger(__name__)
+
+__all__ = ['NpyFrameWriter', 'FrameRecorder', 'load_recording']
+
+NPY_HEADER_SIZE = 256  # Leaves room to rewrite the shape once the final frame count is known
+
+# Per-frame metadata of a recording. Missing hardware info is stored as -1 or NaN.
+FRAME_INFO_DTYPE = np.dtype([('seq', np.int64), ('timestamp', np.float64),
+                             ('hw_seq', np.int64), ('hw_timestamp', np.float64)])
+
+
+def _npy_header(dtype, shape):
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    n_pad = NPY_HEADER_SIZE - 10 - len(header) - 1
+    if n_pad < 0:
+        raise Error("Array shape {} is too large for the .npy header".format(shape))
+    header = (header + ' ' * n_pad + '\n').encode('latin1')
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+
+class NpyFrameWriter(object):
+    """Writes frames into a memory-mapped ``.npy`` file of shape (n_frames, height, width).
+
+    Space for `capacity` frames is preallocated up front, and is grown in chunks of `capacity`
+    frames if more are written. When closed, the file is truncated to the frames actually
+    written, so it can be opened with ``np.load(path, mmap_mode='r')``.
+    """
+    def __init__(self, path, shape, dtype, capacity=256):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.n_written = 0
+        self._chunk = max(int(capacity), 1)
+        self._capacity = 0
+        self._mm = None
+
+        with open(path, 'wb') as f:
+            f.write(_npy_header(self.dtype, (0,) + self.shape))
+        self._grow(self._chunk)
+
+    @property
+    def frame_nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def _grow(self, capacity):
+        if self._mm is not None:
+            self._mm.flush()
+            del self._mm
+        with open(self.path, 'r+b') as f:
+            f.truncate(NPY_HEADER_SIZE + capacity * self.frame_nbytes)
+        self._mm = np.memmap(self.path, self.dtype, 'r+', offset=NPY_HEADER_SIZE,
+                             shape=(capacity,) + self.shape)
+        self._capacity = capacity
+
+    def write(self, array):
+        """Copy a frame into the next slot of the file"""
+        if array.shape != self.shape:
+            raise Error("Frame of shape {} doesn't match recording of shape {}".format(
+                array.shape, self.shape))
+        if self.n_written >= self._capacity:
+            self._grow(self._capacity + self._chunk)
+        self._mm[self.n_written] = array
+        self.n_written += 1
+
+    @property
+    def file_nbytes(self):
+        return NPY_HEADER_SIZE + self.n_written * self.frame_nbytes
+
+    def close(self):
+        """Flush the frames to disk and finalize the file's header"""
+        if self._mm is None:
+            return
+        self._mm.flush()
+        del self._mm
+        self._mm = None
+        with open(self.path, 'r+b') as f:
+            f.write(_npy_header(self.dtype, (self.n_written,) + self.shape))
+            f.truncate(NPY_HEADER_SIZE + self.n_written * self.frame_nbytes)
+
+
+def _meta_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def _float_list(array):
+    return [None if np.isnan(x) else x for x in array.tolist()]
+
+
+class FrameRecorder(object):
+    """Writes `Frame` objects to disk on a background thread.
+
+    Frames passed to `put()` go into a bounded `FrameQueue`, and a writer thread copies them into
+    an `NpyFrameWriter`, or with `compress`, compresses them into a `ChunkedFrameWriter`. If the
+    writer falls behind and the queue fills up, the oldest queued frame is dropped. Per-frame
+    metadata (sequence numbers, timestamps and hardware frame info), along with `metadata`, is
+    saved alongside the frames in a ``.json`` file of the same name, or for compressed
+    recordings, in the file's index.
+
+    Parameters
+    ----------
+    path : str
+        Path of the ``.npy`` (or compressed) file to write
+    capacity : int, optional
+        Number of frames to preallocate space for
+    maxlen : int, optional
+        Maximum number of frames waiting to be written
+    metadata : dict, optional
+        Extra JSON-serializable info to store in the metadata file
+    compress : bool, optional
+        Whether to write a chunked, compressed frame store instead of a ``.npy`` file
+    chunk_frames : int, optional
+        Number of frames per compressed chunk
+    compress_threads : int, optional
+        Number of threads compressing chunks
+    """
+    def __init__(self, path, capacity=None, maxlen=64, metadata=None, compress=False,
+                 chunk_frames=16, compress_threads=2):
+        self.path = path
+        self.capacity = capacity or 256
+        self.metadata = dict(metadata or {})
+        self.compress = compress
+        self.chunk_frames = chunk_frames
+        self.compress_threads = compress_threads
+        self.queue = FrameQueue(maxlen, 'drop_oldest')
+        self.n_camera_dropped = 0
+        self.error = None
+        self._writer = None
+        self._frame_info = np.empty(self.capacity, FRAME_INFO_DTYPE)
+        self._n_info = 0
+        self._write_time = 0.
+        self._thread = threading.Thread(target=self._run, name='FrameRecorder')
+        self._thread.daemon = True
+        self._t_start = time.time()
+        self._thread.start()
+
+    def put(self, frame):
+        """Queue a frame to be written"""
+        if self.error is not None:
+            raise self.error
+        self.n_camera_dropped += frame.dropped
+        self.queue.put(frame)
+
+    def _create_writer(self, array):
+        if self.compress:
+            return ChunkedFrameWriter(self.path, array.shape, array.dtype, self.chunk_frames,
+                                      n_threads=self.compress_threads)
+        return NpyFrameWriter(self.path, array.shape, array.dtype, self.capacity)
+
+    def _run(self):
+        try:
+            while True:
+                frame = self.queue.get()
+                if frame is None:
+                    break
+                t0 = time.time()
+                if self._writer is None:
+                    self._writer = self._create_writer(frame.array)
+                self._writer.write(frame.array)
+                self._write_time += time.time() - t0
+                self._add_info(frame)
+        except Exception as e:
+            log.exception("Error in frame writer thread")
+            self.error = e
+            self.queue.close()
+
+    def _add_info(self, frame):
+        if self._n_info == len(self._frame_info):
+            grown = np.empty(2 * len(self._frame_info), FRAME_INFO_DTYPE)
+            grown[:self._n_info] = self._frame_info
+            self._frame_info = grown
+        self._frame_info[self._n_info] = (
+            frame.seq,
+            np.nan if frame.timestamp is None else frame.timestamp,
+            -1 if frame.hw_seq is None else frame.hw_seq,
+            np.nan if frame.hw_timestamp is None else frame.hw_timestamp,
+        )
+        self._n_info += 1
+
+    def close(self):
+        """Write out the remaining queued frames, finalize the files and return the stats.
+
+        The stats dict holds the number of frames written, the number dropped because the writer
+        fell behind (``n_dropped``) or reported missing by the camera (``n_camera_dropped``), the
+        elapsed time, the sustained write throughput in MB/s of uncompressed frame data, and the
+        compression ratio (uncompressed frame bytes per byte of file).
+        """
+        self.queue.close()
+        self._thread.join()
+
+        writer = self._writer
+        info = self._frame_info[:self._n_info]
+        meta = dict(self.metadata)
+        meta.update({
+            'shape': None if writer is None else list(writer.shape),
+            'dtype': None if writer is None else writer.dtype.str,
+            'seq': info['seq'].tolist(),
+            'timestamps': _float_list(info['timestamp']),
+            'hw_seq': [None if i < 0 else i for i in info['hw_seq'].tolist()],
+            'hw_timestamps': _float_list(info['hw_timestamp']),
+        })
+
+        n_written = n_bytes = file_nbytes = 0
+        if writer is not None:
+            n_written = writer.n_written
+            n_bytes = n_written * writer.frame_nbytes
+            t0 = time.time()
+            # Includes flushing to disk, so count it as write time. A compressed file's index is
+            # written last, so it can include the stats.
+            if self.compress:
+                writer.flush()
+            else:
+                writer.close()
+            self._write_time += time.time() - t0
+            file_nbytes = writer.file_nbytes
+        elapsed = time.time() - self._t_start
+
+        stats = {
+            'n_frames': n_written,
+            'n_dropped': self.queue.n_dropped,
+            'n_camera_dropped': self.n_camera_dropped,
+            'elapsed_s': elapsed,
+            'frames_per_s': n_written / elapsed if elapsed else 0.,
+            'write_MB_per_s': n_bytes / self._write_time / 1e6 if self._write_time else 0.,
+            'compression_ratio': n_bytes / file_nbytes if file_nbytes else 0.,
+        }
+
+        meta['stats'] = stats
+        if self.compress and writer is not None:
+            writer.close(meta)
+        else:
+            # Without any frames, there's no frame file, but the metadata is still saved
+            with open(_meta_path(self.path), 'w') as f:
+                json.dump(meta, f)
+
+        if self.error is not None:
+            raise self.error
+        return stats
+
+
+def load_recording(path, mmap_mode='r'):
+    """Load a recording made by `Camera.record()`.
+
+    Returns the (n_frames, height, width) frame array, memory-mapped by default, along with the
+    metadata dict. For compressed recordings, the frames are returned as a `ChunkedFrameReader`,
+    which loads them lazily as they're indexed. Raises an Error if no frames were recorded.
+    """
+    if os.path.exists(path) and is_chunked_file(path):
+        frames = ChunkedFrameReader(path)
+        return frames, frames.metadata
+
+    with open(_meta_path(path)) as f:
+        meta = json.load(f)
+    if meta['shape'] is None:
+        raise Error("Recording '{}' has no frames".format(path))
+    frames = np.load(path, mmap_mode=mmap_mode)
+    return frames, meta
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Chunked, compressed on-disk frame store.
+
+File layout (all integers little-endian)::
+
+    magic       8 bytes, b'\x93IFRAMES'
+    index_pos   uint64, file offset of the index, or 0 if the file was never closed
+    header_len  uint32, followed by a JSON header with the shape, dtype and chunk size
+    chunks      each a b'CHNK' tag, uint32 frame count and uint32 byte count, followed by the
+                byte-shuffled, zlib-compressed frames
+    index       JSON with the offset, size and frame count of each chunk, plus the metadata
+
+Byte-shuffling groups the bytes of each pixel by significance (all the high bytes, then all the
+low bytes), which lets zlib compress the mostly-constant high bytes of 12- and 16-bit frames
+much better.
+"""
+from __future__ import division
+import json
+import zlib
+import struct
+import threading
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from ...errors import Error
+
+__all__ = ['ChunkedFrameWriter', 'ChunkedFrameReader', 'is_chunked_file']
+
+MAGIC = b'\x93IFRAMES'
+PREAMBLE = struct.Struct('<8sQI')
+CHUNK_HEADER = struct.Struct('<4sII')
+CHUNK_TAG = b'CHNK'
+
+
+def is_chunked_file(path):
+    """Whether the file at `path` is a chunked frame store"""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _shuffle(array, out):
+    """Copy the bytes of `array` into `out`, grouped by their significance within each item"""
+    itemsize = array.dtype.itemsize
+    out[...] = array.view(np.uint8).reshape((-1, itemsize)).T
+    return out
+
+
+def _compress(frames, buf, level):
+    """Byte-shuffle `frames` into the flat uint8 array `buf`, and compress the result"""
+    shuffled = buf[:frames.nbytes].reshape((frames.dtype.itemsize, -1))
+    _shuffle(frames, shuffled)
+    return zlib.compress(shuffled, level)
+
+
+def _unshuffle(data, dtype, shape):
+    itemsize = dtype.itemsize
+    shuffled = np.frombuffer(data, np.uint8).reshape((itemsize, -1))
+    return np.ascontiguousarray(shuffled.T).view(dtype).reshape(shape)
+
+
+class ChunkedFrameWriter(object):
+    """Writes frames into a chunked, compressed frame store.
+
+    Frames are collected into chunks of `chunk_frames` frames, each of which is byte-shuffled and
+    zlib-compressed as a unit. The chunk and shuffle buffers are preallocated, so writing doesn't
+    allocate per frame. An index of the chunks, along with any metadata, is appended when the
+    writer is closed. Read the file back with `ChunkedFrameReader`.
+
+    Compression is much slower than writing raw frames, but zlib releases the GIL, so with
+    `n_threads` > 1 chunks are compressed in parallel on a thread pool (while still being written
+    to the file in order).
+
+    Parameters
+    ----------
+    path : str
+        Path of the file to write
+    shape : tuple of int
+        (height, width) of the frames
+    dtype : numpy.dtype
+        Data type of the frames
+    chunk_frames : int, optional
+        Number of frames per compressed chunk. Larger chunks compress slightly better, but make
+        random access to single frames slower.
+    level : int, optional
+        zlib compression level, from 1 (fastest) to 9 (smallest)
+    n_threads : int, optional
+        Number of threads compressing chunks
+    """
+    def __init__(self, path, shape, dtype, chunk_frames=16, level=1, n_threads=1):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_frames = max(int(chunk_frames), 1)
+        self.level = level
+        self.n_threads = max(int(n_threads), 1)
+        self.n_written = 0
+        self.file_nbytes = 0
+        self._chunks = []
+
+        # One (chunk, shuffle) buffer pair is filled while the others are being compressed
+        n_buffers = self.n_threads + 1 if self.n_threads > 1 else 1
+        chunk_shape = (self.chunk_frames,) + self.shape
+        self._buffers = [(np.empty(chunk_shape, self.dtype),
+                          np.empty(int(np.prod(chunk_shape)) * self.dtype.itemsize, np.uint8))
+                         for _ in range(n_buffers)]
+        self._current = 0
+        self._n_buffered = 0
+        self._pending = deque()
+        self._pool = ThreadPool(self.n_threads) if self.n_threads > 1 else None
+
+        header = json.dumps({'shape': list(self.shape), 'dtype': self.dtype.str,
+                             'chunk_frames': self.chunk_frames}).encode('utf-8')
+        self._file = open(path, 'wb')
+        self._file.write(PREAMBLE.pack(MAGIC, 0, len(header)) + header)
+        self.file_nbytes = self._file.tell()
+
+    @property
+    def frame_nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def write(self, array):
+        """Add a frame, compressing and writing out the current chunk once it's full"""
+        if array.shape != self.shape:
+            raise Error("Frame of shape {} doesn't match recording of shape {}".format(
+                array.shape, self.shape))
+        self._buffers[self._current][0][self._n_buffered] = array
+        self._n_buffered += 1
+        self.n_written += 1
+        if self._n_buffered == self.chunk_frames:
+            self._submit()
+
+    def _submit(self):
+        """Compress the current chunk, or queue it up to be compressed by the thread pool"""
+        n = self._n_buffered
+        if not n:
+            return
+        frames, buf = self._buffers[self._current]
+        self._n_buffered = 0
+        if self._pool is None:
+            self._write_chunk(n, _compress(frames[:n], buf, self.level))
+            return
+
+        self._pending.append((n, self._pool.apply_async(_compress,
+                                                        (frames[:n], buf, self.level))))
+        self._current = (self._current + 1) % len(self._buffers)
+        while len(self._pending) >= len(self._buffers):  # Next buffer is still in use
+            self._write_pending()
+
+    def _write_pending(self):
+        n, result = self._pending.popleft()
+        self._write_chunk(n, result.get())
+
+    def flush(self):
+        """Compress and write out all buffered frames, including a partial last chunk"""
+        self._submit()
+        while self._pending:
+            self._write_pending()
+
+    def _write_chunk(self, n, data):
+        offset = self._file.tell()
+        self._file.write(CHUNK_HEADER.pack(CHUNK_TAG, n, len(data)))
+        self._file.write(data)
+        self._chunks.append((offset, len(data), n))
+        self.file_nbytes = self._file.tell()
+
+    def close(self, metadata=None):
+        """Write out the last partial chunk, then the index, including the `metadata` dict"""
+        if self._file is None:
+            return
+        try:
+            self.flush()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+        index_pos = self._file.tell()
+        index = {'chunks': self._chunks, 'metadata': metadata or {}}
+        self._file.write(json.dumps(index).encode('utf-8'))
+        self._file.seek(len(MAGIC))
+        self._file.write(struct.pack('<Q', index_pos))
+        self._file.seek(0, 2)
+        self.file_nbytes = self._file.tell()
+        self._file.close()
+        self._file = None
+
+
+class ChunkedFrameReader(object):
+    """Random-access, lazy reader of a chunked frame store.
+
+    Behaves like a read-only (n_frames, height, width) array: indexing with an int returns a
+    single frame, and with a slice or list of ints returns a stacked array of frames. A tuple key
+    like ``reader[0, 10:20]`` selects frames with its first item, and indexes within each of
+    them with the rest. Only the chunks holding the requested frames are read and decompressed,
+    and the most recently used ones are cached, so sequential access decompresses each chunk
+    once.
+
+    If the file was never closed properly (e.g. the recording process crashed), the frames in
+    its complete chunks are still readable, but the metadata is lost.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file to read
+    cache_chunks : int, optional
+        Number of decompressed chunks to keep in memory
+    """
+    def __init__(self, path, cache_chunks=2):
+        self.path = path
+        self.cache_chunks = max(int(cache_chunks), 1)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._file = open(path, 'rb')
+        try:
+            self._read_index()
+        except Exception:
+            self._file.close()
+            raise
+
+    def _read_index(self):
+        f = self._file
+        magic, index_pos, header_len = PREAMBLE.unpack(f.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise Error("{} is not a chunked frame store".format(self.path))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+        self.dtype = np.dtype(str(header['dtype']))
+        self.frame_shape = tuple(header['shape'])
+        self.chunk_frames = header['chunk_frames']
+
+        if index_pos:
+            f.seek(index_pos)
+            index = json.loads(f.read().decode('utf-8'))
+            self.chunks = [tuple(c) for c in index['chunks']]
+            self.metadata = index['metadata']
+        else:
+            self.chunks = self._scan_chunks(f.tell())
+            self.metadata = {}
+
+        self._chunk_starts = np.cumsum([0] + [n for _, _, n in self.chunks])
+
+    def _scan_chunks(self, pos):
+        """Find the complete chunks of an unclosed file by walking their headers"""
+        f = self._file
+        f.seek(0, 2)
+        end = f.tell()
+        chunks = []
+        while pos + CHUNK_HEADER.size <= end:
+            f.seek(pos)
+            tag, n, nbytes = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+            if tag != CHUNK_TAG or pos + CHUNK_HEADER.size + nbytes > end:
+                break
+            chunks.append((pos, nbytes, n))
+            pos += CHUNK_HEADER.size + nbytes
+        return chunks
+
+    def __len__(self):
+        return int(self._chunk_starts[-1])
+
+    @property
+    def shape(self):
+        return (len(self),) + self.frame_shape
+
+    def close(self):
+        self._file.close()
+        self._cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _chunk(self, i):
+        """Get the decompressed frames of chunk number `i`"""
+        with self._lock:
+            frames = self._cache.pop(i, None)
+            if frames is None:
+                offset, nbytes, n = self.chunks[i]
+                self._file.seek(offset + CHUNK_HEADER.size)
+                data = zlib.decompress(self._file.read(nbytes))
+                frames = _unshuffle(data, self.dtype, (n,) + self.frame_shape)
+                frames.flags.writeable = False
+            self._cache[i] = frames
+            while len(self._cache) > self.cache_chunks:
+                self._cache.popitem(last=False)
+            return frames
+
+    def _frame(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("Frame index {} out of range for {} frames".format(i, n))
+        chunk = int(np.searchsorted(self._chunk_starts, i, side='right')) - 1
+        return self._chunk(chunk)[i - self._chunk_starts[chunk]]
+
+    def __getitem__(self, key):
+        # With a tuple, the first item selects the frames and the rest index within each frame
+        sub_key = ()
+        if isinstance(key, tuple):
+            key, sub_key = (key[0], key[1:]) if key else (slice(None), ())
+
+        if isinstance(key, slice):
+            key = range(*key.indices(len(self)))
+        elif not np.isscalar(key):
+            key = np.asarray(key).ravel()
+        else:
+            return self._frame(int(key))[sub_key].copy()
+
+        sub_shape = np.broadcast_to(self.dtype.type(0), self.frame_shape)[sub_key].shape
+        out = np.empty((len(key),) + sub_shape, self.dtype)
+        for j, i in enumerate(key):
+            out[j] = self._frame(int(i))[sub_key]
+        return out
+
+    def __iter__(self):
+        for i in range(len(self.chunks)):
+            for frame in self._chunk(i):
+                yield frame.copy()
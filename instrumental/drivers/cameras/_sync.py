@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Synchronized acquisition from several cameras sharing a trigger.
+"""
+from __future__ import division
+from ..util import check_units, unit_mag
+from ...errors import Error, TimeoutError
+from ...log import get_logger
+
+log = get_logger(__name__)
+
+__all__ = ['CameraGroup', 'FrameBundle']
+
+
+class FrameBundle(object):
+    """A set of frames, one per camera of a `CameraGroup`, taken on the same trigger.
+
+    Attributes
+    ----------
+    frames : tuple of `Frame`
+        The frames, in the order of the group's cameras
+    seq : int
+        Sequence number of the bundle, counting from zero
+    """
+    __slots__ = ('frames', 'seq')
+
+    def __init__(self, frames, seq):
+        self.frames = tuple(frames)
+        self.seq = seq
+
+    @property
+    def arrays(self):
+        """Tuple of the frames' image arrays"""
+        return tuple(frame.array for frame in self.frames)
+
+    @property
+    def skew(self):
+        """Spread of the frames' host timestamps, in seconds"""
+        timestamps = [frame.timestamp for frame in self.frames]
+        return max(timestamps) - min(timestamps)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, i):
+        return self.frames[i]
+
+    def __repr__(self):
+        return '<FrameBundle seq={} n_frames={}>'.format(self.seq, len(self.frames))
+
+
+class _Aligner(object):
+    """Tracks one camera's stream, giving each of its frames a trigger index"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.head = None
+        self.index = None
+        self.n_missed = 0  # Frames lost by the camera or its queue so far
+        self.n_unmatched = 0
+
+    def advance(self, timeout):
+        try:
+            frame = self.stream.get(timeout)
+        except StopIteration:
+            raise Error("Camera stream stopped unexpectedly")
+        if self.head is not None:
+            # Gaps in the stream's sequence numbers are frames dropped from its queue
+            self.n_missed += frame.seq - self.head.seq - 1
+        self.n_missed += frame.dropped
+        self.head = frame
+        self.index = frame.seq + self.n_missed
+        return frame
+
+
+class CameraGroup(object):
+    """Acquires from several cameras in parallel and yields their frames in matched bundles.
+
+    The cameras should already be set up to take frames on a shared hardware trigger (e.g. via
+    their `set_trigger()` or `set_trigger_mode()` methods). `frames()` arms every camera by
+    starting a stream on it, so each camera is read out by its own acquisition thread, and then
+    pairs up their frames into `FrameBundle` objects. Live video keeps a hardware trigger mode
+    that's already set, so arming doesn't make the cameras run freely. Fire the trigger only once
+    every camera is armed, e.g. from `start_trigger`, so no camera misses the first triggers.
+
+    Frames are matched either by ``'seq'``, i.e. by counting triggers, which accounts for frames
+    that a camera's frame counter or queue reports as lost, or by ``'timestamp'``, i.e. by host
+    arrival time to within `tolerance`. A frame with no partner from every other camera is
+    discarded, logged and counted in `n_unmatched`::
+
+        >>> group = CameraGroup([cam1, cam2])
+        >>> for bundle in group.frames(n=100, timeout='5s'):
+        ...     left, right = bundle.arrays
+        >>> print(group.n_unmatched)
+
+    Parameters
+    ----------
+    cameras : list of `Camera`
+        The cameras to acquire from
+    match : str, optional
+        How frames are matched: ``'seq'`` or ``'timestamp'``
+    tolerance : Quantity([time]), optional
+        Maximum spread of the host timestamps of a bundle when matching by ``'timestamp'``
+    maxlen : int, optional
+        Maximum number of frames queued per camera
+    """
+    @unit_mag(tolerance='s')
+    def __init__(self, cameras, match='seq', tolerance='5ms', maxlen=64):
+        if match not in ('seq', 'timestamp'):
+            raise ValueError("match must be 'seq' or 'timestamp'")
+        if len(cameras) < 2:
+            raise Error("A camera group needs at least two cameras")
+        self.cameras = list(cameras)
+        self.match = match
+        self.tolerance = tolerance
+        self.maxlen = maxlen
+        self._aligners = None
+
+    @property
+    def n_unmatched(self):
+        """Number of frames discarded per camera because no matching frames were found"""
+        if self._aligners is None:
+            return [0] * len(self.cameras)
+        return [a.n_unmatched for a in self._aligners]
+
+    def _start(self, kwds):
+        streams = []
+        try:
+            for cam in self.cameras:
+                streams.append(cam.start_stream(self.maxlen, **kwds))
+        except Exception:
+            for cam in self.cameras[:len(streams)]:
+                cam.stop_stream()
+            raise
+        self._aligners = [_Aligner(stream) for stream in streams]
+
+    def _stop(self):
+        for cam in self.cameras:
+            try:
+                cam.stop_stream()
+            except Exception:
+                log.exception("Error while stopping stream of %s", cam)
+
+    def _discard(self, i, reason):
+        aligner = self._aligners[i]
+        aligner.n_unmatched += 1
+        log.warning("Discarding frame %d of camera %d: %s", aligner.head.seq, i, reason)
+
+    def _next_bundle(self, timeout):
+        aligners = self._aligners
+        for a in aligners:
+            if a.head is None:
+                a.advance(timeout)
+
+        while True:
+            if self.match == 'seq':
+                target = max(a.index for a in aligners)
+                behind = [i for i, a in enumerate(aligners) if a.index < target]
+                reason = 'no matching frame from the other cameras'
+            else:
+                target = max(a.head.timestamp for a in aligners)
+                behind = [i for i, a in enumerate(aligners)
+                          if a.head.timestamp < target - self.tolerance]
+                reason = 'no frames from the other cameras within the tolerance'
+
+            if not behind:
+                frames = [a.head for a in aligners]
+                for a in aligners:
+                    a.head = None
+                return frames
+
+            for i in behind:
+                self._discard(i, reason)
+                aligners[i].advance(timeout)
+
+    @check_units(timeout='?s')
+    def frames(self, n=None, timeout='1s', start_trigger=None, **kwds):
+        """Iterate over bundles of matched frames.
+
+        All cameras are armed when iteration begins, and disarmed when it ends (including when
+        breaking out of the loop early).
+
+        Parameters
+        ----------
+        n : int, optional
+            Number of bundles to yield. If None (the default), iterate until the loop is exited.
+        timeout : Quantity([time]), optional
+            Maximum time to wait for each camera's next frame before raising a TimeoutError. If
+            None, wait forever.
+        start_trigger : callable, optional
+            Called with no arguments once every camera is armed, e.g. to start the trigger source
+
+        The remaining kwds are passed to each camera's `start_stream()`.
+        """
+        self._start(kwds)
+        try:
+            if start_trigger is not None:
+                start_trigger()
+
+            seq = 0
+            while n is None or seq < n:
+                try:
+                    frames = self._next_bundle(timeout)
+                except TimeoutError:
+                    raise TimeoutError("Timed out while waiting for frame bundle {}".format(seq))
+                yield FrameBundle(frames, seq)
+                seq += 1
+        finally:
+            self._stop()
@@ -9,7 +9,8 @@ import os
 import os.path
 import tempfile
 from enum import Enum
-from time import clock
+from time import clock, mktime
+from datetime import datetime
 
 import numpy as np
 from cffi import FFI, cparser
@@ -17,6 +18,7 @@ from pycparser import CParser
 from nicelib import NiceLib, Sig, NiceObject, RetHandler
 
 from . import Camera
+from ._frames import CapturedImages
 from ..util import as_enum, unit_mag, check_units
 from .. import ParamSet
 from ...errors import Error, TimeoutError
@@ -64,6 +66,25 @@ lib = ffi.dlopen('SC2_Cam.dll')
 winlib = ffi.dlopen('Kernel32.dll')
 
 
+def _decode_bcd_timestamp(pixels, shift=0):
+    """Decode the binary timestamp written into the first 14 pixels of an image
+
+    Each pixel holds two BCD digits in its low byte, after shifting it right by `shift` bits.
+    Returns the camera's image counter and its timestamp in seconds since the epoch.
+    """
+    vals = [(int(p) >> shift) & 0xFF for p in pixels[:14]]
+    digits = [(v >> 4) * 10 + (v & 0x0F) for v in vals]
+
+    counter = digits[0]*1000000 + digits[1]*10000 + digits[2]*100 + digits[3]
+    year = digits[4]*100 + digits[5]
+    microseconds = digits[11]*10000 + digits[12]*100 + digits[13]
+    try:
+        dt = datetime(year, digits[6], digits[7], digits[8], digits[9], digits[10])
+    except ValueError:
+        return counter, None  # Timestamp is garbled, e.g. because the mode was just switched on
+    return counter, mktime(dt.timetuple()) + microseconds * 1e-6
+
+
 def get_error_text(ret_code):
     from ._pixelfly import errortext  # Hide from Sphinx
     pbuf = errortext.ffi.new('char[]', 1024)
@@ -138,6 +159,9 @@ class NicePCO(NiceLib):
         GetIRSensitivity = Sig('in', 'out')
         SetIRSensitivity = Sig('in', 'in')
         SetTransferParametersAuto = Sig('in', 'ignore', 'ignore')
+        GetTimestampMode = Sig('in', 'out')
+        SetTimestampMode = Sig('in', 'in')
+        GetBitAlignment = Sig('in', 'out')
 
         def GetTransferParameter(self):
             hcam, = self._handles
@@ -165,10 +189,14 @@ class PCO_Camera(Camera):
     def _initialize(self):
         self.buffers = []
         self.queue = []
+        self.last_buffer = None
+        self.n_underruns = 0
         self._partial_sequence = []
         self._buf_size = 0
         self.shutter = None
         self._trig_mode = self.TriggerMode.software
+        self._hw_timestamps = False
+        self._frame_info = (None, None)
 
         self._open(self._paramset.get('cam_num', 0))
         self._paramset['interface'] = self.interface_type
@@ -250,6 +278,29 @@ class PCO_Camera(Camera):
         self._free_buffers()
         self._cam.CloseCamera()
 
+    def set_hw_timestamps(self, enable=True):
+        """Enable or disable the camera's binary image timestamps.
+
+        When enabled, the camera overwrites the first 14 pixels of each image with its image
+        counter and the capture time, which are then reported as the ``hw_seq`` and
+        ``hw_timestamp`` of each frame yielded by `frames()`. Takes effect the next time
+        acquisition is started.
+        """
+        self._cam.SetTimestampMode(1 if enable else 0)
+        self._hw_timestamps = enable
+        self._frame_info = (None, None)
+        if enable:
+            self._ts_shift = self._timestamp_shift()
+
+    def _timestamp_shift(self):
+        """Number of bits the timestamp BCD digits are shifted by within each pixel"""
+        if self._cam.GetBitAlignment() == 0:  # MSB-aligned
+            return 16 - self._get_camera_description().wDynResDESC
+        return 0
+
+    def _latest_frame_info(self):
+        return self._frame_info
+
     def _enable_soft_roi(self, enable):
         self._cam.EnableSoftROI(enable, ffi.NULL, 0)
 
@@ -477,15 +528,18 @@ class PCO_Camera(Camera):
         self._clear_queue()
 
     @check_units(timeout='?ms')
-    def get_captured_image(self, timeout='1s', copy=True, wait_for_all=True, **kwds):
-        self._handle_kwds(kwds)
+    def get_captured_image(self, timeout='1s', copy=True, wait_for_all=True, stack=False,
+                           out=None, **kwds):
+        self._handle_kwds(kwds, fill_coords=False)
         width, height, _, _ = self._get_sizes()
         frame_size = self._frame_size()
-        image_arrs = []
 
         if not self.queue:
             raise Error("No capture initiated. You must first call start_capture()")
 
+        images = CapturedImages(self, len(self.queue), copy, stack, self._partial_sequence, out)
+        n_old = len(images)
+
         start_time = clock() * u.s
         # Can't loop directly through queue since wait_for_frame modifies it
         while self.queue:
@@ -497,51 +551,65 @@ class PCO_Camera(Camera):
                 frame_ready = self.wait_for_frame(timeout - elapsed_time)
 
             if not frame_ready:
-                if wait_for_all or not image_arrs:
-                    self._partial_sequence.extend(image_arrs)  # Save for later
+                if wait_for_all or len(images) == n_old:
+                    self._partial_sequence = images.images  # Save for later
                     raise TimeoutError
                 else:
                     break
 
-            if copy:
-                image_buf = memoryview(ffi.buffer(buf.address, frame_size)[:])
-            else:
-                image_buf = memoryview(ffi.buffer(buf.address, frame_size))
+            image_buf = memoryview(ffi.buffer(buf.address, frame_size))
 
             # Convert to array (currently assumes mono16)
             array = np.frombuffer(image_buf, np.uint16)
             array = array.reshape((height, width))
 
+            owned = False
             if kwds['fix_hotpixels']:
                 array = self._correct_hot_pixels(array)
+                owned = True
 
-            # Handle soft ROI
+            # Handle soft ROI, copying only the region we keep
             left, top = self._roi_trim_left, self._roi_trim_top
             array = array[top:top + self._soft_height, left:left + self._soft_width]
-
-            image_arrs.append(array)
-        image_arrs = self._partial_sequence + image_arrs
+            images.add(array, owned)
+        self._partial_sequence = []
 
         if not self.queue:
             # Stop recording and clean up queue
             self._cam.SetRecordingState(0)
             self._clear_queue()
-            self._partial_sequence = []
 
-        if len(image_arrs) == 1:
-            return image_arrs[0]
-        else:
-            return tuple(image_arrs)
+        return images.result()
 
-    def grab_image(self, timeout='1s', copy=True, **kwds):
+    def grab_image(self, timeout='1s', copy=True, stack=False, out=None, **kwds):
         self.start_capture(**kwds)
-        return self.get_captured_image(timeout=timeout, copy=copy, **kwds)
+        return self.get_captured_image(timeout=timeout, copy=copy, stack=stack, out=out, **kwds)
 
     @check_units(framerate='Hz')
-    def start_live_video(self, framerate='10Hz', **kwds):
+    def start_live_video(self, framerate='10Hz', n_buffers=4, **kwds):
+        """Start live video mode.
+
+        An external trigger mode, set via `set_trigger_mode()` or the `trig` kwd, is kept, so each
+        frame is taken on a hardware trigger. Otherwise the camera runs freely.
+
+        The camera fills a queue of `n_buffers` buffers in turn. Each buffer is handed back to
+        the camera on the call to `wait_for_frame()` after the one that returned it, so a frame
+        can't be overwritten while it is being read with `latest_frame()`. A deeper queue lets
+        the camera keep running while the consumer is stalled for several frame periods. See
+        `n_buffers_pending`, `n_buffers_free` and `n_underruns` to monitor the queue.
+
+        See `grab_image()` for the set of available kwds.
+        """
+        if n_buffers < 2:
+            raise Error("Live video needs at least two buffers")
+        trig_given = 'trig' in kwds
         self._handle_kwds(kwds)
 
-        self.set_trigger_mode(self.TriggerMode.auto)
+        external = (self.TriggerMode.extern_edge, self.TriggerMode.extern_pulse)
+        if trig_given:
+            self.set_trigger_mode(kwds['trig'], kwds['rising'])
+        if self._trig_mode not in external:
+            self.set_trigger_mode(self.TriggerMode.auto)
         self._set_binning(kwds['vbin'], kwds['hbin'])
         self._set_ROI(kwds['left'], kwds['top'], kwds['right'], kwds['bot'])
         self._cam.ArmCamera()
@@ -554,16 +622,19 @@ class PCO_Camera(Camera):
         self._cam.CamLinkSetImageParameters(width, height)
 
         self.shutter = 'continuous'
-        if self._frame_size() != self._buf_size or len(self.buffers) < 2:
-            self._allocate_buffers(nbufs=2)
+        if self._frame_size() != self._buf_size or len(self.buffers) != n_buffers:
+            self._allocate_buffers(nbufs=n_buffers)
         self._cam.ArmCamera()
+        self.last_buffer = None
+        self.n_underruns = 0
 
         # Add all the buffers to the queue
         for buf in self.buffers:
             self._push_on_queue(buf)
 
         self._cam.SetRecordingState(1)
-        self._cam.ForceTrigger()
+        if self._trig_mode not in external:
+            self._cam.ForceTrigger()
 
     def stop_live_video(self):
         self._cam.SetRecordingState(0)
@@ -591,27 +662,47 @@ class PCO_Camera(Camera):
         else:
             raise Error("Failed to grab image")
 
-        self.last_buffer = self.queue.pop(0)  # Pop and save only on success
-
         if self.shutter == 'continuous':
-            self._push_on_queue(buf)  # Add buf back to the end of the queue
+            if len(self.queue) > 1 and self._buffer_filled(self.queue[-1]):
+                # Every queued buffer is full, so the camera has nowhere to put the next frame
+                self.n_underruns += 1
+                log.warning("Live video buffer underrun; consider using more buffers")
+            if self.last_buffer is not None:
+                # The previous frame has been read by now, so its buffer can be refilled
+                self._push_on_queue(self.last_buffer)
 
+        self.last_buffer = self.queue.pop(0)  # Pop and save only on success
         return True
 
-    def latest_frame(self, copy=True):
+    def _buffer_filled(self, buf):
+        return winlib.WaitForSingleObject(buf.event, 0) == winlib.WAIT_OBJECT_0
+
+    @property
+    def n_buffers_pending(self):
+        """Number of frames the camera has filled buffers with, but which haven't been returned
+        by `wait_for_frame()` yet"""
+        return sum(1 for buf in self.queue if self._buffer_filled(buf))
+
+    @property
+    def n_buffers_free(self):
+        """Number of queued buffers that are still available for the camera to fill"""
+        return len(self.queue) - self.n_buffers_pending
+
+    def latest_frame(self, copy=True, out=None):
         buf_info = self.last_buffer
-        if copy:
-            buf = memoryview(ffi.buffer(buf_info.address, self._frame_size())[:])
-        else:
-            buf = memoryview(ffi.buffer(buf_info.address, self._frame_size()))
+        buf = memoryview(ffi.buffer(buf_info.address, self._frame_size()))
 
         width, height, _, _ = self._get_sizes()
         array = np.frombuffer(buf, np.uint16)
         array = array.reshape((height, width))
 
-        # Handle soft ROI
+        if self._hw_timestamps:
+            self._frame_info = _decode_bcd_timestamp(array[0], self._ts_shift)
+
+        # Handle soft ROI, copying only the region we keep
         left, top = self._roi_trim_left, self._roi_trim_top
-        return array[top:top + self._soft_height, left:left + self._soft_width]
+        array = array[top:top + self._soft_height, left:left + self._soft_width]
+        return self._output_frame(array, copy, out)
 
     def _color_mode(self):
         desc = self._get_camera_description()
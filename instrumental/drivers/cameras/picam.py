@@ -14,14 +14,21 @@ Note that the .dlls found first on the system path must match the version
 of the headers installed with the Picam SDK.
 """
 
+import time
+import threading
 from warnings import warn
-from numpy import frombuffer, sum, uint16, hstack, vstack
+from numpy import frombuffer, uint16, copyto, zeros
 from enum import Enum
 from nicelib import NiceLib, NiceObjectDef, load_lib
-from ...errors import Error, InstrumentNotFoundError
-from ..util import check_units, check_enums
+from ...errors import Error, InstrumentNotFoundError, TimeoutError
+from ...log import get_logger
+from ..util import check_units, check_enums, unit_mag
+from ._frames import Frame, FrameQueue, check_out_array
+from ._recording import FrameRecorder
 from ... import Q_
 
+log = get_logger(__name__)
+
 
 class PicamError(Error):
     pass
@@ -260,6 +267,149 @@ class PicamAcquisitionError(PicamError):
         else:
             return "An unkown error with code {}".format(self.value)
 
+class PicamStream(object):
+    """Continuous acquisition whose readouts are drained by a background thread.
+
+    Created via ``PicamCamera.start_stream()``. The thread waits for
+    acquisition updates and copies each readout out of the SDK's memory as
+    soon as it is available, so the SDK's buffer doesn't overflow while the
+    consumer is busy. Readouts are pushed onto a bounded ``FrameQueue`` as
+    ``Frame`` objects, whose ``array`` holds the readout (or a list of arrays,
+    one per region of interest), and are optionally recorded to disk.
+
+    The per-pixel running total of all readouts is updated as each batch
+    arrives, so ``total`` and ``mean`` are available at any time without
+    keeping the readouts around.
+
+    Iterating over the stream yields the queued readouts until the
+    acquisition ends or the stream is stopped::
+
+        >>> stream = cam.start_stream(maxlen=1000)
+        >>> for frame in stream:
+        ...     process(frame.array)
+        >>> stream.stop()
+    """
+    POLL_INTERVAL = '100ms'  # How often the thread checks whether it should stop
+
+    def __init__(self, camera, maxlen=256, policy='drop_oldest', path=None):
+        if path is not None and len(camera.frame_shapes) != 1:
+            raise PicamError("Can only record a single region of interest to disk")
+        self.camera = camera
+        self.queue = FrameQueue(maxlen, policy)
+        self.recorder = None if path is None else FrameRecorder(path, maxlen=maxlen)
+        self.n_readouts = 0
+        self.error = None
+        self._totals = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='PicamStream')
+        self._thread.daemon = True
+
+    @property
+    def n_dropped(self):
+        """Number of readouts discarded because the queue was full"""
+        return self.queue.n_dropped
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def start(self):
+        self.camera.start_acquisition()
+        self._thread.start()
+
+    def _run(self):
+        cam = self.camera
+        try:
+            running = True
+            while running and not self._stop_event.is_set():
+                available, status = cam.wait_for_aqcuisition_update(self.POLL_INTERVAL)
+                running = bool(status.running)
+                if available.readout_count:
+                    self._drain(available)
+        except Exception as e:
+            log.exception("Error in Picam acquisition thread")
+            self.error = e
+        finally:
+            if cam.is_aqcuisition_running():
+                cam.stop_acquisition()
+            self.queue.close()
+
+    def _drain(self, available):
+        views = self.camera._roi_views(available)
+        count = available.readout_count
+        timestamp = time.time()
+
+        with self._lock:
+            if self._totals is None:
+                self._totals = [zeros(v.shape[1:]) for v in views]
+            for total, v in zip(self._totals, views):
+                total += v.sum(axis=0, dtype=float)
+            first_seq = self.n_readouts
+            self.n_readouts += count
+
+        for i in range(count):
+            readout = [v[i].copy() for v in views]
+            frame = Frame(self._result(readout), first_seq + i, timestamp)
+            if self.recorder is not None:
+                self.recorder.put(frame)
+            self.queue.put(frame)
+
+    def _result(self, arrays):
+        return arrays[0] if len(arrays) == 1 else arrays
+
+    @property
+    def total(self):
+        """Per-pixel sum of all readouts so far (a list of arrays if there are
+        multiple regions of interest), or None before the first readout"""
+        with self._lock:
+            if self._totals is None:
+                return None
+            return self._result([t.copy() for t in self._totals])
+
+    @property
+    def mean(self):
+        """Per-pixel mean of all readouts so far, or None before the first
+        readout"""
+        with self._lock:
+            if self._totals is None:
+                return None
+            return self._result([t / self.n_readouts for t in self._totals])
+
+    def stop(self):
+        """Stop the acquisition and the thread. Readouts still in the queue
+        can still be read. If recording, returns the recorder's stats."""
+        self._stop_event.set()
+        self.queue.close()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        if self.recorder is not None:
+            return self.recorder.close()
+
+    @unit_mag(timeout='?s')
+    def get(self, timeout=None):
+        """Get the next readout from the queue as a ``Frame``.
+
+        Raises a TimeoutError if none arrives within ``timeout``, and raises
+        StopIteration once the acquisition has ended and the queue is empty.
+        """
+        frame = self.queue.get(timeout)
+        if frame is None:
+            if self.error is not None:
+                raise self.error
+            if self.queue.closed:
+                raise StopIteration
+            raise TimeoutError("Timed out while waiting for the next readout")
+        return frame
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except StopIteration:
+                return
+
+
 class PicamCamera():
     """ A Picam Camera """
     def __init__(self, name, handle, NicePicam, ffi, NicePicamLib, picam):
@@ -282,8 +432,12 @@ class PicamCamera():
             self.picam.destroy_rois(self.rois)
         self.rois = self._get_rois()
         self.frame_shapes = self.get_frame_shapes()
+        self._update_readout_stride()
+
+    def _update_readout_stride(self):
+        """Cache the readout stride, which changes with the ROIs, metadata and other parameters"""
         self.readout_stride = self._get_readout_stride()
-        self.n_pixels_per_readout = self.readout_stride/BYTES_PER_PIXEL
+        self.n_pixels_per_readout = self.readout_stride // BYTES_PER_PIXEL
 
     def _set_rois(self, rois, canset=False):
         """ Set the region of interest structure. """
@@ -496,14 +650,14 @@ class PicamCamera():
         uncommitted, N = self._NicePicam.CommitParameters()
         if N != 0:
             raise PicamError("{} parameters were unsuccessfully committed.")
+        self._update_readout_stride()
 
     def _c_address_to_numpy(self, address, size, data_type=float):
         """ Creates a numpy array from a c array at ``address`` with bytesize
         ``size`` """
         ffi = self._NicePicamLib._ffi
         # This copies the buffer
-        buf = buffer(ffi.buffer(address, size)[:])
-        return frombuffer(buf, data_type)
+        return frombuffer(ffi.buffer(address, size)[:], data_type)
 
     def get_frame_shapes(self, rois=None):
         """Returns the region of interest frame shapes as a list of tuples
@@ -517,8 +671,8 @@ class PicamCamera():
         shapes = []
         for i in range(rois.roi_count):
             roi = rois.roi_array[i]
-            x = roi.width/roi.x_binning
-            y = roi.height/roi.y_binning
+            x = roi.width // roi.x_binning
+            y = roi.height // roi.y_binning
             shapes = shapes + [(x, y)]
         return shapes
 
@@ -528,6 +682,7 @@ class PicamCamera():
         The number of readouts is controlled by ``set_readout_count``.
         """
         self._NicePicam.StartAcquisition()
+        self._update_readout_stride()  # Starting commits any changed parameters
 
     def stop_acquisition(self):
         """Stops a currently running acuisition"""
@@ -545,46 +700,124 @@ class PicamCamera():
             raise PicamAcquisitionError(status.errors)
         return available, status
 
-    def get_data_from_available(self, available_data, average=False):
-        """Returns an array of data corresponding to the data buffer given
-        by the PicamAvailableData structure
+    def _roi_views(self, available_data):
+        """Returns a list of arrays of shape (readout_count, y, x), one per
+        region of interest, that directly reference the readouts given by the
+        PicamAvailableData structure ``available_data``
+
+        Each is a single strided view of the readout memory, which the SDK
+        reuses once the readouts have been retrieved.
         """
         count = available_data.readout_count
         if count == 0:
             raise PicamError('There are no readouts in available_data')
-        readout_stride = self._get_readout_stride()
-        size = readout_stride * available_data.readout_count
-        data = self._c_address_to_numpy(available_data.initial_readout,
-                                        size, uint16)
-        data_list = []
+        ffi = self._NicePicamLib._ffi
+        size = self.readout_stride * count
+        data = frombuffer(ffi.buffer(available_data.initial_readout, size), uint16)
+        readouts = data.reshape((count, self.n_pixels_per_readout))
+
+        views = []
         index_start = 0
-        # loop over each roi
         for shape in self.frame_shapes:
-            n_roi_pixels = shape[0]*shape[1]
-            index_end = n_roi_pixels + index_start
-            roi_data = data[index_start:index_end]
-            # loop over each readout
-            for i in range(1, count):
-                index_1 = index_start + i * self.n_pixels_per_readout
-                index_2 = index_end + i * self.n_pixels_per_readout
-                temp = data[index_1:index_2]
-                roi_data = vstack([roi_data, temp])
-            roi_data = roi_data.reshape((count,) + shape[::-1])
-
-            if count==1:
-                roi_data = roi_data[0,:,:]
+            index_end = index_start + shape[0]*shape[1]
+            roi_data = readouts[:, index_start:index_end]
+            views.append(roi_data.reshape((count,) + shape[::-1]))
+            index_start = index_end
+        return views
+
+    def get_data_from_available(self, available_data, average=False, copy=True, out=None):
+        """Returns an array of data corresponding to the data buffer given
+        by the PicamAvailableData structure
+
+        The array has shape (readout_count, y, x), or (y, x) for a single
+        readout. If there are multiple regions of interest, a list with one
+        array per region is returned. If ``average`` is True, the readouts are
+        averaged together into a single float (y, x) array.
+
+        If ``copy`` is False, the arrays directly reference the SDK's readout
+        memory, which is only valid until the next readouts are retrieved. To
+        avoid allocating, pass ``out``, an array (or list of arrays, one per
+        region) of matching shape and uint16 dtype, which the data is copied
+        into.
+        """
+        count = available_data.readout_count
+        views = self._roi_views(available_data)
+        if out is not None and not isinstance(out, (list, tuple)):
+            out = [out]
+        if out is not None and len(out) != len(views):
+            raise PicamError('Need one output array per region of interest')
+
+        data_list = []
+        for i, roi_data in enumerate(views):
+            if count == 1:
+                roi_data = roi_data[0]
 
             if average:
-                roi_data = sum(roi_data, 2)/float(count)
+                roi_data = roi_data.mean(axis=0) if count > 1 else roi_data.astype(float)
+            elif out is not None:
+                check_out_array(out[i], roi_data.shape, roi_data.dtype)
+                copyto(out[i], roi_data)
+                roi_data = out[i]
+            elif copy:
+                roi_data = roi_data.copy()
 
             data_list.append(roi_data)
-            index_start = index_end
 
         if len(self.frame_shapes) == 1:
             return data_list[0]
         else:
             return data_list
 
+    @check_units(timeout='ms')
+    def readouts(self, timeout='-1ms', copy=True):
+        """Starts an acquisition and yields each readout as it arrives.
+
+        The acquisition runs for the number of readouts set by
+        ``set_readout_count``, or indefinitely if that is zero. Readouts are
+        yielded as soon as ``WaitForAcquisitionUpdate`` delivers them, in the
+        format of ``get_data_from_available`` for a single readout. The
+        acquisition is stopped if the generator is closed early.
+
+        If ``copy`` is False, each readout references the SDK's memory and is
+        only valid until the next one is yielded.
+        """
+        self.start_acquisition()
+        try:
+            running = True
+            while running:
+                available, status = self.wait_for_aqcuisition_update(timeout)
+                running = bool(status.running)
+                if available.readout_count == 0:
+                    continue
+
+                views = self._roi_views(available)
+                for i in range(available.readout_count):
+                    readout = [v[i].copy() if copy else v[i] for v in views]
+                    yield readout[0] if len(readout) == 1 else readout
+        finally:
+            if self.is_aqcuisition_running():
+                self.stop_acquisition()
+
+    def start_stream(self, maxlen=256, policy='drop_oldest', path=None):
+        """Starts a continuous acquisition drained by a background thread.
+
+        The number of readouts is controlled by ``set_readout_count``; zero
+        means acquire until stopped. Returns a ``PicamStream``.
+
+        Parameters
+        ----------
+        maxlen : int, optional
+            Maximum number of readouts to hold in the stream's queue
+        policy : str, optional
+            What to do when the queue is full, either 'drop_oldest' or 'block'
+        path : str, optional
+            If given, every readout is also recorded to this ``.npy`` file
+            (see ``load_recording``). Requires a single region of interest.
+        """
+        stream = PicamStream(self, maxlen, policy, path)
+        stream.start()
+        return stream
+
     @check_units(timeout = 'ms')
     def get_data(self, count=1, timeout='-1ms', average=False):
         """Returns a numpy array of the pixel data for the specified camera.
@@ -594,6 +827,7 @@ class PicamCamera():
                                                         timeout.to('ms').m)
         if error != 0:
             raise PicamAcquisitionError()
+        self._update_readout_stride()
         return self.get_data_from_available(available_data, average)
 
     def get_readout_rate(self, default=False):
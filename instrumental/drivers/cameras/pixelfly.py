@@ -14,11 +14,15 @@ import win32event
 from nicelib import NiceLib, Sig, NiceObject, load_lib, RetHandler
 
 from . import Camera
+from ._frames import CapturedImages
 from .. import ParamSet
 from ..util import check_units
 from ...errors import Error, TimeoutError, LibError
+from ...log import get_logger
 from ... import Q_, u
 
+log = get_logger(__name__)
+
 if PY2:
     memoryview = buffer  # Needed b/c np.frombuffer is broken on memoryviews in PY2
 
@@ -134,6 +138,10 @@ class Pixelfly(Camera):
         self._buf_events = []
         self._nbufs = 0
         self._buf_i = 0
+        self._live_nbufs = 4
+        self._n_queued = 0
+        self._held_buf = None  # Buffer of the latest live frame, re-queued once it's been read
+        self.n_underruns = 0
 
         self._double_img = None  # Used for latest_frame
 
@@ -237,9 +245,23 @@ class Pixelfly(Camera):
         self._allocate_buffers()
         self.color_mode = 'mono16'
 
-    def start_live_video(self, **kwds):
+    def start_live_video(self, n_buffers=4, **kwds):
+        """Start live video mode.
+
+        The camera fills a queue of `n_buffers` buffers in turn. Each buffer is handed back to
+        the camera on the call to `wait_for_frame()` after the one that returned it, so a frame
+        can't be overwritten while it is being read with `latest_frame()`. A deeper queue lets
+        the camera keep running while the consumer is stalled for several frame periods. See
+        `n_buffers_pending`, `n_buffers_free` and `n_underruns` to monitor the queue.
+
+        See `grab_image()` for the set of available kwds.
+        """
+        if n_buffers < 2:
+            raise Error("Live video needs at least two buffers")
         self._handle_kwds(kwds)
         self._last_kwds = kwds
+        self._live_nbufs = n_buffers
+        self.n_underruns = 0
 
         #self.set_mode('video')
         self.set_mode(exposure=kwds['exposure_time'], hbin=kwds['hbin'], vbin=kwds['vbin'],
@@ -278,12 +300,39 @@ class Pixelfly(Camera):
             raise Exception("Buffer error 0x{:08X} 0x{:08X} 0x{:08X} 0x{:08X}".format(
                             uptr[0], uptr[1], uptr[2], uptr[3]))
 
+        self._n_queued -= 1
         if self._shutter == 'video':
-            self._dev.ADD_BUFFER_TO_LIST(self._bufnums[self._buf_i], self._frame_size(), 0, 0)
+            last_queued = (buf_i + self._n_queued) % self._nbufs
+            if self._n_queued and self._buffer_filled(last_queued):
+                # Every queued buffer is full, so the camera has nowhere to put the next frame
+                self.n_underruns += 1
+                log.warning("Live video buffer underrun; consider using more buffers")
+            if self._held_buf is not None:
+                # The previous frame has been read by now, so its buffer can be refilled
+                self._dev.ADD_BUFFER_TO_LIST(self._bufnums[self._held_buf], self._frame_size(),
+                                             0, 0)
+                self._n_queued += 1
+            self._held_buf = buf_i
         self._buf_i = (self._buf_i + 1) % self._nbufs
 
         return True
 
+    def _buffer_filled(self, buf_i):
+        ret = win32event.WaitForSingleObject(int(self._buf_events[buf_i]), 0)
+        return ret == win32event.WAIT_OBJECT_0
+
+    @property
+    def n_buffers_pending(self):
+        """Number of frames the camera has filled buffers with, but which haven't been returned
+        by `wait_for_frame()` yet"""
+        queued = [(self._buf_i + i) % self._nbufs for i in range(self._n_queued)]
+        return sum(1 for buf_i in queued if self._buffer_filled(buf_i))
+
+    @property
+    def n_buffers_free(self):
+        """Number of queued buffers that are still available for the camera to fill"""
+        return self._n_queued - self.n_buffers_pending
+
     def _frame_size(self):
         nimgs = 2 if self._shutter == 'double' else 1
         nbytes = ((self.bit_depth+7)//8)
@@ -291,10 +340,10 @@ class Pixelfly(Camera):
 
     def _allocate_buffers(self, nbufs=None):
         if nbufs is None:
-            if self._nbufs > 1:
+            if self._shutter == 'video':
+                nbufs = self._live_nbufs
+            elif self._nbufs > 1:
                 nbufs = self._nbufs
-            elif self._shutter == 'video':
-                nbufs = 2
             else:
                 nbufs = 1
 
@@ -334,28 +383,29 @@ class Pixelfly(Camera):
         for i in range(self._nbufs):
             self._dev.ADD_BUFFER_TO_LIST(self._bufnums[i], frame_size, 0, 0)
         self._buf_i = 0
+        self._n_queued = self._nbufs
+        self._held_buf = None
         self._capture_started = True
 
         self._dev.TRIGGER_CAMERA()
 
-    def latest_frame(self, copy=True):
+    def latest_frame(self, copy=True, out=None):
         if self._double_img is not None:
             img = self._double_img
             self._double_img = None
-            return self._crop_roi(img)
+            return self._output_frame(img, copy=False, out=out)
 
         buf_i = (self._buf_i - 1) % self._nbufs
-        if copy:
-            buf = memoryview(ffi.buffer(self._bufptrs[buf_i], self._frame_size())[:])
-        else:
-            buf = memoryview(ffi.buffer(self._bufptrs[buf_i], self._frame_size()))
+        buf = memoryview(ffi.buffer(self._bufptrs[buf_i], self._frame_size()))
 
         if self._shutter == 'double':
-            arr, self._double_img = self._arrays_from_buffer(buf)
+            arr, second = self._arrays_from_buffer(buf)
+            second = self._crop_roi(second)
+            self._double_img = np.copy(second) if copy else second
         else:
             arr, = self._arrays_from_buffer(buf)
 
-        return self._crop_roi(arr)
+        return self._output_frame(self._crop_roi(arr), copy, out)
 
     def _crop_roi(self, arr, kwds=None):
         kwds = self._last_kwds if kwds is None else kwds
@@ -387,13 +437,16 @@ class Pixelfly(Camera):
         pass
 
     @check_units(timeout='?ms')
-    def get_captured_image(self, timeout='1s', copy=True, **kwds):
-        self._handle_kwds(kwds)  # Should get rid of this duplication somehow...
-        image_arrs = []
+    def get_captured_image(self, timeout='1s', copy=True, stack=False, out=None, **kwds):
+        self._handle_kwds(kwds, fill_coords=False)  # Should get rid of this duplication somehow...
 
         if not self._capture_started:
             raise Error("No capture initiated. You must first call start_capture()")
 
+        frames_per_buf = 2 if self._shutter == 'double' else 1
+        n_remaining = (self._nbufs - self._buf_i) * frames_per_buf
+        images = CapturedImages(self, n_remaining, copy, stack, self._partial_sequence, out)
+
         start_time = clock() * u.s
         while self._buf_i < self._nbufs:
             if timeout is None:
@@ -403,37 +456,29 @@ class Pixelfly(Camera):
                 frame_ready = self.wait_for_frame(timeout - elapsed_time)
 
             if not frame_ready:
-                self._partial_sequence.extend(image_arrs)  # Save for later
+                self._partial_sequence = images.images  # Save for later
                 raise TimeoutError
 
-            if copy:
-                buf = memoryview(ffi.buffer(self._bufptrs[self._buf_i], self._frame_size())[:])
-            else:
-                buf = memoryview(ffi.buffer(self._bufptrs[self._buf_i], self._frame_size()))
-
+            buf = memoryview(ffi.buffer(self._bufptrs[self._buf_i], self._frame_size()))
             arrays = self._arrays_from_buffer(buf)
 
+            owned = False
             if kwds['fix_hotpixels']:
                 arrays = [self._correct_hot_pixels(a) for a in arrays]
+                owned = True
 
-            # Software ROI
+            # Software ROI, copying only the region we keep
             kwds = self._last_kwds
-            arrays = [a[kwds['top']:kwds['bot'], kwds['left']:kwds['right']] for a in arrays]
-
-            image_arrs.extend(arrays)
+            for array in arrays:
+                images.add(array[kwds['top']:kwds['bot'], kwds['left']:kwds['right']], owned)
             self._buf_i += 1
 
             # FIXME: HACK -- remove me
             if self._buf_i < self._nbufs:
                 self._dev.TRIGGER_CAMERA()
 
-        image_arrs = self._partial_sequence + image_arrs
         self._partial_sequence = []
-
-        if len(image_arrs) == 1:
-            return image_arrs[0]
-        else:
-            return tuple(image_arrs)
+        return images.result()
 
     def _arrays_from_buffer(self, buf):
         dtype = np.uint8 if self.bit_depth <= 8 else np.uint16
@@ -448,9 +493,9 @@ class Pixelfly(Camera):
             return (arr1.reshape((self._binned_height, self._binned_width)),
                     arr2.reshape((self._binned_height, self._binned_width)))
 
-    def grab_image(self, timeout='1s', copy=True, **kwds):
+    def grab_image(self, timeout='1s', copy=True, stack=False, out=None, **kwds):
         self.start_capture(**kwds)
-        return self.get_captured_image(timeout=timeout, copy=copy, **kwds)
+        return self.get_captured_image(timeout=timeout, copy=copy, stack=stack, out=out, **kwds)
 
     def _load_sizes(self):
         ccdx, ccdy, actualx, actualy, bit_pix = self._dev.GETSIZES()
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Driver for a simulated camera, which generates synthetic frames in software.
+
+Useful for developing and testing code (GUIs, pipelines, remote access, etc.) without hardware,
+and for benchmarking the per-frame overhead of the `Camera` machinery itself.
+"""
+from __future__ import division
+import time
+import threading
+import numpy as np
+
+from . import Camera
+from ._frames import CapturedImages
+from ..util import check_units, unit_mag
+from ...errors import Error, TimeoutError, InstrumentNotFoundError
+from ... import Q_
+
+__all__ = ['SimulatedCamera']
+
+_INST_PARAMS = ['serial']
+_INST_CLASSES = ['SimulatedCamera']
+
+SERIAL_PREFIX = 'SIM'
+
+
+def _sleep_until(t):
+    delay = t - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+
+class SimulatedCamera(Camera):
+    """A camera that produces synthetic frames of a Gaussian spot with noise and hot pixels.
+
+    Supports the full `Camera` interface: finite captures, live video, ROIs and binning, plus a
+    simulated hardware trigger for live video (see `set_trigger()`). Frames are "exposed" in real
+    time, so a live video runs at the set frame rate and a capture takes
+    ``n_frames * exposure_time`` to finish. Noisy frames for the current ROI, binning and
+    exposure are generated up front and cycled through, so producing a frame costs nothing and
+    timings measure only the overhead of the code consuming it.
+
+    Open one by giving a serial that starts with ``'SIM'``, along with any settings::
+
+        >>> cam = instrument(module='cameras.simulated', serial='SIM0',
+        ...                  settings={'width': 640, 'height': 480, 'bit_depth': 8})
+
+    Settings
+    --------
+    width, height : int
+        Size of the (unbinned) sensor in pixels
+    bit_depth : int
+        Number of bits per pixel. Frames are uint8 for 8 bits or fewer, and uint16 otherwise.
+    noise : float
+        Standard deviation of the per-pixel noise, in counts
+    dark_level : float
+        Mean value of unlit pixels, in counts
+    signal : float
+        Peak value of the spot above the dark level, in counts, for a 10 ms exposure. It scales
+        with the exposure time.
+    n_hot_pixels : int
+        Number of hot (saturated) pixels, placed at random. See `hot_pixels`.
+    n_noise_frames : int
+        Number of distinct noisy frames generated and cycled through
+    seed : int
+        Seed for the random number generator, so the hot pixels and noise are repeatable
+    """
+    def _initialize(self, width=1280, height=1024, bit_depth=12, noise=5., dark_level=100.,
+                    signal=1000., n_hot_pixels=10, n_noise_frames=8, seed=0):
+        if not 1 <= bit_depth <= 16:
+            raise Error("bit_depth must be between 1 and 16")
+        self._sensor_width = int(width)
+        self._sensor_height = int(height)
+        self.bit_depth = bit_depth
+        self.dtype = np.dtype(np.uint8 if bit_depth <= 8 else np.uint16)
+        self.noise = noise
+        self.dark_level = dark_level
+        self.signal = signal
+        self.n_noise_frames = max(int(n_noise_frames), 1)
+        self._rand = np.random.RandomState(seed)
+
+        #: (y, x) coordinates of the simulated hot pixels, as an Nx2 array
+        n_hot_pixels = min(n_hot_pixels, self._sensor_width * self._sensor_height)
+        hot_idx = self._rand.choice(self._sensor_width * self._sensor_height, n_hot_pixels,
+                                    replace=False)
+        self.hot_pixels = np.column_stack(np.unravel_index(np.sort(hot_idx),
+                                                           (self._sensor_height,
+                                                            self._sensor_width)))
+        self._spot = self._make_spot()
+
+        self._hbin = self._vbin = 1
+        self._roi = (0, 0, self._sensor_width, self._sensor_height)  # left, top, right, bot
+        self._exposure_s = 0.01
+        self._fix_hotpixels = False
+        self._frames = None
+        self._frames_key = None
+
+        self._mode = None  # None, 'capture' or 'live'
+        self._t_start = 0.
+        self._period = 0.
+        self._n_frames = 0
+        self._next_frame = 0
+        self._partial_sequence = []
+        self._frame_idx = -1
+        self._latest_info = (None, None)
+        self._trigger_mode = 'off'
+        self._n_triggers = 0
+        self._trigger_cond = threading.Condition()
+
+    def close(self):
+        self._mode = None
+        self._frames = self._frames_key = None
+
+    def _make_spot(self):
+        """Unit-height Gaussian spot centered on the full sensor, as float32"""
+        h, w = self._sensor_height, self._sensor_width
+        ys = np.arange(h, dtype=np.float32) - (h - 1) / 2
+        xs = np.arange(w, dtype=np.float32) - (w - 1) / 2
+        sigma = min(w, h) / 8
+        return np.exp(-(ys[:, np.newaxis]**2 + xs**2) / (2 * sigma**2)).astype(np.float32)
+
+    def _prepare_frames(self):
+        """Generate the noisy frames for the current ROI, binning and exposure, if needed"""
+        key = self._roi + (self._hbin, self._vbin, self._exposure_s)
+        if key == self._frames_key:
+            return
+
+        left, top, right, bot = self._roi
+        hbin, vbin = self._hbin, self._vbin
+        y0, y1, x0, x1 = top * vbin, bot * vbin, left * hbin, right * hbin
+
+        max_value = 2**self.bit_depth - 1
+        scene = self.dark_level + self._spot[y0:y1, x0:x1] * (self.signal *
+                                                               self._exposure_s / 0.01)
+        height, width = bot - top, right - left
+        if hbin > 1 or vbin > 1:
+            scene = scene.reshape((height, vbin, width, hbin)).sum(axis=(1, 3))
+
+        # Hot pixels saturate, as does any bin containing one
+        hot_y, hot_x = self.hot_pixels.T
+        inside = (hot_y >= y0) & (hot_y < y1) & (hot_x >= x0) & (hot_x < x1)
+        hot = ((hot_y[inside] - y0) // vbin, (hot_x[inside] - x0) // hbin)
+
+        frames = np.empty((self.n_noise_frames, height, width), self.dtype)
+        for frame in frames:
+            noisy = scene + self._rand.normal(0., self.noise, scene.shape)
+            np.clip(noisy, 0, max_value, out=noisy)
+            frame[...] = noisy
+            frame[hot] = max_value
+        frames.flags.writeable = False  # Stands in for SDK memory
+        self._frames = frames
+        self._frames_key = key
+
+    def _frame_array(self, idx):
+        """Get (array, owned) for frame number `idx`, where `array` references 'SDK memory'"""
+        array = self._frames[idx % len(self._frames)]
+        if self._fix_hotpixels:
+            return self._correct_hot_pixels(array), True
+        return array, False
+
+    def _apply_kwds(self, kwds):
+        self._handle_kwds(kwds, fill_coords=False)
+        self._hbin, self._vbin = int(kwds['hbin']), int(kwds['vbin'])
+        self._handle_kwds(kwds)
+
+        roi = tuple(int(round(kwds[k])) for k in ('left', 'top', 'right', 'bot'))
+        left, top, right, bot = roi
+        if not (0 <= left < right <= self.max_width and 0 <= top < bot <= self.max_height):
+            raise Error("ROI (left={}, top={}, right={}, bot={}) doesn't fit within the {}x{} "
+                        "binned sensor".format(left, top, right, bot, self.max_width,
+                                               self.max_height))
+        self._roi = roi
+        self._exposure_s = Q_(kwds['exposure_time']).to('s').magnitude
+        self._fix_hotpixels = kwds['fix_hotpixels']
+        self._prepare_frames()
+
+    def set_trigger(self, mode='off'):
+        """Set the trigger mode of live video.
+
+        With ``'hardware'``, live video takes one frame per call to `trigger()` instead of running
+        freely, like a real camera on an external trigger line. Triggered frames are buffered, so
+        `wait_for_frame()` returns each of them in turn.
+        """
+        if mode not in ('off', 'hardware'):
+            raise Error("Unrecognized trigger mode {}".format(mode))
+        self._trigger_mode = mode
+
+    #: Trigger mode string, 'off' or 'hardware'. Read-only
+    trigger_mode = property(lambda self: self._trigger_mode)
+
+    def trigger(self):
+        """Pulse the simulated trigger input, taking a frame if live video is triggered"""
+        with self._trigger_cond:
+            self._n_triggers += 1
+            self._trigger_cond.notify_all()
+
+    def start_capture(self, **kwds):
+        self._apply_kwds(kwds)
+        self._n_frames = kwds['n_frames']
+        self._next_frame = 0
+        self._partial_sequence = []
+        self._period = self._exposure_s
+        self._t_start = time.time()
+        self._mode = 'capture'
+
+    @unit_mag(timeout='?s')
+    def get_captured_image(self, timeout='1s', copy=True, wait_for_all=True, stack=False,
+                           out=None):
+        if self._mode != 'capture':
+            raise Error("No capture initiated. You must first call start_capture()")
+
+        images = CapturedImages(self, self._n_frames - self._next_frame, copy, stack,
+                                self._partial_sequence, out)
+        n_old = len(images)
+
+        deadline = None if timeout is None else time.time() + timeout
+        while self._next_frame < self._n_frames:
+            ready_time = self._t_start + (self._next_frame + 1) * self._period
+            if deadline is not None and ready_time > deadline:
+                _sleep_until(deadline)
+                if wait_for_all or len(images) == n_old:
+                    self._partial_sequence = images.images  # Save for later
+                    raise TimeoutError("Timed out while waiting for image readout")
+                else:
+                    break
+
+            _sleep_until(ready_time)
+            images.add(*self._frame_array(self._next_frame))
+            self._next_frame += 1
+        self._partial_sequence = []
+
+        if self._next_frame >= self._n_frames:
+            self._mode = None
+        return images.result()
+
+    def grab_image(self, timeout='1s', copy=True, stack=False, out=None, **kwds):
+        self.start_capture(**kwds)
+        return self.get_captured_image(timeout=timeout, copy=copy, stack=stack, out=out)
+
+    @check_units(framerate='?Hz')
+    def start_live_video(self, framerate=None, **kwds):
+        """Start live video mode.
+
+        Frames are produced at `framerate`, or if it is None, back-to-back at a rate of one per
+        exposure time. If the exposure time is zero too, frames are produced as fast as they are
+        consumed, i.e. every call to `wait_for_frame()` returns a new frame immediately.
+
+        See `grab_image()` for the set of available kwds.
+        """
+        self._apply_kwds(kwds)
+        if framerate is None:
+            self._period = self._exposure_s
+        else:
+            self._period = 1. / framerate.to('Hz').magnitude
+        self._frame_idx = -1
+        self._latest_info = (None, None)
+        with self._trigger_cond:
+            self._n_triggers = 0  # Triggers sent before arming are missed
+        self._t_start = time.time()
+        self._mode = 'live'
+
+    def stop_live_video(self):
+        self._mode = None
+
+    def _newest_frame(self, now):
+        """Number of the newest frame finished by time `now` in live mode (-1 if none)"""
+        return int((now - self._t_start) / self._period) - 1
+
+    @unit_mag(timeout='?s')
+    def wait_for_frame(self, timeout=None):
+        if self._mode != 'live':
+            raise Error("Live video is not running. You must first call start_live_video()")
+
+        if self._trigger_mode == 'hardware':
+            return self._wait_for_trigger(timeout)
+
+        if not self._period:
+            self._frame_idx += 1
+            return True
+
+        now = time.time()
+        newest = self._newest_frame(now)
+        if newest <= self._frame_idx:
+            ready_time = self._t_start + (self._frame_idx + 2) * self._period
+            if timeout is not None and ready_time > now + timeout:
+                _sleep_until(now + timeout)
+                return False
+            _sleep_until(ready_time)
+            newest = max(self._newest_frame(time.time()), self._frame_idx + 1)
+
+        # Like a real camera, only the newest frame is kept, so any others since the last call
+        # are dropped and show up as gaps in the frame numbers
+        self._frame_idx = newest
+        return True
+
+    def _wait_for_trigger(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._trigger_cond:
+            while self._n_triggers <= self._frame_idx + 1:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._trigger_cond.wait(remaining)
+            self._frame_idx += 1  # Each trigger's frame is read out in turn
+        return True
+
+    def latest_frame(self, copy=True, out=None):
+        if self._frame_idx < 0:
+            raise Error("No frame is ready yet. Call wait_for_frame() first")
+        idx = self._frame_idx
+        self._latest_info = (idx, self._t_start + (idx + 1) * self._period)
+        array, owned = self._frame_array(idx)
+        return self._output_frame(array, copy and not owned, out)
+
+    def _latest_frame_info(self):
+        return self._latest_info
+
+    width = property(lambda self: self._roi[2] - self._roi[0])
+    height = property(lambda self: self._roi[3] - self._roi[1])
+    max_width = property(lambda self: self._sensor_width // self._hbin)
+    max_height = property(lambda self: self._sensor_height // self._vbin)
+
+    @property
+    def framerate(self):
+        """Frame rate in live mode, or None if unthrottled"""
+        return Q_(1. / self._period, 'Hz') if self._period else None
+
+
+def list_instruments():
+    # Simulated cameras aren't attached hardware, so there are none to discover
+    return []
+
+
+def _instrument(paramset):
+    serial = paramset.get('serial', SERIAL_PREFIX)
+    if not str(serial).startswith(SERIAL_PREFIX):
+        # Keeps simulated cameras from shadowing real ones when opening by serial
+        raise InstrumentNotFoundError("Simulated camera serials must start with "
+                                      "'{}'".format(SERIAL_PREFIX))
+    return SimulatedCamera._create(paramset)
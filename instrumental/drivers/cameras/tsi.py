@@ -11,6 +11,7 @@ from cffi import FFI
 from enum import Enum
 
 from . import Camera
+from ._frames import CapturedImages
 from ..util import as_enum, unit_mag, check_units
 from .. import ParamSet, register_cleanup
 from ...errors import Error, TimeoutError
@@ -381,6 +382,7 @@ class TSI_Camera(Camera):
         sdk.GetNumberOfCameras()
         self._partial_sequence = []
         self._next_frame_idx = 0
+        self._latest_frame_number = None
         self._tot_frames = None  # Zero means 'infinite' capture
         self._trig_mode = None
         self._dev = sdk.GetCamera(self._paramset.get('number', 0))
@@ -430,10 +432,11 @@ class TSI_Camera(Camera):
             n_frames = 1
         self._set_parameter(Param.FRAME_COUNT, n_frames)
 
-    def grab_image(self, timeout='1s', copy=True, **kwds):
+    def grab_image(self, timeout='1s', copy=True, stack=False, out=None, **kwds):
         self.start_capture(**kwds)
         try:
-            images = self.get_captured_image(timeout=timeout, copy=copy, **kwds)
+            images = self.get_captured_image(timeout=timeout, copy=copy, stack=stack, out=out,
+                                             **kwds)
         finally:
             self._dev.Stop()
         return images
@@ -443,14 +446,22 @@ class TSI_Camera(Camera):
         self._dev.Stop()
 
     @check_units(timeout='?ms')
-    def get_captured_image(self, timeout='1s', copy=True, wait_for_all=True, **kwds):
-        image_arrs = []
+    def get_captured_image(self, timeout='1s', copy=True, wait_for_all=True, stack=False,
+                           out=None, **kwds):
+        if self._tot_frames is None or (self._tot_frames and
+                                        self._next_frame_idx >= self._tot_frames):
+            raise Error("No capture initiated. You must first call start_capture() or "
+                        "start_live_video()")
+        elif self._tot_frames == 0:
+            n_new = 1  # Live video never ends, so just get the next frame
+        else:
+            n_new = self._tot_frames - self._next_frame_idx
 
-        if self._tot_frames and self._next_frame_idx >= self._tot_frames:
-            raise Error("No capture initiated. You must first call start_capture()")
+        images = CapturedImages(self, n_new, copy, stack, self._partial_sequence, out)
+        n_old = len(images)
 
         start_time = clock() * u.s
-        while self._next_frame_idx < self._tot_frames:
+        while len(images) < n_old + n_new:
             if timeout is None:
                 frame_ready = self.wait_for_frame(timeout=None)
             else:
@@ -458,24 +469,20 @@ class TSI_Camera(Camera):
                 frame_ready = self.wait_for_frame(timeout - elapsed_time)
 
             if not frame_ready:
-                if wait_for_all or not image_arrs:
-                    self._partial_sequence.extend(image_arrs)  # Save for later
+                if wait_for_all or len(images) == n_old:
+                    self._partial_sequence = images.images  # Save for later
                     raise TimeoutError("Timed out while waiting for image readout")
                 else:
                     break
 
-            array = self.latest_frame(copy)
-            image_arrs.append(array)
-        image_arrs = self._partial_sequence + image_arrs
+            images.add(self._arr_from_img_struct(self._latest_tsi_img))
+            self._dev.FreeImage(self._latest_tsi_img)
+        self._partial_sequence = []
 
         if self._tot_frames and self._next_frame_idx >= self._tot_frames:
             self._dev.Stop()
-            self._partial_sequence = []
 
-        if len(image_arrs) == 1:
-            return image_arrs[0]
-        else:
-            return tuple(image_arrs)
+        return images.result()
 
     def start_capture(self, **kwds):
         self._handle_kwds(kwds)
@@ -507,24 +514,26 @@ class TSI_Camera(Camera):
             if timeout_s is not None and elapsed_time > timeout_s:
                 return False
 
-    def latest_frame(self, copy=True):
+    def latest_frame(self, copy=True, out=None):
         # Frees the TSI image buffer if `copy` is true. Otherwise, it's the user's responsibility
         # If no buffers are available for use, the frame count will never increment, and
         # wait_for_frame will block (until its timeout is reached)
-        img = self._arr_from_img_struct(self._latest_tsi_img, copy)
+        img = self._output_frame(self._arr_from_img_struct(self._latest_tsi_img), copy, out)
+        self._latest_frame_number = self._latest_tsi_img.m_FrameNumber
         self._dev.FreeImage(self._latest_tsi_img)
         return img
 
-    def _arr_from_img_struct(self, tsi_img, copy):
+    def _latest_frame_info(self):
+        return self._latest_frame_number, None
+
+    def _arr_from_img_struct(self, tsi_img):
+        """Get an array that directly references the image struct's pixel data"""
         p_buf = tsi_img.m_PixelData.ui16
         # Note: m_SizeInBytes doesn't seem to work correctly
         frame_size = tsi_img.m_Width * tsi_img.m_Height * tsi_img.m_BytesPerPixel
         self._tsi_img = tsi_img
 
-        if copy:
-            image_buf = memoryview(ffi.buffer(p_buf, frame_size)[:])
-        else:
-            image_buf = memoryview(ffi.buffer(p_buf, frame_size))
+        image_buf = memoryview(ffi.buffer(p_buf, frame_size))
 
         # Convert to array (currently assumes mono16)
         array = np.frombuffer(image_buf, np.uint16)
@@ -540,6 +549,7 @@ class TSI_Camera(Camera):
         self._set_exposure_time(kwds['exposure_time'])
         self._set_n_frames(0)
         self._tot_frames = 0
+        self._partial_sequence = []
         self._next_frame_idx = 0
 
         self._dev.Stop()  # Ensure old captures are finished
@@ -10,6 +10,7 @@ from past.builtins import basestring, unicode
 import struct
 import weakref
 import fnmatch
+from collections import OrderedDict
 import numpy as np
 import win32event  # req: pywin32
 
@@ -17,6 +18,7 @@ from nicelib import (NiceLib, NiceObject, load_lib,
                      RetHandler, Sig, ret_return)  # req: nicelib >= 0.5
 
 from . import Camera
+from ._frames import CapturedImages
 from ..util import check_units
 from .. import ParamSet, Facet
 from ...errors import (InstrumentNotFoundError, Error, TimeoutError, LibError,
@@ -252,6 +254,15 @@ class NiceUC480(NiceLib):
             if getting:
                 return param_data[0]
 
+        @Sig('in', 'in', 'inout', 'in')
+        def GetImageInfo(self, mem_id):
+            """GetImageInfo(mem_id)"""
+            if IMAGEINFO_TYPE is None:
+                raise UnsupportedFeatureError("uc480 lib has no image info struct")
+            info_p = ffi.new(IMAGEINFO_TYPE)
+            self._autofunc_GetImageInfo(mem_id, info_p, ffi.sizeof(info_p[0]))
+            return info_p[0]
+
         @Sig('in', 'in', 'inout', 'in')
         def Blacklevel(self, command, param=None):
             if command in BLACKLEVEL_GET_PARAM_TYPES:
@@ -286,6 +297,21 @@ lib = NiceUC480
 if not hasattr(lib, 'AOI_IMAGE_GET_POS_FAST_SUPPORTED'):
     lib.AOI_IMAGE_GET_POS_FAST_SUPPORTED = lib.AOI_IMAGE_SET_POS_FAST_SUPPORTED
 
+
+def _find_ctype(*names):
+    """Get the first of the C type `names` that the lib's header defines, or None"""
+    for name in names:
+        try:
+            ffi.typeof(name)
+            return name
+        except ffi.error:
+            pass
+    return None
+
+
+# The image info struct is named after the header, i.e. uc480.h (Thorlabs) or uEye.h (IDS)
+IMAGEINFO_TYPE = _find_ctype('UC480IMAGEINFO*', 'UEYEIMAGEINFO*')
+
 AOI_GET_PARAM_TYPES = {
     lib.AOI_IMAGE_GET_AOI: 'IS_RECT*',
     lib.AOI_IMAGE_GET_POS: 'IS_POINT_2D*',
@@ -504,10 +530,17 @@ def AutoParamEnableFacet(name, doc=None):
 
     def fset(self, enable):
         self._dev.SetAutoParameter(SET_CMD, enable, 0)
+        self._settings.clear()  # Auto functions may change the exposure and gain
 
     return Facet(fget, fset, type=bool, doc=doc)
 
 
+def _mem_seq_nbytes(key):
+    """Approximate size in bytes of an image memory sequence with the given pool key"""
+    width, height, color_depth, num_bufs = key
+    return width * height * color_depth // 8 * num_bufs
+
+
 class BufferInfo(object):
     def __init__(self, ptr, id):
         self.ptr = ptr
@@ -519,6 +552,13 @@ class UC480_Camera(Camera):
     DEFAULT_KWDS = Camera.DEFAULT_KWDS.copy()
     DEFAULT_KWDS.update(vsub=1, hsub=1)
 
+    #: Max number of image memory sequences kept allocated for reuse by later acquisitions
+    MEM_POOL_SIZE = 4
+
+    #: Max total size in bytes of the image memory sequences kept for reuse. Sequences larger
+    #: than this (e.g. long captures) are freed as soon as they're no longer in use.
+    MEM_POOL_MAX_BYTES = 256 * 1024**2
+
     def _initialize(self):
         """Create a UC480_Camera object.
 
@@ -553,6 +593,10 @@ class UC480_Camera(Camera):
         self._list_memid = None
 
         self._buffers = []
+        self._mem_key = None
+        self._mem_pool = OrderedDict()
+        self._settings = {}
+        self._latest_buf_ptr = None
         self._queue_enabled = False
         self._trigger_mode = lib.SET_TRIGGER_OFF
 
@@ -574,6 +618,7 @@ class UC480_Camera(Camera):
     def set_auto_exposure(self, enable=True):
         """Enable or disable the auto exposure shutter."""
         self._dev.SetAutoParameter(lib.SET_ENABLE_AUTO_SHUTTER, enable, 0)
+        self._settings.pop('exposure_time', None)
 
     def load_params(self, filename=None):
         """Load camera parameters from file or EEPROM.
@@ -593,6 +638,7 @@ class UC480_Camera(Camera):
             param = ffi.new('wchar_t[]', filename)
 
         self._dev.ParameterSet(cmd, param, ffi.sizeof(param))
+        self._settings.clear()  # The camera's settings no longer match what we last applied
         self._init_colormode()  # Ignore loaded color mode b/c we only support a few
 
         # Make sure memory is set up for right color depth
@@ -648,20 +694,84 @@ class UC480_Camera(Camera):
 
     def _free_image_mem_seq(self):
         self._dev.ClearSequence()
-        for buf in self._buffers:
-            self._dev.FreeImageMem(buf.ptr, buf.id)
+        self._free_buffers(self._buffers)
         self._buffers = []
+        self._mem_key = None
+
+    def _free_buffers(self, buffers):
+        for buf in buffers:
+            self._dev.FreeImageMem(buf.ptr, buf.id)
 
     def _allocate_mem_seq(self, num_bufs):
-        """Create and setup the image memory for live capture."""
-        for i in range(num_bufs):
-            p_img_mem, memid = self._dev.AllocImageMem(self._width, self._height, self._color_depth)
-            self._dev.AddToSequence(p_img_mem, memid)
-            self._buffers.append(BufferInfo(p_img_mem, memid))
+        """Set up the image memory sequence for capture.
+
+        Does nothing if the current sequence already matches the image size, color depth and
+        number of buffers. Otherwise, the current sequence's memory is kept in a pool, keyed by
+        those values, so switching back and forth between acquisition settings doesn't
+        reallocate. Only the `MEM_POOL_SIZE` most recently used sequences are kept, up to a total
+        of `MEM_POOL_MAX_BYTES`.
+        """
+        key = (self._width, self._height, self._color_depth, num_bufs)
+        if key == self._mem_key:
+            return
+
+        self._dev.ClearSequence()
+        if self._buffers:
+            self._mem_pool[self._mem_key] = self._buffers
+
+        buffers = self._mem_pool.pop(key, None)
+        if buffers is None:
+            log.debug("Allocating %d image buffers of size %dx%d", num_bufs, self._width,
+                      self._height)
+            buffers = []
+            for i in range(num_bufs):
+                p_img_mem, memid = self._dev.AllocImageMem(self._width, self._height,
+                                                           self._color_depth)
+                buffers.append(BufferInfo(p_img_mem, memid))
+
+        for buf in buffers:
+            self._dev.AddToSequence(buf.ptr, buf.id)
+        self._buffers = buffers
+        self._mem_key = key
+
+        pool_nbytes = sum(_mem_seq_nbytes(k) for k in self._mem_pool)
+        while self._mem_pool and (len(self._mem_pool) > self.MEM_POOL_SIZE or
+                                  pool_nbytes > self.MEM_POOL_MAX_BYTES):
+            old_key, old_buffers = self._mem_pool.popitem(last=False)
+            pool_nbytes -= _mem_seq_nbytes(old_key)
+            self._free_buffers(old_buffers)
 
         # Initialize display
         self._dev.SetDisplayMode(lib.SET_DM_DIB)
 
+    def _push_setting(self, name, value, apply):
+        """Apply a setting via ``apply()``, unless it's unchanged since it was last applied
+
+        Returns whether the setting was applied.
+        """
+        if name in self._settings and self._settings[name] == value:
+            return False
+        apply()
+        self._settings[name] = value
+        return True
+
+    def _apply_capture_settings(self, kwds):
+        """Push binning, subsampling and AOI to the camera, skipping any that are unchanged"""
+        self._handle_kwds(kwds, fill_coords=False)
+
+        sampling = (kwds['vbin'], kwds['hbin'], kwds['vsub'], kwds['hsub'])
+        def set_sampling():
+            self._set_binning(kwds['vbin'], kwds['hbin'])
+            self._set_subsampling(kwds['vsub'], kwds['hsub'])
+            self._refresh_sizes()
+        if self._push_setting('sampling', sampling, set_sampling):
+            self._settings.pop('aoi', None)  # The AOI is relative to the binned sensor
+
+        # Fill coords now b/c max width/height may have changed
+        self._handle_kwds(kwds, fill_coords=True)
+        aoi = (kwds['left'], kwds['top'], kwds['right'], kwds['bot'])
+        self._push_setting('aoi', aoi, lambda: self._set_AOI(*aoi))
+
     def close(self):
         """Close the camera and release the associated image memory."""
         self._dev.ExitEvent(lib.SET_EVENT_SEQ)
@@ -717,6 +827,7 @@ class UC480_Camera(Camera):
     def _set_subsampling(self, vsub, hsub):
         mode = SUBSAMP_V_CODE_FROM_NUM[vsub] | SUBSAMP_H_CODE_FROM_NUM[hsub]
         self._dev.SetSubSampling(mode)
+        self._settings.pop('exposure_time', None)  # The driver may have clamped the exposure
 
     def _get_subsampling(self):
         vsub = self._dev.SetSubSampling(lib.GET_SUBSAMPLING_FACTOR_VERTICAL)
@@ -726,21 +837,15 @@ class UC480_Camera(Camera):
     def _set_binning(self, vbin, hbin):
         mode = BIN_V_CODE_FROM_NUM[vbin] | BIN_H_CODE_FROM_NUM[hbin]
         self._dev.SetBinning(mode)
+        self._settings.pop('exposure_time', None)  # The driver may have clamped the exposure
 
     def start_capture(self, **kwds):
-        self._handle_kwds(kwds, fill_coords=False)
+        self._apply_capture_settings(kwds)
+        exposure_time = Q_(kwds['exposure_time'])
+        self._push_setting('exposure_time', exposure_time,
+                           lambda: self._set_exposure(exposure_time))
+        self._push_setting('gain', kwds['gain'], lambda: self._set_gain(kwds['gain']))
 
-        self._set_binning(kwds['vbin'], kwds['hbin'])
-        self._set_subsampling(kwds['vsub'], kwds['hsub'])
-        self._refresh_sizes()
-
-        # Fill coords now b/c max width/height may have changed
-        self._handle_kwds(kwds, fill_coords=True)
-        self._set_AOI(kwds['left'], kwds['top'], kwds['right'], kwds['bot'])
-        self._set_exposure(kwds['exposure_time'])
-        self._set_gain(kwds['gain'])
-
-        self._free_image_mem_seq()
         self._allocate_mem_seq(kwds['n_frames'])
 
         self._set_queueing(True)  # Use queue instead of ring buffer for finite sequence
@@ -753,7 +858,7 @@ class UC480_Camera(Camera):
         self._dev.CaptureVideo(lib.DONT_WAIT)  # Trigger
 
     @check_units(timeout='ms')
-    def get_captured_image(self, timeout='1s', copy=True):
+    def get_captured_image(self, timeout='1s', copy=True, stack=False, out=None):
         ret = win32event.WaitForSingleObject(self._seq_event, int(timeout.m_as('ms')))
         self._dev.DisableEvent(lib.SET_EVENT_SEQ)
 
@@ -763,34 +868,21 @@ class UC480_Camera(Camera):
             raise Error("Failed to grab image")
 
         # Assumes we have exactly as many images as buffers
-        arrays = []
+        images = CapturedImages(self, len(self._buffers), copy, stack, out=out)
+        buf_size = self.bytes_per_line * self.height
         for buf in self._buffers:
-            buf_size = self.bytes_per_line * self.height
-            array = self._array_from_buffer(ffi.buffer(buf.ptr, buf_size))
-            arrays.append(np.copy(array) if copy else array)
+            images.add(self._array_from_buffer(ffi.buffer(buf.ptr, buf_size)))
 
         self._dev.StopLiveVideo(lib.WAIT)
+        return images.result()
 
-        if len(arrays) == 1:
-            return arrays[0]
-        else:
-            return tuple(arrays)
-
-    def grab_image(self, timeout='1s', copy=True, **kwds):
+    def grab_image(self, timeout='1s', copy=True, stack=False, out=None, **kwds):
         self.start_capture(**kwds)
-        return self.get_captured_image(timeout=timeout, copy=copy)
+        return self.get_captured_image(timeout=timeout, copy=copy, stack=stack, out=out)
 
     @check_units(framerate='?Hz')
     def start_live_video(self, framerate=None, **kwds):
-        self._handle_kwds(kwds, fill_coords=False)
-
-        self._set_binning(kwds['vbin'], kwds['hbin'])
-        self._set_subsampling(kwds['vsub'], kwds['hsub'])
-        self._refresh_sizes()
-
-        # Fill coords now b/c max width/height may have changed
-        self._handle_kwds(kwds, fill_coords=True)
-        self._set_AOI(kwds['left'], kwds['top'], kwds['right'], kwds['bot'])
+        self._apply_capture_settings(kwds)
 
         # Framerate should be set *before* exposure time
         if framerate is None:
@@ -798,14 +890,18 @@ class UC480_Camera(Camera):
             framerate = 1/Q_(kwds['exposure_time'])
         self._dev.SetFrameRate(framerate.m_as('Hz'))
 
-        self._set_exposure(kwds['exposure_time'])
-        self._set_gain(kwds['gain'])
+        # Changing the framerate can change the exposure, so always set it
+        exposure_time = Q_(kwds['exposure_time'])
+        self._set_exposure(exposure_time)
+        self._settings['exposure_time'] = exposure_time
+        self._push_setting('gain', kwds['gain'], lambda: self._set_gain(kwds['gain']))
 
-        self._free_image_mem_seq()
         self._allocate_mem_seq(num_bufs=2)
         self._set_queueing(False)
 
-        self._trigger_mode = lib.SET_TRIGGER_OFF
+        # Software triggers aren't sent in live mode, so free-run unless a hardware trigger is set
+        if self._trigger_mode == lib.SET_TRIGGER_SOFTWARE:
+            self._trigger_mode = lib.SET_TRIGGER_OFF
         self._dev.SetExternalTrigger(self._trigger_mode)
         self._dev.EnableEvent(lib.SET_EVENT_FRAME)
         self._dev.CaptureVideo(lib.WAIT)
@@ -827,11 +923,24 @@ class UC480_Camera(Camera):
 
         return True
 
-    def latest_frame(self, copy=True):
+    def latest_frame(self, copy=True, out=None):
         buf_num, buf_ptr, last_buf_ptr = self._dev.GetActSeqBuf()
         buf_size = self.bytes_per_line * self.height
         array = self._array_from_buffer(ffi.buffer(last_buf_ptr, buf_size))
-        return np.copy(array) if copy else array
+        self._latest_buf_ptr = last_buf_ptr
+        return self._output_frame(array, copy, out)
+
+    def _latest_frame_info(self):
+        mem_ids = [buf.id for buf in self._buffers if buf.ptr == self._latest_buf_ptr]
+        if not mem_ids or IMAGEINFO_TYPE is None:
+            return None, None
+        try:
+            info = self._dev.GetImageInfo(mem_ids[0])
+        except UC480Error as e:
+            log.debug("Couldn't get image info: %s", e)
+            return None, None
+        # The device timestamp has a resolution of 0.1 us
+        return info.u64FrameNumber, info.u64TimestampDevice * 1e-7
 
     def _get_AOI(self):
         rect = self._dev.AOI(lib.AOI_IMAGE_GET_AOI)
@@ -839,6 +948,7 @@ class UC480_Camera(Camera):
 
     def _set_AOI(self, x0, y0, x1, y1):
         self._dev.AOI(lib.AOI_IMAGE_SET_AOI, (x0, y0, x1-x0, y1-y0))
+        self._settings.pop('exposure_time', None)  # The driver may have clamped the exposure
         self._refresh_sizes()
 
     def _refresh_sizes(self):
@@ -1024,6 +1134,7 @@ class UC480_Camera(Camera):
     def master_gain(self, gain):
         gain_factor = int(round(gain * 100))
         self._dev.SetHWGainFactor(lib.SET_MASTER_GAIN_FACTOR, gain_factor)
+        self._settings.pop('gain', None)
 
     max_master_gain = property(lambda self: self._max_master_gain,
                                doc="Max value that ``master_gain`` can take")
@@ -3,11 +3,14 @@
 from __future__ import division
 from past.builtins import unicode, basestring
 
+import os
 import sys
+import json
 import time
 import weakref
+import threading
 from enum import Enum, EnumMeta
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 import numpy as np
 from nicelib import (NiceLib, load_lib, RetHandler,
@@ -20,7 +23,8 @@ from ..util import check_units, check_enums, as_enum
 from . import DAQ
 
 __all__ = ['NIDAQ', 'AnalogIn', 'AnalogOut', 'VirtualDigitalChannel', 'SampleMode', 'EdgeSlope',
-           'TerminalConfig', 'RelativeTo', 'ProductCategory', 'DAQError']
+           'TerminalConfig', 'RelativeTo', 'ProductCategory', 'DAQError', 'AIStream', 'AIBlock',
+           'AIData', 'load_recording']
 
 
 def to_bytes(value, codec='utf-8'):
@@ -116,7 +120,7 @@ class NiceNI(NiceLib):
         CreateAOVoltageChan = Sig('in', 'in', 'in', 'in', 'in', 'in', 'in')
         CreateDIChan = Sig('in', 'in', 'in', 'in')
         CreateDOChan = Sig('in', 'in', 'in', 'in')
-        ReadAnalogF64 = Sig('in', 'in', 'in', 'in', 'arr', 'len=in', 'out', 'ignore')
+        ReadAnalogF64 = Sig('in', 'in', 'in', 'in', 'in', 'in', 'out', 'ignore')
         ReadAnalogScalarF64 = Sig('in', 'in', 'out', 'ignore')
         ReadDigitalScalarU32 = Sig('in', 'in', 'out', 'ignore')
         ReadDigitalU32 = Sig('in', 'in', 'in', 'in', 'arr', 'len=in', 'out', 'ignore')
@@ -433,6 +437,110 @@ def num_not_none(*args):
     return sum(int(arg is not None) for arg in args)
 
 
+_time_axes = OrderedDict()
+_time_axes_lock = threading.Lock()
+
+
+def _time_axis(fsamp_hz, n_samples, copy=False):
+    """Get the sample times in seconds, cached per (fsamp, n_samples)
+
+    The cached array is read-only, so unless `copy` is True, the caller must not modify it.
+    """
+    key = (fsamp_hz, n_samples)
+    with _time_axes_lock:
+        t = _time_axes.pop(key, None)
+        if t is None:
+            t = np.arange(n_samples) / fsamp_hz
+            t.flags.writeable = False
+        _time_axes[key] = t
+        if len(_time_axes) > 16:
+            _time_axes.popitem(last=False)
+    return t.copy() if copy else t
+
+
+def _check_AI_out(out, n_channels, n_samples=None):
+    """Check that `out` can hold an AI read of `n_channels` (and `n_samples`, if given)"""
+    shape_ok = out.ndim == 2 and out.shape[0] == n_channels
+    if n_samples is not None:
+        shape_ok = shape_ok and out.shape[1] == n_samples
+    if not (shape_ok and out.dtype == np.float64 and out.flags.c_contiguous):
+        shape = (n_channels, 'n_samples' if n_samples is None else n_samples)
+        raise Error("out must be a C-contiguous float64 array of shape ({}, {})".format(*shape))
+
+
+def _channel_rows(out, n_read):
+    """Get the rows of samples of each channel after reading `n_read` samples into `out`"""
+    n_channels, n_samples = out.shape
+    if n_read < n_samples:
+        # A short read packs the channels together at the start of the buffer, so spread them out
+        # into their rows, starting from the last so none is overwritten before it has moved
+        flat = out.reshape(-1)
+        for i in reversed(range(1, n_channels)):
+            out[i, :n_read] = flat[i*n_read:(i+1)*n_read]
+    return out[:, :n_read]
+
+
+class AIData(object):
+    """Samples from an analog input read, as one plain array.
+
+    Returned by `Task.read()` and `Task.run()` when ``raw=True``, for when the samples are going
+    to be processed as an array anyway. It also acts as a read-only stand-in for the dict those
+    methods normally return: indexing it with a channel path or ``'t'`` returns the same
+    Quantity as the dict would, created on demand.
+
+    Attributes
+    ----------
+    data : numpy.ndarray
+        (n_channels, n_samples) float64 array of samples, one row per channel
+    channels : list of str
+        Paths of the channels, in the order of the rows of `data`
+    units : str
+        Units of the samples
+    fsamp : Quantity or None
+        Sample rate, or None for a single, untimed sample per channel
+    """
+    def __init__(self, data, channels, fsamp, units='V'):
+        self.data = data
+        self.channels = list(channels)
+        self.fsamp = fsamp
+        self.units = units
+
+    @property
+    def t(self):
+        """Sample times in seconds, as a read-only array"""
+        if self.fsamp is None:
+            return np.zeros(1)
+        return _time_axis(self.fsamp.m_as('Hz'), self.data.shape[1])
+
+    def __getitem__(self, key):
+        if key == 't':
+            return Q_(0., 's') if self.fsamp is None else Q_(self.t, 's')
+        try:
+            row = self.data[self.channels.index(key)]
+        except ValueError:
+            raise KeyError(key)
+        return Q_(row[0] if self.fsamp is None else row, self.units)
+
+    def keys(self):
+        return self.channels + ['t']
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.channels) + 1
+
+    def __contains__(self, key):
+        return key == 't' or key in self.channels
+
+    def to_dict(self):
+        """Get the samples as a dict of Quantities, as returned by a read without ``raw``"""
+        return {key: self[key] for key in self.keys()}
+
+    def __repr__(self):
+        return '<AIData channels={} n_samples={}>'.format(self.channels, self.data.shape[1])
+
+
 class Task(object):
     """A high-level task that can synchronize use of multiple channel types.
 
@@ -511,29 +619,167 @@ class Task(object):
                 mtask._mx_task.CfgDigEdgeStartTrig(self.master_trig, self.edge.value)
         self._trig_set_up = True
 
-    def run(self, write_data=None):
+    def run(self, write_data=None, out=None, raw=False):
         """Run a task from start to finish
 
         Writes output data, starts the task, reads input data, stops the task, then returns the
         input data. Will wait indefinitely for the data to be received. If you need more control,
         you may instead prefer to use `write()`, `read()`, `start()`, `stop()`, etc. directly.
+
+        See `read()` for a description of `out` and `raw`.
         """
         if not self._trig_set_up:
             self._setup_triggers()
 
         self.write(write_data, autostart=False)
         self.start()
-        read_data = self.read()
+        read_data = self.read(out=out, raw=raw)
         self.stop()
 
         return read_data
 
     @check_units(timeout='?s')
-    def read(self, timeout=None):
+    def read(self, timeout=None, out=None, raw=False):
+        """Read the data from the input channels.
+
+        Returns a dict mapping each AI channel's path to its array of samples, along with the
+        sample times under the key 't'.
+
+        Parameters
+        ----------
+        timeout : Quantity([time]), optional
+            Maximum time to wait for the samples. If None, wait forever.
+        out : numpy.ndarray, optional
+            C-contiguous float64 array of shape (n_AI_channels, n_samples) to read the samples
+            into, one row per channel. The returned arrays are then views of it, so repeated
+            reads into the same array allocate no sample buffers. The time array is then cached
+            and shared between reads with the same timing, so it is read-only. Without `out`,
+            each read returns its own, writable time array.
+        raw : bool, optional
+            If True, return an `AIData` holding the samples as a single (n_channels, n_samples)
+            array, without wrapping them in Quantities
+        """
         timeout_s = float(-1. if timeout is None else timeout.m_as('s'))
-        read_data = self._read_AI_channels(timeout_s)
+        read_data = self._read_AI_channels(timeout_s, out, raw)
         return read_data
 
+    @check_units(fsamp='Hz')
+    def start_stream(self, fsamp, block_size, n_buffers=4, buf_size=None):
+        """Start continuously acquiring from the task's AI channels, in blocks.
+
+        Only supported for tasks made up of analog input channels. Each block holds one row per
+        channel, in the order the channels were given to the task. See `AnalogIn.start_stream()`
+        for a description of the parameters.
+
+        Returns
+        -------
+        stream : AIStream
+            The running stream. Stopping it stops the task.
+        """
+        if set(self._mtasks) != {'AI'}:
+            raise Error("Streaming is only supported for tasks with only AI channels")
+        return AIStream(self._mtasks['AI'], [ch.path for ch in self.AIs], fsamp, block_size,
+                        n_buffers, buf_size)
+
+    @check_units(duration='s', fsamp='Hz')
+    def record(self, path, duration, fsamp, block_size=None, n_buffers=8):
+        """Record the task's AI channels continuously, straight to a memory-mapped file.
+
+        The samples are streamed via `start_stream()`, whose reader thread reads them from the
+        DAQ, while this method copies each block into a ``.npy`` file of shape
+        (n_samples, n_channels) preallocated for the whole `duration`. Memory use therefore stays
+        fixed however long the recording is. Each block is written at its sample index on the
+        stream's time axis, so samples lost in an overrun are left as NaNs rather than closing
+        up the gap.
+
+        The channel paths and voltage ranges, sample rate, units and start time are saved in a
+        ``.json`` file of the same name before recording starts. Once recording stops, whether
+        or not it completed, the number of samples written, the overruns and the stats below are
+        added to it. Use `load_recording()` to open the recording as memory-mapped arrays.
+
+        Parameters
+        ----------
+        path : str
+            Path of the ``.npy`` file to write
+        duration : Quantity([time])
+            How long to record for
+        fsamp : Quantity([frequency])
+            The sample frequency
+        block_size : int, optional
+            Number of samples per channel read at a time. Defaults to 100 ms worth.
+        n_buffers : int, optional
+            Number of block buffers of the stream
+
+        Returns
+        -------
+        stats : dict
+            The number of samples per channel written (``n_samples``), the number of DAQmx buffer
+            overruns (``n_overruns``) and of samples lost in them (``n_lost``), ``elapsed_s``, and
+            the sustained write throughput (``write_MB_per_s``)
+        """
+        fsamp_hz = fsamp.m_as('Hz')
+        n_total = int(round(duration.m_as('s') * fsamp_hz))
+        if n_total < 1:
+            raise ValueError("duration must be at least one sample period")
+        if block_size is None:
+            block_size = max(int(fsamp_hz / 10), 1)
+        block_size = min(block_size, n_total)
+        channels = [ch.path for ch in self.AIs]
+        ranges = self._mtasks['AI'].ranges if 'AI' in self._mtasks else {}
+
+        mm = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64,
+                                       shape=(n_total, len(channels)))
+        start_time = time.time()
+        meta = {
+            'channels': channels,
+            'ranges_V': [ranges.get(ch) for ch in channels],
+            'fsamp_Hz': fsamp_hz,
+            'units': 'V',
+            'start_time': start_time,
+            'n_samples': 0,
+            'complete': False,
+            'overruns': [],
+        }
+        _write_meta(path, meta)
+
+        n_written = 0
+        overruns = meta['overruns']  # (sample index, n_lost) of each overrun
+        write_time = 0.
+        stream = None
+        try:
+            stream = self.start_stream(fsamp, block_size, n_buffers)
+            while n_written < n_total:
+                block = stream.get()
+                start = min(block.start, n_total)
+                if block.overrun:
+                    overruns.append((n_written, start - n_written))
+                n = min(block.data.shape[1], n_total - start)
+                t0 = time.time()
+                mm[n_written:start] = np.nan
+                mm[start:start + n] = block.data[:, :n].T
+                write_time += time.time() - t0
+                n_written = start + n
+            meta['complete'] = True
+        finally:
+            if stream is not None:
+                stream.stop()
+            t0 = time.time()
+            mm.flush()  # Includes flushing to disk, so count it as write time
+            write_time += time.time() - t0
+            del mm
+
+            n_bytes = n_written * len(channels) * 8
+            stats = {
+                'n_samples': n_written,
+                'n_overruns': len(overruns),
+                'n_lost': sum(n_lost for _, n_lost in overruns),
+                'elapsed_s': time.time() - start_time,
+                'write_MB_per_s': n_bytes / write_time / 1e6 if write_time else 0.,
+            }
+            meta.update(n_samples=n_written, stats=stats)
+            _write_meta(path, meta)
+        return stats
+
     def write(self, write_data, autostart=True):
         """Write data to the output channels.
 
@@ -629,25 +875,27 @@ class Task(object):
         for mtask in self._mtasks.values():
             mtask.clear()
 
-    def _read_AI_channels(self, timeout_s):
-        """ Returns a dict containing the AI buffers. """
+    def _read_AI_channels(self, timeout_s, out=None, raw=False):
+        """ Returns a dict (or with `raw`, an AIData) containing the AI buffers. """
         is_scalar = self.fsamp is None
-        mx_task = self._mtasks['AI']._mx_task
-        buf_size = self.n_samples * len(self.AIs)
-        data, n_samps_read = mx_task.ReadAnalogF64(-1, timeout_s, Val.GroupByChannel, buf_size)
+        copy_t = out is None  # Only reads into `out` share the cached time axis
+        if out is None:
+            out = np.empty((len(self.AIs), self.n_samples))
+        else:
+            _check_AI_out(out, len(self.AIs), self.n_samples)
+        n_samps_read = self._mtasks['AI']._read_AI_into(out, -1, timeout_s)
+        rows = _channel_rows(out, n_samps_read)
+        if raw:
+            return AIData(rows, [ch.path for ch in self.AIs], self.fsamp)
 
         res = {}
         for i, ch in enumerate(self.AIs):
-            start = i * n_samps_read
-            stop = (i + 1) * n_samps_read
-            ch_data = data[start:stop] if not is_scalar else data[start]
-            res[ch.path] = Q_(ch_data, 'V')
+            res[ch.path] = Q_(rows[i, 0] if is_scalar else rows[i], 'V')
 
         if is_scalar:
             res['t'] = Q_(0., 's')
         else:
-            end_t = (n_samps_read-1)/self.fsamp.m_as('Hz') if self.fsamp is not None else 0
-            res['t'] = Q_(np.linspace(0., end_t, n_samps_read), 's')
+            res['t'] = Q_(_time_axis(self.fsamp.m_as('Hz'), n_samps_read, copy_t), 's')
         return res
 
     def _write_AO_channels(self, data, autostart=True):
@@ -708,6 +956,7 @@ class MiniTask(object):
         self._mx_task = NiceNI.Task('')
         self.io_type = io_type
         self.chans = []
+        self.ranges = {}  # (vmin, vmax) in volts of each AI channel
         self.fsamp = None
 
     def __enter__(self):
@@ -792,6 +1041,7 @@ class MiniTask(object):
         vmax = default_max if vmax is None else vmax
         self._mx_task.CreateAIVoltageChan(ai_path, '', term_cfg.value, vmin.m_as('V'),
                                           vmax.m_as('V'), Val.Volts, '')
+        self.ranges[ai_path] = (vmin.m_as('V'), vmax.m_as('V'))
 
     def add_AO_channel(self, ao):
         self._assert_io_type('AO')
@@ -825,28 +1075,43 @@ class MiniTask(object):
         return Q_(value, 'V')
 
     @check_units(timeout='?s')
-    def read_AI_channels(self, samples=-1, timeout=None):
-        """Perform an AI read and get a dict containing the AI buffers"""
+    def read_AI_channels(self, samples=-1, timeout=None, out=None):
+        """Perform an AI read and get a dict containing the AI buffers
+
+        If given, `out` is a C-contiguous (n_channels, n_samples) float64 array that the samples
+        are read into, and of which the returned arrays are views. The time array is then a
+        cached, read-only one. If `samples` is -1, as many samples as are available, up to
+        n_samples, are read.
+        """
         self._assert_io_type('AI')
         samples = int(samples)
         timeout_s = float(-1. if timeout is None else timeout.m_as('s'))
 
-        if samples == -1:
-            buf_size = self._mx_task.GetBufInputBufSize() * len(self.chans)
+        n_chans = len(self.chans)
+        copy_t = out is None
+        if out is not None:
+            _check_AI_out(out, n_chans, None if samples == -1 else samples)
+        elif samples == -1:
+            out = np.empty((n_chans, self._mx_task.GetBufInputBufSize()))
         else:
-            buf_size = samples * len(self.chans)
+            out = np.empty((n_chans, samples))
 
-        data, n_samples_read = self._mx_task.ReadAnalogF64(samples, timeout_s, Val.GroupByChannel,
-                                                           buf_size)
+        n_samples_read = self._read_AI_into(out, samples, timeout_s)
+        rows = _channel_rows(out, n_samples_read)
         res = {}
         for i, ch_name in enumerate(self.chans):
-            start = i * n_samples_read
-            stop = (i+1) * n_samples_read
-            res[ch_name] = Q_(data[start:stop], 'V')
-        res['t'] = Q_(np.linspace(0, n_samples_read/self.fsamp.m_as('Hz'),
-                                  n_samples_read, endpoint=False), 's')
+            res[ch_name] = Q_(rows[i], 'V')
+        res['t'] = Q_(_time_axis(self.fsamp.m_as('Hz'), n_samples_read, copy_t), 's')
         return res
 
+    def _read_AI_into(self, out, samples, timeout_s):
+        """Read `samples` samples per channel into the (n_channels, n_samples) float64 array `out`
+
+        Returns the number of samples read per channel. If fewer than ``out.shape[1]`` are read,
+        they fill the start of ``out``'s memory, channel by channel.
+        """
+        return self._mx_task.ReadAnalogF64(samples, timeout_s, Val.GroupByChannel, out, out.size)
+
     @check_units(value='V', timeout='?s')
     def write_AO_scalar(self, value, timeout=None):
         self._assert_io_type('AO')
@@ -887,8 +1152,7 @@ class MiniTask(object):
             res[ch_name] = self._reorder_digital_int(ch_res)
 
         if self.fsamp is not None:
-            end_t = (n_samples_per_chan_read-1) / self.fsamp.m_as('Hz')
-            res['t'] = Q_(np.linspace(0., end_t, n_samples_per_chan_read), 's')
+            res['t'] = Q_(_time_axis(self.fsamp.m_as('Hz'), n_samples_per_chan_read, True), 's')
         return res
 
     def _reorder_digital_int(self, data):
@@ -949,6 +1213,249 @@ class MiniTask(object):
         self._mx_task.WriteAnalogF64(n_samples, autostart, timeout, Val.GroupByChannel, arr)
 
 
+class AIBlock(object):
+    """A block of samples read by an `AIStream`.
+
+    Attributes
+    ----------
+    data : numpy.ndarray
+        (n_channels, block_size) array of samples, in volts. This is one of the stream's reusable
+        buffers, so it is only valid until the next block is requested from the stream. Copy it
+        if you need to keep it longer.
+    index : int
+        Number of the block, counting from zero
+    start : int
+        Index of the block's first sample, counting from the start of the stream. This includes
+        the samples lost in any overruns, so ``start / fsamp`` is the time of the block.
+    overrun : bool
+        Whether samples were lost between the previous block and this one
+    n_lost : int
+        Number of samples per channel lost between the previous block and this one. Since the
+        task is restarted after an overrun, this is estimated from the host clock.
+    """
+    __slots__ = ('data', 'index', 'start', 'overrun', 'n_lost')
+
+    def __init__(self, data, index, start, overrun=False, n_lost=0):
+        self.data = data
+        self.index = index
+        self.start = start
+        self.overrun = overrun
+        self.n_lost = n_lost
+
+    def __repr__(self):
+        overrun = ' overrun n_lost={}'.format(self.n_lost) if self.overrun else ''
+        return '<AIBlock index={} start={}{}>'.format(self.index, self.start, overrun)
+
+
+class AIStream(object):
+    """Continuous analog input, read in fixed-size blocks on a background thread.
+
+    Created via `AnalogIn.start_stream()` or `Task.start_stream()`. The task runs in continuous
+    mode, and a reader thread repeatedly reads `block_size` samples per channel from the DAQmx
+    input buffer into one of `n_buffers` preallocated arrays, so no memory is allocated per
+    block. Consumers get the blocks, in order, from `get()` or by iterating over the stream::
+
+        >>> with daq.ai0.start_stream(fsamp='250kHz', block_size=25000) as stream:
+        ...     for block in stream:
+        ...         process(block.data[0])
+
+    If the consumer falls behind, the reader waits for it to finish with a buffer, and samples
+    pile up in the DAQmx buffer. If that overflows, the task is restarted, the next block is
+    flagged as an `~AIBlock.overrun`, and `n_overruns` is incremented. The number of samples lost
+    while the task was stopped is estimated from the time elapsed since it was (re)started, so
+    each block's `~AIBlock.start` stays on the stream's time axis.
+
+    Attributes
+    ----------
+    channels : list of str
+        Paths of the channels, in the order of the rows of each block
+    fsamp : Quantity
+        Sample rate
+    block_size : int
+        Number of samples per channel in each block
+    n_samples : int
+        Number of samples per channel read so far
+    n_overruns : int
+        Number of times the DAQmx buffer overflowed
+    n_lost : int
+        Estimated number of samples per channel lost in overruns
+    """
+    def __init__(self, mtask, channels, fsamp, block_size, n_buffers=4, buf_size=None,
+                 owns_task=False):
+        self.channels = list(channels)
+        self.fsamp = fsamp
+        self.block_size = int(block_size)
+        self.n_blocks = 0
+        self.n_samples = 0
+        self.n_overruns = 0
+        self.n_lost = 0
+        self.error = None
+        self._mtask = mtask
+        self._owns_task = owns_task
+
+        fsamp_hz = fsamp.m_as('Hz')
+        if buf_size is None:
+            # Room for at least a second of samples, or several blocks at high block rates
+            buf_size = max(4 * self.block_size, int(fsamp_hz))
+        self.buf_size = int(buf_size)
+        mtask.config_timing(fsamp, self.buf_size, mode=SampleMode.continuous)
+        mtask.input_buf_size = self.buf_size
+        mtask.overwrite(False)
+        self._timeout_s = max(2 * self.block_size / fsamp_hz, 1.)
+        self._fsamp_hz = fsamp_hz
+        self._position = 0  # Index of the next sample to be read
+
+        shape = (len(self.channels), self.block_size)
+        self._free = deque(np.empty(shape) for _ in range(max(int(n_buffers), 2)))
+        self._ready = deque()
+        self._held = None
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._done = False
+        self._thread = threading.Thread(target=self._run, name='AIStream')
+        self._thread.daemon = True
+
+        mtask.start()
+        self._run_start = (time.time(), 0)  # Host time and sample index the task started at
+        self._thread.start()
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def _restart(self):
+        """Restart the task after an overrun, returning the estimated number of samples lost"""
+        self._mtask.stop()
+        self._mtask.start()
+        now = time.time()
+        t_start, start = self._run_start
+        position = max(start + int(round((now - t_start) * self._fsamp_hz)), self._position)
+        n_lost = position - self._position
+        self._position = position
+        self._run_start = (now, position)
+        return n_lost
+
+    def _run(self):
+        overrun = False
+        n_lost = 0
+        try:
+            while True:
+                with self._cond:
+                    while not self._free and not self._stopped:
+                        self._cond.wait()
+                    if self._stopped:
+                        break
+                    buf = self._free.popleft()
+
+                try:
+                    n_read = self._mtask._read_AI_into(buf, self.block_size, self._timeout_s)
+                except DAQError as e:
+                    with self._cond:
+                        self._free.appendleft(buf)
+                    if e.code != NiceNI.ErrorSamplesNoLongerAvailable:
+                        raise
+                    # The DAQmx buffer overflowed, so restart the task to resume acquiring
+                    n_lost += self._restart()
+                    self.n_overruns += 1
+                    overrun = True
+                    continue
+
+                block = AIBlock(buf, self.n_blocks, self._position, overrun, n_lost)
+                self.n_lost += n_lost
+                overrun = False
+                n_lost = 0
+                self.n_blocks += 1
+                self.n_samples += n_read
+                self._position += n_read
+                with self._cond:
+                    self._ready.append(block)
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def _release_held(self):
+        if self._held is not None:
+            self._free.append(self._held.data)
+            self._held = None
+            self._cond.notify_all()
+
+    @check_units(timeout='?s')
+    def get(self, timeout=None):
+        """Get the next block of samples.
+
+        The previous block's buffer is handed back to the reader thread, so its data must no
+        longer be used. Raises a TimeoutError if no block is ready within `timeout`, and raises
+        StopIteration once the stream has been stopped and every block has been read. If the
+        reader thread hit an error, it is re-raised here.
+        """
+        deadline = None if timeout is None else time.time() + timeout.m_as('s')
+        with self._cond:
+            self._release_held()
+            while not self._ready:
+                if self._done:
+                    if self.error is not None:
+                        raise self.error
+                    raise StopIteration
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("Timed out while waiting for the next block")
+                self._cond.wait(remaining)
+            self._held = self._ready.popleft()
+            return self._held
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except StopIteration:
+                return
+
+    def stop(self):
+        """Stop acquiring. Blocks that were already read can still be gotten."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+        try:
+            self._mtask.stop()
+        finally:
+            if self._owns_task:
+                self._mtask.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+def _meta_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def _write_meta(path, meta):
+    with open(_meta_path(path), 'w') as f:
+        json.dump(meta, f)
+
+
+def load_recording(path, mmap_mode='r'):
+    """Load an AI recording made by `Task.record()`.
+
+    Returns a dict mapping each channel path to its memory-mapped array of samples, in volts,
+    along with the metadata dict. The arrays are views of the file, so samples are only loaded
+    from disk as they are accessed. For a recording that was stopped early, they only include
+    the samples written before it stopped.
+    """
+    with open(_meta_path(path)) as f:
+        meta = json.load(f)
+    data = np.load(path, mmap_mode=mmap_mode)[:meta['n_samples']]
+    return {ch: data[:, i] for i, ch in enumerate(meta['channels'])}, meta
+
+
 class Channel(object):
     def __init__(self, daq):
         # We hold onto the DAQ object as a weakref to avoid cycles in the reference graph. Since
@@ -1055,6 +1562,37 @@ class AnalogIn(Channel):
         self._mtask.stop()
         self._mtask = None
 
+    @check_units(fsamp='Hz', vmin='?V', vmax='?V')
+    def start_stream(self, fsamp, block_size, n_buffers=4, buf_size=None, vmin=None, vmax=None):
+        """Start continuously acquiring from this channel, in blocks read on a background thread.
+
+        Parameters
+        ----------
+        fsamp : Quantity
+            The sample frequency
+        block_size : int
+            Number of samples in each block
+        n_buffers : int, optional
+            Number of preallocated block buffers
+        buf_size : int, optional
+            Size of the DAQmx input buffer, in samples. Defaults to a second's worth of samples or
+            four blocks, whichever is larger.
+
+        Returns
+        -------
+        stream : AIStream
+            The running stream. Call its `~AIStream.stop()` method (or use it as a context
+            manager) to stop acquiring.
+        """
+        mtask = self.daq._create_mini_task('AI')
+        try:
+            mtask.add_AI_channel(self, vmin=vmin, vmax=vmax)
+            return AIStream(mtask, [self.path], fsamp, block_size, n_buffers, buf_size,
+                            owns_task=True)
+        except Exception:
+            mtask.clear()
+            raise
+
 
 class AnalogOut(Channel):
     type = 'AO'
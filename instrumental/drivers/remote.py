@@ -10,7 +10,6 @@ import socket
 import struct
 import threading
 import logging as log
-import cPickle as pickle
 
 from . import instrument, list_instruments, Instrument
 from .. import conf
@@ -21,6 +20,11 @@ try:
 except ImportError:
     import SocketServer as socketserver
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 DEFAULT_PORT = 28265
 
 # Header format is:
@@ -414,15 +418,18 @@ class ServerSession(Session):
 
 
 class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
+    session_class = ServerSession
+
     def handle(self):
         log.info("Opening connection to client...")
-        session = ServerSession(self.request, self.server.shared_obj_table, self.server.table_lock)
+        session = self.session_class(self.request, self.server.shared_obj_table,
+                                     self.server.table_lock)
         session.handle_requests()
 
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    def __init__(self, server_address):
-        socketserver.TCPServer.__init__(self, server_address, ThreadedTCPRequestHandler)
+    def __init__(self, server_address, handler_class=ThreadedTCPRequestHandler):
+        socketserver.TCPServer.__init__(self, server_address, handler_class)
         self.shared_obj_table = {}
         self.table_lock = threading.RLock()
         log.info("Server started...")
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 # Copyright 2014-2016 Nate Bogdanowicz
+import threading
 import numpy as np
-import scipy.misc
-from qtpy.QtCore import Qt, QTimer, Signal, QRect, QRectF, QPoint
-from qtpy.QtGui import QPixmap, QImage, QColor, QPen, QMouseEvent, QPainter
+from qtpy.QtCore import Qt, QObject, QTimer, Signal, QRect, QRectF, QPoint
+from qtpy.QtGui import QPixmap, QImage, QColor, QPen, QMouseEvent, QPainter, QTransform
 from qtpy.QtWidgets import QGraphicsView, QGraphicsScene, QMainWindow, QLabel, QStyle
 from qtpy import PYSIDE, PYQT5
 
@@ -45,7 +45,222 @@ def create_figure_window(title=''):
     return win, mplfig
 
 
-class CameraView(QLabel):
+def bytescale_lut(cmin, cmax, bits=16):
+    """Lookup table mapping `bits`-bit pixel values to uint8, like ``scipy.misc.bytescale``"""
+    scale = 255. / ((cmax - cmin) or 1)
+    lut = (np.arange(2**bits, dtype=float) - cmin) * scale
+    return (np.clip(lut, 0, 255) + 0.5).astype(np.uint8)
+
+
+class DisplayLUT(object):
+    """Cached display lookup table, only rebuilt when the black or white point changes"""
+    def __init__(self):
+        self._key = None
+        self._lut = None
+
+    def get(self, cmin, cmax):
+        key = (cmin, cmax)
+        if key != self._key:
+            self._lut = bytescale_lut(cmin, cmax)
+            self._key = key
+        return self._lut
+
+
+class AutoContrast(object):
+    """Tracks the black and white points of live frames from a running histogram.
+
+    Each frame passed to `update()` is sampled on a sparse grid of about `n_samples` pixels, whose
+    offset shifts from frame to frame so that every pixel is eventually sampled. The sample
+    histogram is blended into a running histogram with weight `smoothing`, and the black and white
+    points are read off as its `low` and `high` percentiles. The cost is independent of the
+    sensor size, and since the points are quantized to the histogram's bins, a steady scene gives
+    steady points, so a cached `DisplayLUT` is rarely rebuilt.
+
+    Parameters
+    ----------
+    low, high : float, optional
+        Percentiles of pixel values mapped to black and white
+    n_samples : int, optional
+        Approximate number of pixels sampled per frame
+    smoothing : float, optional
+        Weight of each new frame in the running histogram, between 0 and 1. Smaller values adapt
+        more slowly, but flicker less.
+    bits : int, optional
+        Bit depth of the frames' pixel values
+    """
+    def __init__(self, low=0.5, high=99.5, n_samples=10000, smoothing=0.2, bits=16):
+        self.low = low
+        self.high = high
+        self.n_samples = n_samples
+        self.smoothing = smoothing
+        self.n_bins = min(2**bits, 4096)
+        self._shift = max(bits - 12, 0)
+        self._hist = None
+        self._n_frames = 0
+
+    def reset(self):
+        """Forget the running histogram, e.g. after the scene changes drastically"""
+        self._hist = None
+
+    def _sample(self, arr):
+        step = max(1, int(np.sqrt(arr.size / float(self.n_samples))))
+        i = self._n_frames % (step * step)
+        self._n_frames += 1
+        return arr[i // step::step, i % step::step]
+
+    def update(self, arr):
+        """Add a frame to the running histogram and return the new (black, white) points"""
+        sample = self._sample(arr)
+        if self._shift:
+            sample = sample >> self._shift
+        hist = np.bincount(sample.ravel(), minlength=self.n_bins).astype(float)
+        if len(hist) > self.n_bins:  # Values beyond the expected bit depth count as white
+            hist[self.n_bins - 1] += hist[self.n_bins:].sum()
+            hist = hist[:self.n_bins]
+        hist /= max(sample.size, 1)
+
+        if self._hist is None:
+            self._hist = hist
+        else:
+            self._hist *= 1 - self.smoothing
+            self._hist += self.smoothing * hist
+
+        cdf = np.cumsum(self._hist)
+        cdf /= cdf[-1]
+        low_bin, high_bin = np.searchsorted(cdf, [self.low / 100., self.high / 100.])
+        black = int(low_bin) << self._shift
+        white = ((int(max(high_bin, low_bin)) + 1) << self._shift) - 1  # Top of the bin
+        return black, white
+
+
+def convert_for_display(arr, lut=None, step=1, out=None):
+    """Decimate `arr` by `step` and map it through `lut` (if given), writing into `out`"""
+    view = arr[::step, ::step]
+    if out is None:
+        out = np.empty(view.shape, np.uint8)
+    if lut is None:
+        np.copyto(out, view)
+    else:
+        np.take(lut, view, out=out, mode='clip')
+    return out
+
+
+class FrameConverter(QObject):
+    """Converts camera frames to 8-bit display images on a worker thread.
+
+    Frames passed to `submit()` are decimated and mapped through a lookup table into one of
+    `n_buffers` preallocated uint8 buffers, which is then sent with the `converted` signal, along
+    with the original frame and the decimation step. Once the GUI is done displaying a buffer,
+    it must hand it back with `release()`. If a newer frame is submitted before the last one was
+    converted, or all buffers are in use because the GUI is falling behind, frames are dropped
+    rather than queued up.
+    """
+    converted = Signal(object)
+
+    def __init__(self, n_buffers=3):
+        super(FrameConverter, self).__init__()
+        self.n_buffers = n_buffers
+        self.n_dropped = 0
+        self._cond = threading.Condition()
+        self._pending = None
+        self._shape = None
+        self._free = []
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='FrameConverter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopped = True
+            self._pending = None
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, arr, lut=None, step=1):
+        """Queue a frame for conversion, replacing any frame that is still waiting"""
+        with self._cond:
+            if self._pending is not None:
+                self.n_dropped += 1
+            self._pending = (arr, lut, step)
+            self._cond.notify()
+
+    def release(self, buf):
+        """Hand a buffer from the `converted` signal back for reuse"""
+        with self._cond:
+            if buf.shape == self._shape:
+                self._free.append(buf)
+
+    def _take_buffer(self, shape):
+        if shape != self._shape:
+            self._shape = shape
+            self._free = [np.empty(shape, np.uint8) for _ in range(self.n_buffers)]
+        return self._free.pop() if self._free else None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                arr, lut, step = self._pending
+                self._pending = None
+                shape = arr[::step, ::step].shape
+                buf = self._take_buffer(shape)
+                if buf is None:
+                    self.n_dropped += 1
+                    continue
+
+            convert_for_display(arr, lut, step, out=buf)
+            self.converted.emit((buf, arr, step))
+
+
+class DisplayScalingMixin(object):
+    """Scaling of 16-bit camera images to 8 bits for display, shared by the camera views.
+
+    By default, the white point is set once from the first frame. Use `set_auto_contrast()` to
+    have the black and white points track the live frames instead.
+    """
+    _cmin = 0
+    _cmax = None
+    auto_contrast = None
+    _lut = None
+
+    def set_auto_contrast(self, enable=True, **kwds):
+        """Enable or disable adaptive scaling of 16-bit images for display.
+
+        When enabled, the black and white points track percentiles of the live frames, using an
+        `AutoContrast` created with the given `kwds`. Otherwise, the white point is set once from
+        the first frame.
+        """
+        self.auto_contrast = AutoContrast(**kwds) if enable else None
+        if not enable:
+            self._cmin, self._cmax = 0, None
+
+    def _display_lut(self, arr):
+        """Cached LUT for scaling 16-bit images to 8 bits, or None for other images"""
+        if arr.dtype != np.uint16:
+            return None
+        if self.auto_contrast is not None:
+            self._cmin, self._cmax = self.auto_contrast.update(arr)
+        elif not self._cmax:
+            self._cmax = arr.max()  # Set cmax once from first image
+        if self._lut is None:
+            self._lut = DisplayLUT()
+        return self._lut.get(self._cmin, self._cmax)
+
+
+class CameraView(DisplayScalingMixin, QLabel):
     def __init__(self, camera=None):
         super(CameraView, self).__init__()
         self.camera = camera
@@ -80,9 +295,7 @@ class CameraView(QLabel):
             image = QImage(arr.data, self.camera.width, self.camera.height, bpl, format)
             self._saved_img = arr
         elif not is_rgb and arr.dtype == np.uint16:
-            if not self._cmax:
-                self._cmax = arr.max()  # Set cmax once from first image
-            arr = scipy.misc.bytescale(arr, self._cmin, self._cmax)
+            arr = convert_for_display(arr, self._display_lut(arr))
             format = QImage.Format_Indexed8
             w, h = self.camera.width, self.camera.height
             image = QImage(arr.data, w, h, w, format)
@@ -114,7 +327,7 @@ class CameraView(QLabel):
         self.setFixedSize(w, cam.height*w/cam.width)
 
 
-class CroppableCameraView(QGraphicsView):
+class CroppableCameraView(DisplayScalingMixin, QGraphicsView):
     rectChanged = Signal(QRect)
     imageDisplayed = Signal(np.ndarray)
     videoStarted = Signal()
@@ -133,6 +346,10 @@ class CroppableCameraView(QGraphicsView):
         self._selecting = False
         self.needs_resize = False
         self.latest_array = None
+        self._shown_buffer = None
+
+        self.converter = FrameConverter()
+        self.converter.converted.connect(self._show_converted)
 
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
@@ -219,8 +436,8 @@ class CroppableCameraView(QGraphicsView):
 
     def rect(self):
         """QRect of the selection in camera coordinates"""
-        # selrect in _image_ (pixmap) coordinates
-        i_selrect = self.pixmapitem.sceneTransform().inverted()[0].mapRect(self.selrect.rect())
+        # selrect in _image_ coordinates
+        i_selrect = self._image_transform().mapRect(self.selrect.rect())
         current_left = self.settings.get('left', 0)
         current_top = self.settings.get('top', 0)
         return i_selrect.toRect().translated(current_left, current_top)
@@ -233,6 +450,7 @@ class CroppableCameraView(QGraphicsView):
         self.hideRect()
 
         rect = self.rect()
+        pixmap_rect = self.mapSceneToPixmap(self.selrect.rect()).toRect()
         self.settings['left'] = rect.left()
         self.settings['right'] = rect.right()
         self.settings['top'] = rect.top()
@@ -243,7 +461,7 @@ class CroppableCameraView(QGraphicsView):
         else:
             if not self._uncropped_pixmap:
                 self._uncropped_pixmap = self.pixmapitem.pixmap()
-            self.pixmapitem.setPixmap(self._uncropped_pixmap.copy(rect))
+            self.pixmapitem.setPixmap(self._uncropped_pixmap.copy(pixmap_rect))
             self.setFixedSize(rect.width(), rect.height())
 
     def uncrop(self):
@@ -279,21 +497,54 @@ class CroppableCameraView(QGraphicsView):
         map_func = transform.mapRect if isinstance(pixmap_pt, (QRect, QRectF)) else transform.map
         return map_func(pixmap_pt)
 
+    def _image_transform(self):
+        """Transform from scene coordinates to (undecimated) image coordinates"""
+        step = self.pixmapitem.scale()
+        return self.pixmapitem.sceneTransform().inverted()[0] * QTransform.fromScale(step, step)
+
     def mapSceneToCamera(self, sc_pt):
-        px_pt = self.mapSceneToPixmap(sc_pt)
-        return QPoint(px_pt.x() + self.settings.get('left', 0),
-                      px_pt.y() + self.settings.get('top', 0))
+        im_pt = self._image_transform().map(sc_pt)
+        return QPoint(im_pt.x() + self.settings.get('left', 0),
+                      im_pt.y() + self.settings.get('top', 0))
 
     def set_image(self, image_arr):
-        pixmap = QPixmap(self._array_to_qimage(image_arr))
+        step = self._decimation(image_arr.shape)
+        display_arr = convert_for_display(image_arr, self._display_lut(image_arr), step)
+        self._set_pixmap(QPixmap(self._array_to_qimage(display_arr)), step)
+
+    def _set_pixmap(self, pixmap, step=1):
+        """Display `pixmap`, an image decimated by `step`, scaled up to the image's full size"""
         if not self.pixmapitem:
             self.pixmapitem = self.scene.addPixmap(pixmap)
         else:
             self.pixmapitem.setPixmap(pixmap)
+        if self.pixmapitem.scale() != step:
+            self.pixmapitem.setScale(step)
 
         if self.needs_resize:
             self._autoresize_viewport()
             self.needs_resize = False
+        self._fit_to_viewport()
+
+    def _fit_to_viewport(self):
+        """Shrink the view to show the whole image if it doesn't fit in the viewport"""
+        sr = self.pixmapitem.sceneBoundingRect()
+        vp = self.viewport().size()
+        if sr.width() > vp.width() or sr.height() > vp.height():
+            self.fitInView(sr, Qt.KeepAspectRatio)
+        elif not self.transform().isIdentity():
+            self.resetTransform()
+
+    def _decimation(self, shape):
+        """Integer step for decimating images of the given shape down to the viewport size
+
+        Decimating only by whole steps keeps the displayed image at least as large as the
+        viewport, so no resolution is visibly lost.
+        """
+        vp = self.viewport().size()
+        if self.needs_resize or vp.width() <= 0 or vp.height() <= 0:
+            return 1  # The view is about to be sized to fit the image
+        return max(1, int(max(shape[1] / float(vp.width()), shape[0] / float(vp.height()))))
 
     def _autoresize_viewport(self):
         ir = self.pixmapitem.boundingRect()
@@ -315,6 +566,7 @@ class CroppableCameraView(QGraphicsView):
         timer = QTimer()
         self.timer = timer
         timer.timeout.connect(self._wait_for_frame)
+        self.converter.start()
         self.cam.start_live_video(**self.settings)
         timer.start(0)  # Run full throttle
         self.is_live = True
@@ -324,27 +576,33 @@ class CroppableCameraView(QGraphicsView):
     def stop_video(self):
         self.timer.stop()
         self.cam.stop_live_video()
+        self.converter.stop()
         self.is_live = False
 
     def _wait_for_frame(self):
         frame_ready = self.cam.wait_for_frame(timeout='0 ms')
         if frame_ready:
             arr = self.cam.latest_frame(copy=True)
-            self.set_image(arr)
             self.latest_array = arr
-            self.imageDisplayed.emit(arr)
+            # Scaling to 8 bits happens on the converter's thread, which calls _show_converted()
+            self.converter.submit(arr, self._display_lut(arr), self._decimation(arr.shape))
+
+    def _show_converted(self, result):
+        buf, arr, step = result
+        self._set_pixmap(QPixmap(self._array_to_qimage(buf)), step)
+
+        # The previous buffer is no longer on screen, so it can be refilled
+        if self._shown_buffer is not None:
+            self.converter.release(self._shown_buffer)
+        self._shown_buffer = buf
+        self.imageDisplayed.emit(arr)
 
     def _scale_image(self, arr):
         """Return a bytescaled copy of the image array"""
-        if not self._cmax:
-            self._cmax = arr.max()  # Set cmax once from first image
-        return scipy.misc.bytescale(arr, self._cmin, self._cmax)
+        return convert_for_display(arr, self._display_lut(arr))
 
     def _lut_scale_image(self, arr):
-        if not self._cmax:
-            self._cmax = arr.max()
-        lut = scipy.misc.bytescale(np.arange(2**16), self._cmin, self._cmax)
-        return lut[arr]
+        return self._display_lut(arr)[arr]
 
     def _create_lut(self, k):
         A = 2**15
@@ -355,18 +613,19 @@ class CroppableCameraView(QGraphicsView):
         bpl = arr.strides[0]
         is_rgb = len(arr.shape) == 3
 
+        h, w = arr.shape[:2]  # May be decimated, so don't use the camera's size
+
         if is_rgb and arr.dtype == np.uint8:
             format = QImage.Format_RGB32
-            image = QImage(arr.data, self.cam.width, self.cam.height, bpl, format)
+            image = QImage(arr.data, w, h, bpl, format)
         elif not is_rgb and arr.dtype == np.uint8:
             # TODO: Somehow need to make sure data is ordered as I'm assuming
             format = QImage.Format_Indexed8
-            image = QImage(arr.data, self.cam.width, self.cam.height, bpl, format)
+            image = QImage(arr.data, w, h, bpl, format)
             self._saved_img = arr
         elif not is_rgb and arr.dtype == np.uint16:
             arr = self._scale_image(arr)
             format = QImage.Format_Indexed8
-            w, h = self.cam.width, self.cam.height
             image = QImage(arr.data, w, h, w, format)
             self._saved_img = arr  # Save a reference to keep Qt from crashing
         else:
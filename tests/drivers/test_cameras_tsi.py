@@ -0,0 +1,21 @@
+import numpy as np
+
+
+class TestTSI_Camera(object):
+    def test_live_captured_image(self, inst):
+        inst.start_live_video()
+        try:
+            image = inst.get_captured_image(timeout='5s')
+            assert image.ndim == 2
+
+            stack = inst.get_captured_image(timeout='5s', stack=True)
+            assert stack.shape == (1,) + image.shape
+
+            out = np.empty((1,) + image.shape, image.dtype)
+            res = inst.get_captured_image(timeout='5s', out=out)
+            assert res.shape == out.shape and np.shares_memory(res, out)
+
+            out = np.empty_like(image)
+            assert inst.get_captured_image(timeout='5s', out=out) is out
+        finally:
+            inst.stop_live_video()
@@ -1,3 +1,4 @@
+import numpy as np
 from instrumental import u
 
 
@@ -17,3 +18,42 @@ class TestNIDAQ(object):
         assert data['t'].shape == (10,)
         assert dim_matches(data[ai.path], u.V)
         assert dim_matches(data['t'], u.s)
+        data['t'] += 1 * u.s  # Each read gets its own time array
+
+    def test_AI_stream(self, inst):
+        with inst.ai0.start_stream(fsamp='10kHz', block_size=1000) as stream:
+            blocks = [stream.get(timeout='1s') for _ in range(3)]
+            assert [b.start for b in blocks] == [0, 1000, 2000]
+            assert blocks[-1].data.shape == (1, 1000)
+        assert stream.n_overruns == 0
+
+    def test_AI_record(self, inst, tmpdir):
+        from instrumental.drivers.daq.ni import Task, load_recording
+        path = str(tmpdir.join('rec.npy'))
+        with Task(inst.ai0) as task:
+            stats = task.record(path, duration='0.5s', fsamp='10kHz')
+        data, meta = load_recording(path)
+        assert stats['n_samples'] == meta['n_samples'] == 5000
+        assert meta['complete'] and len(meta['ranges_V']) == 1
+        assert data[inst.ai0.path].shape == (5000,)
+
+    def test_AI_read_out(self, inst):
+        from instrumental.drivers.daq.ni import Task
+        ai = inst.ai0
+        out = np.empty((1, 10))
+        with Task(ai) as task:
+            task.set_timing(n_samples=10, fsamp='1kHz')
+            data = task.run(out=out)
+        assert np.shares_memory(data[ai.path].magnitude, out)
+        assert data['t'].shape == (10,)
+
+    def test_AI_read_raw(self, inst):
+        from instrumental.drivers.daq.ni import Task
+        ai = inst.ai0
+        with Task(ai) as task:
+            task.set_timing(n_samples=10, fsamp='1kHz')
+            data = task.run(raw=True)
+        assert data.data.shape == (1, 10)
+        assert data.channels == [ai.path]
+        assert dim_matches(data[ai.path], u.V)
+        assert data['t'].shape == (10,)
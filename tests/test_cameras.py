@@ -0,0 +1,432 @@
+import time
+import numpy as np
+import pytest
+from instrumental.drivers.cameras import (FrameRingBuffer, FrameQueue, FrameStream, HotPixelMap,
+                                          RunningStats, DarkCalibration, FlatFieldCorrection,
+                                          Frame, Pipeline, Crop, Bin, Subtract, LUT, Statistics,
+                                          Function, FrameRecorder, load_recording,
+                                          CapturedImages, ChunkedFrameWriter,
+                                          ChunkedFrameReader)
+from instrumental.errors import Error
+
+
+def test_ring_buffer_overwrite():
+    ring = FrameRingBuffer(3, (4, 5), np.uint16)
+    for i in range(5):
+        ring.push(np.full((4, 5), i, np.uint16), timestamp=float(i))
+
+    assert ring.n_pushed == 5
+    assert ring.n_overwritten == 2
+    assert ring.n_unread == 3
+
+    frame = ring.read()
+    assert frame.seq == 2
+    assert frame.timestamp == 2.
+    assert np.all(frame.array == 2)
+    assert not frame.array.flags.writeable
+
+    assert ring.latest().seq == 4
+    with pytest.raises(Error):
+        ring.get(1)
+
+
+def test_ring_buffer_shape_mismatch():
+    ring = FrameRingBuffer(2, (4, 5), np.uint16)
+    with pytest.raises(Error):
+        ring.push(np.zeros((5, 4), np.uint16))
+
+
+def test_frame_queue_drop_oldest():
+    queue = FrameQueue(2, 'drop_oldest')
+    for i in range(5):
+        queue.put(i)
+    assert queue.n_dropped == 3
+    assert queue.get(0) == 3
+    assert queue.get(0) == 4
+    assert queue.get(0) is None
+
+
+class FakeLiveCamera(object):
+    """Bare-bones stand-in providing just the live-video methods used by FrameStream"""
+    def __init__(self, n_frames, lost=()):
+        self.n_frames = n_frames
+        self.lost = lost  # Hardware frame numbers the camera "drops"
+        self.count = 0
+        self.hw_count = 0
+
+    def wait_for_frame(self, timeout=None):
+        if self.count >= self.n_frames:
+            time.sleep(0.01)
+            return False
+        self.count += 1
+        self.hw_count += 1
+        while self.hw_count in self.lost:
+            self.hw_count += 1
+        return True
+
+    def latest_frame(self, copy=True):
+        return np.full((2, 2), self.count, np.uint16)
+
+    def _latest_frame_info(self):
+        return self.hw_count, self.hw_count * 0.01
+
+
+def test_frame_stream_in_order():
+    stream = FrameStream(FakeLiveCamera(20), maxlen=32, policy='block')
+    stream.start()
+    frames = [stream.get(timeout='1s') for _ in range(20)]
+    stream.stop()
+
+    assert [f.seq for f in frames] == list(range(20))
+    assert frames[-1].array[0, 0] == 20
+    assert stream.n_dropped == 0
+    with pytest.raises(StopIteration):
+        stream.get(timeout='10ms')
+
+
+def test_frame_stream_detects_dropped():
+    stream = FrameStream(FakeLiveCamera(10, lost=(4, 5, 9)), maxlen=32, policy='block')
+    stream.start()
+    frames = [stream.get(timeout='1s') for _ in range(10)]
+    stream.stop()
+
+    assert [f.dropped for f in frames] == [0, 0, 0, 2, 0, 0, 1, 0, 0, 0]
+    assert frames[3].hw_seq == 6
+    assert frames[3].hw_timestamp == pytest.approx(0.06)
+    assert stream.n_missed == 3
+
+
+def test_hot_pixel_correction():
+    img = np.arange(30, dtype=np.uint16).reshape((5, 6)) * 10
+    pixels = [(0, 0), (2, 3), (4, 5)]
+    for y, x in pixels:
+        img[y, x] = 60000
+
+    hot = HotPixelMap(pixels + [(10, 10)])  # Out-of-bounds pixels are ignored
+    fixed = hot.correct(img)
+    assert img[2, 3] == 60000
+
+    for y, x in pixels:
+        window = img[max(y-1, 0):y+2, max(x-1, 0):x+2]
+        expected = (window.sum(dtype=float) - img[y, x]) / (window.size - 1)
+        assert fixed[y, x] == int(expected)
+    mask = np.ones(img.shape, bool)
+    mask[tuple(np.transpose(pixels))] = False
+    assert np.all(fixed[mask] == img[mask])
+
+    assert hot.correct(img, in_place=True) is img
+    assert np.all(img == fixed)
+
+
+def test_dark_calibration(tmpdir):
+    rand = np.random.RandomState(0)
+    frames = rand.normal(100, 2, (50, 20, 30)).astype(np.uint16)
+    frames[:, 3, 4] += 1000  # Always hot
+    frames[::5, 10, 20] += 1000  # Intermittently hot
+
+    stats = RunningStats((20, 30))
+    for frame in frames:
+        stats.add(frame)
+    assert stats.n == 50
+    assert np.allclose(stats.mean, frames.mean(axis=0))
+    assert np.allclose(stats.variance, frames.var(axis=0, ddof=1))
+
+    calib = DarkCalibration.from_stats(stats)
+    assert calib.hot_pixels.tolist() == [[3, 4], [10, 20]]
+
+    path = str(tmpdir.join('darkcal.npz'))
+    calib.save(path)
+    loaded = DarkCalibration.load(path)
+    assert loaded.n_frames == 50
+    assert np.all(loaded.hot_mask == calib.hot_mask)
+    assert np.all(loaded.dark == calib.dark)
+
+
+def test_flat_field_correction():
+    rand = np.random.RandomState(0)
+    dark = rand.normal(100, 5, (8, 12)).astype(np.float32)
+    flat = rand.normal(2, 0.1, (8, 12)).astype(np.float32)
+    frame = rand.randint(200, 300, (8, 12)).astype(np.uint16)
+
+    corr = FlatFieldCorrection(dark, flat)
+    corr.prepare(frame.shape)
+    out = corr.apply(frame, out=corr.buffer)
+    assert out is corr.buffer
+    assert out.dtype == np.float32
+    assert np.allclose(out, (frame - dark) / (flat / flat.mean()), rtol=1e-5)
+
+    # ROI at (left=1, top=1) of a frame binned 2x2, so it covers sensor rows 2-5, columns 2-9
+    corr.prepare((2, 4), left=1, top=1, hbin=2, vbin=2)
+    binned = corr.apply(np.zeros((2, 4), np.uint16))
+    expected_dark = dark[2:6, 2:10].reshape((2, 2, 4, 2)).sum(axis=(1, 3))
+    expected_flat = flat[2:6, 2:10].reshape((2, 2, 4, 2)).mean(axis=(1, 3)) / flat.mean()
+    assert np.allclose(binned, -expected_dark / expected_flat, rtol=1e-5)
+
+    with pytest.raises(Error):
+        corr.apply(frame)
+
+
+def test_pipeline():
+    frame = np.arange(64, dtype=np.uint16).reshape((8, 8))
+    pipeline = Pipeline([Crop(2, 0, 8, 8), Bin(2, 2), Subtract(np.full((4, 3), 10)),
+                         Function(np.abs), Statistics()])
+    out, results = pipeline.process(frame)
+
+    expected = np.abs(frame[:, 2:].reshape((4, 2, 3, 2)).sum(axis=(1, 3)) - 10.)
+    assert out.dtype == np.float32
+    assert np.all(out == expected)
+    assert results['statistics']['max'] == expected.max()
+
+    lut, _ = Pipeline([LUT.linear(0, 63, bits=8)]).process(frame)
+    assert lut.dtype == np.uint8
+    assert lut[0, 0] == 0 and lut[-1, -1] == 255
+
+
+def test_pipeline_imap_in_order():
+    pipeline = Pipeline([Bin(2, 2, mean=True), Statistics()], n_workers=3)
+    frames = (Frame(np.full((4, 4), i, np.uint16), i) for i in range(20))
+    try:
+        out = list(pipeline.imap(frames))
+    finally:
+        pipeline.close()
+
+    assert [f.seq for f in out] == list(range(20))
+    assert [f.results['statistics']['mean'] for f in out] == list(range(20))
+    assert all(f.array.shape == (2, 2) for f in out)
+    assert out[0].array is not out[1].array
+
+
+def test_statistics_moments():
+    ys, xs = np.mgrid[:40, :60]
+    frame = (1000 * np.exp(-((xs - 35.)**2 / 18 + (ys - 12.)**2 / 8))).astype(np.uint16) + 10
+    stats = Statistics(threshold=10, rois=[(0, 0, 60, 20), (0, 20, 60, 40)])
+    s = stats.analyze(frame)
+
+    weights = frame - 10.
+    total = weights.sum()
+    cx, cy = (weights * xs).sum() / total, (weights * ys).sum() / total
+    assert np.isclose(s['sum'], total)
+    assert np.allclose(s['centroid'], (cy, cx))
+    assert np.allclose(s['variance'], ((weights * (ys - cy)**2).sum() / total,
+                                       (weights * (xs - cx)**2).sum() / total), rtol=1e-4)
+    assert np.isclose(s['covariance'], (weights * (xs - cx) * (ys - cy)).sum() / total, atol=1e-3)
+    assert s['roi_sums'] == (frame[:20].sum(), frame[20:].sum())
+    assert s['max'] == frame.max() and s['min'] == frame.min()
+
+    coarse = Statistics(threshold=10, downsample=2).analyze(frame)
+    assert np.allclose(coarse['centroid'], (cy, cx), atol=0.1)
+    assert Statistics(threshold=2000).analyze(frame)['centroid'] is None
+
+
+def test_frame_recorder(tmpdir):
+    path = str(tmpdir.join('rec.npy'))
+    recorder = FrameRecorder(path, capacity=4, maxlen=100, metadata={'exposure_time': '5 ms'})
+    for i in range(10):  # More than the capacity, so the file has to grow
+        recorder.put(Frame(np.full((3, 4), i, np.uint16), i, timestamp=float(i)))
+    stats = recorder.close()
+    assert stats['n_frames'] == 10
+    assert stats['n_dropped'] == 0
+
+    frames, meta = load_recording(path)
+    assert frames.shape == (10, 3, 4)
+    assert frames.dtype == np.uint16
+    assert np.all(frames[:, 0, 0] == np.arange(10))
+    assert meta['exposure_time'] == '5 ms'
+    assert meta['seq'] == list(range(10))
+    assert meta['timestamps'] == [float(i) for i in range(10)]
+    assert meta['hw_seq'] == meta['hw_timestamps'] == [None] * 10
+
+
+def test_empty_frame_recorder(tmpdir):
+    for name, compress in [('rec.npy', False), ('rec.ifr', True)]:
+        path = str(tmpdir.join(name))
+        assert FrameRecorder(path, compress=compress).close()['n_frames'] == 0
+        with pytest.raises(Error):
+            load_recording(path)
+
+
+def test_compressed_frame_recorder(tmpdir):
+    path = str(tmpdir.join('rec.ifr'))
+    recorder = FrameRecorder(path, maxlen=100, metadata={'exposure_time': '5 ms'}, compress=True,
+                             chunk_frames=4)
+    rand = np.random.RandomState(0)
+    arrays = rand.randint(0, 4096, (10, 3, 4)).astype(np.uint16)
+    for i, array in enumerate(arrays):
+        recorder.put(Frame(array, i, timestamp=float(i)))
+    stats = recorder.close()
+    assert stats['n_frames'] == 10
+
+    frames, meta = load_recording(path)
+    with frames:
+        assert frames.shape == (10, 3, 4)
+        assert len(frames.chunks) == 3  # Including a partial last chunk
+        assert np.all(frames[7] == arrays[7])
+        assert np.all(frames[-1] == arrays[-1])
+        assert np.all(frames[2:9:3] == arrays[2:9:3])
+        assert np.all(frames[7, 1:, ::2] == arrays[7, 1:, ::2])
+        assert np.all(frames[2:9:3, 1] == arrays[2:9:3, 1])
+        assert np.all(np.array(list(frames)) == arrays)
+        assert meta['exposure_time'] == '5 ms'
+        assert meta['timestamps'] == [float(i) for i in range(10)]
+        assert meta['stats']['n_frames'] == 10
+
+    # An unclosed file still has its complete chunks
+    writer = ChunkedFrameWriter(str(tmpdir.join('crash.ifr')), (3, 4), np.uint16, chunk_frames=4)
+    for array in arrays:
+        writer.write(array)
+    writer._file.flush()
+    frames = ChunkedFrameReader(str(tmpdir.join('crash.ifr')))
+    assert len(frames) == 8
+    assert np.all(frames[:] == arrays[:8])
+    frames.close()
+    writer.close()
+
+
+class FakeCaptureCamera(object):
+    """Stand-in providing just what CapturedImages needs from a camera"""
+    _correction = None
+
+    def _output_image(self, array, copy=True, out=None):
+        if out is not None:
+            np.copyto(out, array)
+            return out
+        return np.copy(array) if copy else array
+
+
+def test_captured_images_stack():
+    sdk_buf = np.zeros((3, 4), np.uint16)
+    prefix = [np.full((3, 4), 7, np.uint16)]  # Left over from a timed-out call
+    images = CapturedImages(FakeCaptureCamera(), 3, stack=True, prefix=prefix)
+    for i in range(3):
+        sdk_buf[:] = i
+        images.add(sdk_buf)
+
+    stack = images.result()
+    assert stack.shape == (4, 3, 4)
+    assert stack.flags.c_contiguous
+    assert np.all(stack[:, 0, 0] == [7, 0, 1, 2])
+
+    images = CapturedImages(FakeCaptureCamera(), 2)
+    images.add(sdk_buf)
+    images.add(sdk_buf)
+    first, second = images.result()
+    assert first is not sdk_buf and first is not second
+
+
+def test_captured_images_out():
+    sdk_buf = np.full((3, 4), 5, np.uint16)
+    out = np.empty((2, 3, 4), np.uint16)
+    images = CapturedImages(FakeCaptureCamera(), 2, out=out)
+    images.add(sdk_buf)
+    images.add(sdk_buf)
+    result = images.result()
+    assert result.base is out or result is out
+    assert np.all(out == 5)
+
+    single = np.empty((3, 4), np.uint16)
+    images = CapturedImages(FakeCaptureCamera(), 1, out=single)
+    images.add(sdk_buf)
+    assert images.result() is single
+
+    with pytest.raises(Error):
+        CapturedImages(FakeCaptureCamera(), 2, out=single)
+    with pytest.raises(Error):
+        CapturedImages(FakeCaptureCamera(), 1, out=np.empty((1, 3, 4), np.uint8)).add(sdk_buf)
+
+
+def test_simulated_camera():
+    from instrumental.drivers import ParamSet
+    from instrumental.drivers.cameras.simulated import SimulatedCamera
+    settings = {'width': 64, 'height': 48, 'bit_depth': 8, 'n_hot_pixels': 3}
+    cam = SimulatedCamera._create(ParamSet(SimulatedCamera, serial='SIM-test', settings=settings))
+    try:
+        img = cam.grab_image(hbin=2, vbin=2, width=20, height=10, exposure_time='1ms')
+        assert img.shape == (10, 20)
+        assert img.dtype == np.uint8
+        assert cam.max_width == 32
+
+        stack = cam.grab_image(n_frames=3, stack=True, exposure_time='1ms')
+        assert stack.shape == (3, 48, 64)
+        assert np.all(stack[(slice(None),) + tuple(cam.hot_pixels.T)] == 255)
+
+        hw_seqs = [frame.hw_seq for frame in cam.frames(n=5, exposure_time='0ms')]
+        assert hw_seqs == list(range(5))
+    finally:
+        cam.close()
+
+
+def test_camera_group_keeps_trigger():
+    from instrumental.drivers import ParamSet
+    from instrumental.drivers.cameras import CameraGroup
+    from instrumental.drivers.cameras.simulated import SimulatedCamera
+    cams = [SimulatedCamera._create(ParamSet(SimulatedCamera, serial='SIM-trig{}'.format(i),
+                                             settings={'width': 32, 'height': 16}))
+            for i in range(2)]
+    for cam in cams:
+        cam.set_trigger('hardware')
+
+    def fire():
+        for _ in range(5):
+            for cam in cams:
+                cam.trigger()
+
+    group = CameraGroup(cams)
+    bundles = []
+    for bundle in group.frames(n=5, timeout='1s', start_trigger=fire, policy='block',
+                               exposure_time='0ms'):
+        assert [cam.trigger_mode for cam in cams] == ['hardware', 'hardware']
+        bundles.append(bundle)
+    assert [b.seq for b in bundles] == list(range(5))
+    assert all(b[0].hw_seq == b[1].hw_seq for b in bundles)
+    assert group.n_unmatched == [0, 0]
+
+
+def test_calibrate_dark_ignores_correction():
+    from instrumental.drivers import ParamSet
+    from instrumental.drivers.cameras.simulated import SimulatedCamera
+    settings = {'width': 64, 'height': 48}
+    cam = SimulatedCamera._create(ParamSet(SimulatedCamera, serial='SIM-calib', settings=settings))
+    try:
+        calib = cam.calibrate_dark(n_frames=5, exposure_time='0ms')
+        cam.enable_correction()
+        recalib = cam.calibrate_dark(n_frames=5, exposure_time='0ms')
+        assert abs(recalib.dark.mean() - calib.dark.mean()) < 1
+        assert cam.latest_frame().dtype == np.float32  # Correction is re-enabled afterwards
+    finally:
+        cam.close()
+
+
+def test_calibrate_and_record_skip_pipeline(tmpdir):
+    from instrumental.drivers import ParamSet
+    from instrumental.drivers.cameras.simulated import SimulatedCamera
+    settings = {'width': 64, 'height': 48}
+    cam = SimulatedCamera._create(ParamSet(SimulatedCamera, serial='SIM-pipe', settings=settings))
+    cam.pipeline = Pipeline([Crop(0, 0, 32, 24)])
+    try:
+        assert cam.calibrate_dark(n_frames=2, exposure_time='0ms').dark.shape == (48, 64)
+        path = str(tmpdir.join('rec.npy'))
+        cam.record(path, n_frames=3, exposure_time='0ms')
+        frames, meta = load_recording(path)
+        assert frames.shape == (3, 48, 64)
+    finally:
+        cam.pipeline.close()
+        cam.close()
+
+
+def test_camera_group():
+    from instrumental.drivers import ParamSet
+    from instrumental.drivers.cameras import CameraGroup
+    from instrumental.drivers.cameras.simulated import SimulatedCamera
+    settings = {'width': 32, 'height': 16}
+    cams = [SimulatedCamera._create(ParamSet(SimulatedCamera, serial='SIM-group{}'.format(i),
+                                             settings=settings)) for i in range(2)]
+    group = CameraGroup(cams)
+    # Unthrottled frames and a blocking queue, so no frames are lost and matching is exact
+    bundles = list(group.frames(n=10, policy='block', exposure_time='0ms'))
+    assert [b.seq for b in bundles] == list(range(10))
+    for bundle in bundles:
+        assert len(set(frame.seq for frame in bundle)) == 1
+        assert len(set(frame.hw_seq for frame in bundle)) == 1
+        assert bundle.arrays[0].shape == (16, 32)
+    assert group.n_unmatched == [0, 0]
+    assert all(cam.stream is None for cam in cams)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Loopback Instrumental server shared by the benchmark tools.
+
+`BenchServer` runs a `ThreadedTCPServer` on loopback in a child process, so its CPU use can be
+measured separately from the clients'. Each tool supplies a `BenchServerSession` subclass whose
+``handle_create()`` builds simulated instruments instead of looking up real drivers.
+"""
+from __future__ import division, print_function
+import os
+import threading
+import multiprocessing
+
+from instrumental.drivers.remote import (ThreadedTCPServer, ThreadedTCPRequestHandler,
+                                         ServerSession)
+
+__all__ = ['BenchServerSession', 'BenchServer']
+
+
+class BenchServerSession(ServerSession):
+    """Server session that never pickles the objects it serves, or their bound methods.
+
+    Real instruments hold device handles, so pickling them fails and the server hands out
+    RemoteObjects instead. Simulated instruments may well be picklable, which would silently
+    send the client a copy, so they're kept remote explicitly here.
+    """
+    def serialize(self, obj, lock):
+        owner = getattr(obj, '__self__', None)
+        if id(obj) not in self.obj_table and id(owner) in self.obj_table:
+            obj = self.new_remote_obj(obj, lock)
+        return super(BenchServerSession, self).serialize(obj, lock)
+
+
+def _serve(session_class, conn):
+    """Server process entry point. Answers 'cpu' and 'stop' commands over `conn`"""
+    handler_class = type('BenchRequestHandler', (ThreadedTCPRequestHandler,),
+                         {'session_class': session_class})
+    server = ThreadedTCPServer(('127.0.0.1', 0), handler_class)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    conn.send(server.server_address[1])
+
+    while True:
+        command = conn.recv()
+        if command == 'cpu':
+            times = os.times()
+            conn.send(times[0] + times[1])
+        elif command == 'stop':
+            server.shutdown()
+            server.server_close()
+            conn.send(None)
+            break
+
+
+class BenchServer(object):
+    """Handle on a benchmark server running in a child process
+
+    Parameters
+    ----------
+    session_class : type
+        `BenchServerSession` subclass handling each client connection. It must be defined at
+        module level, so the child process can import it.
+    """
+    def __init__(self, session_class):
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._proc = multiprocessing.Process(target=_serve, args=(session_class, child_conn))
+        self._proc.daemon = True
+        self._proc.start()
+        self.port = self._conn.recv()
+
+    def cpu_time(self):
+        """Total user+system CPU seconds used so far by the server process"""
+        self._conn.send('cpu')
+        return self._conn.recv()
+
+    def stop(self):
+        self._conn.send('stop')
+        self._conn.recv()
+        self._proc.join()
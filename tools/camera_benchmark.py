@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Benchmark of the per-frame overhead of the camera frame-handling machinery.
+
+Runs an unthrottled `SimulatedCamera`, which hands out pregenerated frames at no cost, so every
+timing measures only the code consuming the frames. Three groups of paths are timed:
+
+- ``camera``: `Camera` base-class paths, i.e. `latest_frame()` with and without copying or into
+  an ``out`` array, `latest_stats()`, the frame ring buffer, dark/flat correction, the `frames()`
+  iterator (with and without a `Pipeline`) and `start_stream()`
+- ``gui``: `CroppableCameraView` displaying frames, on an offscreen Qt platform. Skipped if Qt
+  isn't available.
+- ``remote``: `wait_for_frame()` and `latest_frame()` through an Instrumental server running in a
+  separate process on loopback (see ``bench_server.py``)
+
+Reports the time per frame and the resulting maximum frame rate of each path.
+
+Example::
+
+    python tools/camera_benchmark.py --size 1024 1280 --bit-depth 12 --groups camera remote
+"""
+from __future__ import division, print_function
+import os
+import time
+import argparse
+
+import numpy as np
+
+from instrumental.drivers import ParamSet
+from instrumental.drivers.cameras import Pipeline, Crop, Bin, Statistics
+from instrumental.drivers.cameras.simulated import SimulatedCamera
+from instrumental.drivers.remote import ClientSession, FAKE_LOCK
+
+from bench_server import BenchServerSession, BenchServer
+
+GROUPS = ('camera', 'gui', 'remote')
+
+
+def _create_camera(shape, bit_depth, serial='SIM-bench'):
+    settings = {'width': shape[1], 'height': shape[0], 'bit_depth': bit_depth}
+    return SimulatedCamera._create(ParamSet(SimulatedCamera, serial=serial, settings=settings))
+
+
+def _time_live(cam, n_frames, read_frame):
+    """Seconds per frame of `wait_for_frame()` followed by `read_frame()`, in live mode"""
+    cam.start_live_video(exposure_time='0ms')
+    try:
+        for _ in range(10):  # Warm up
+            cam.wait_for_frame()
+            read_frame()
+        t0 = time.time()
+        for _ in range(n_frames):
+            cam.wait_for_frame()
+            read_frame()
+        return (time.time() - t0) / n_frames
+    finally:
+        cam.stop_live_video()
+
+
+def _time_iter(frames, n_frames):
+    """Seconds per frame to exhaust an iterator of `n_frames` frames"""
+    t0 = time.time()
+    for _ in frames:
+        pass
+    return (time.time() - t0) / n_frames
+
+
+def run_camera(cam, n_frames):
+    """Time the base-class paths, returning a list of (name, seconds per frame) pairs"""
+    shape = (cam.max_height, cam.max_width)
+    out = np.empty(shape, cam.dtype)
+    results = [
+        ('latest_frame(copy=False)', _time_live(cam, n_frames,
+                                                lambda: cam.latest_frame(copy=False))),
+        ('latest_frame()', _time_live(cam, n_frames, lambda: cam.latest_frame())),
+        ('latest_frame(out=...)', _time_live(cam, n_frames, lambda: cam.latest_frame(out=out))),
+    ]
+
+    stats = Statistics(threshold=cam.dark_level)
+    results.append(('latest_stats()', _time_live(cam, n_frames, lambda: cam.latest_stats(stats))))
+    stats = Statistics(threshold=cam.dark_level, downsample=4)
+    results.append(('latest_stats(), downsampled',
+                    _time_live(cam, n_frames, lambda: cam.latest_stats(stats))))
+
+    cam.enable_frame_buffer(16)
+    try:
+        results.append(('latest_frame(), frame buffer',
+                        _time_live(cam, n_frames, lambda: cam.latest_frame())))
+    finally:
+        cam.disable_frame_buffer()
+
+    cam.enable_correction(dark=np.full(shape, 100., np.float32))
+    try:
+        results.append(('latest_frame(copy=False), correction',
+                        _time_live(cam, n_frames, lambda: cam.latest_frame(copy=False))))
+    finally:
+        cam.disable_correction()
+
+    results.append(('frames()', _time_iter(cam.frames(n=n_frames, exposure_time='0ms'),
+                                           n_frames)))
+
+    height, width = shape
+    cam.pipeline = Pipeline([Crop(0, 0, width // 2, height // 2), Bin(2, 2), Statistics()])
+    try:
+        results.append(('frames(), pipeline', _time_iter(cam.frames(n=n_frames,
+                                                                    exposure_time='0ms'),
+                                                         n_frames)))
+    finally:
+        cam.pipeline.close()
+        cam.pipeline = None
+
+    stream = cam.start_stream(maxlen=n_frames + 1, exposure_time='0ms')
+    t0 = time.time()
+    try:
+        for _ in range(n_frames):
+            stream.get()
+        results.append(('start_stream()', (time.time() - t0) / n_frames))
+    finally:
+        cam.stop_stream()
+
+    return results
+
+
+def run_gui(cam, n_frames):
+    """Time `CroppableCameraView` displaying frames, returning (name, seconds per frame) pairs
+
+    Returns an empty list if Qt isn't available.
+    """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from qtpy.QtWidgets import QApplication
+        from instrumental.gui import CroppableCameraView
+    except Exception as e:
+        print('Skipping gui benchmarks: {}'.format(e))
+        return []
+
+    app = QApplication.instance() or QApplication([])
+    view = CroppableCameraView(cam)
+    displayed = []
+    view.imageDisplayed.connect(displayed.append)
+
+    def display_frames(n):
+        # Frames are converted on a worker thread, so count the ones that actually get shown
+        del displayed[:]
+        while len(displayed) < n:
+            view._wait_for_frame()
+            app.processEvents()
+
+    view.start_video()
+    view.timer.stop()  # Drive the view's frame handler directly instead of from the event loop
+    try:
+        display_frames(10)  # Warm up
+        t0 = time.time()
+        display_frames(n_frames)
+        t = (time.time() - t0) / n_frames
+    finally:
+        view.stop_video()
+    return [('CroppableCameraView', t)]
+
+
+class CameraSession(BenchServerSession):
+    """Server session that opens a SimulatedCamera directly, as a plain RemoteObject"""
+    def handle_create(self, request):
+        params = dict(request['params'])
+        shape, bit_depth = params['shape'], params['bit_depth']
+        cam = _create_camera(shape, bit_depth, serial='SIM-remote')
+        return self.new_remote_obj(cam, FAKE_LOCK), FAKE_LOCK
+
+
+def run_remote(shape, bit_depth, n_frames):
+    """Time reading frames through a server process, returning (name, seconds per frame) pairs"""
+    server = BenchServer(CameraSession)
+    session = ClientSession('127.0.0.1', server.port, 'bench')
+    try:
+        cam = session.instrument({'shape': shape, 'bit_depth': bit_depth})
+        results = [('remote latest_frame()', _time_live(cam, n_frames, cam.latest_frame))]
+    finally:
+        session.close()
+        server.stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, nargs=2, default=[1024, 1280],
+                        metavar=('HEIGHT', 'WIDTH'), help='Frame size in pixels')
+    parser.add_argument('--bit-depth', type=int, default=12, help='Bits per pixel')
+    parser.add_argument('--frames', type=int, default=500, help='Number of frames to time')
+    parser.add_argument('--groups', nargs='+', choices=GROUPS, default=list(GROUPS),
+                        help='Groups of paths to time')
+    args = parser.parse_args(argv)
+
+    shape = tuple(args.size)
+    cam = _create_camera(shape, args.bit_depth)
+    print('{}x{} {}-bit frames ({})'.format(shape[0], shape[1], args.bit_depth, cam.dtype))
+
+    results = []
+    if 'camera' in args.groups:
+        results.extend(run_camera(cam, args.frames))
+    if 'gui' in args.groups:
+        results.extend(run_gui(cam, args.frames))
+    if 'remote' in args.groups:
+        results.extend(run_remote(shape, args.bit_depth, args.frames))
+
+    print('{:<40} {:>10} {:>10}'.format('path', 'us/frame', 'max fps'))
+    for name, t in results:
+        print('{:<40} {:>10.1f} {:>10.0f}'.format(name, t * 1e6, 1 / t))
+
+
+if __name__ == '__main__':
+    main()
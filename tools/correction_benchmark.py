@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Benchmark of camera dark/flat-field correction throughput.
+
+Times `FlatFieldCorrection` on synthetic frames, both writing into its preallocated buffer and
+allocating a new output array per frame, alongside the naive ``(frame - dark) / flat`` NumPy
+expression. Reports the per-frame time and the maximum sustainable frame rate of each method,
+and whether it keeps up with the target frame rate.
+
+Example::
+
+    python tools/correction_benchmark.py --size 2048 2048 --fps 100
+"""
+from __future__ import division, print_function
+import time
+import argparse
+
+import numpy as np
+
+from instrumental.drivers.cameras import FlatFieldCorrection
+
+
+def _time_per_call(func, n_frames):
+    func()  # Warm up
+    t0 = time.time()
+    for _ in range(n_frames):
+        func()
+    return (time.time() - t0) / n_frames
+
+
+def run(shape, n_frames, dtype=np.uint16):
+    """Time each correction method, returning a list of (name, seconds per frame) pairs"""
+    rand = np.random.RandomState(0)
+    frame = rand.randint(0, 4096, shape).astype(dtype)
+    dark = rand.normal(100, 5, shape).astype(np.float32)
+    flat = rand.normal(1000, 20, shape).astype(np.float32)
+
+    corr = FlatFieldCorrection(dark, flat)
+    corr.prepare(shape)
+    norm_flat = flat / flat.mean()
+
+    methods = [
+        ('naive (frame - dark) / flat', lambda: (frame - dark) / norm_flat),
+        ('FlatFieldCorrection, new output', lambda: corr.apply(frame)),
+        ('FlatFieldCorrection, preallocated', lambda: corr.apply(frame, out=corr.buffer)),
+    ]
+    return [(name, _time_per_call(func, n_frames)) for name, func in methods]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, nargs=2, default=[2048, 2048],
+                        metavar=('HEIGHT', 'WIDTH'), help='Frame size in pixels')
+    parser.add_argument('--frames', type=int, default=100, help='Number of frames to time')
+    parser.add_argument('--fps', type=float, default=100.,
+                        help='Target frame rate the correction must keep up with')
+    args = parser.parse_args(argv)
+
+    shape = tuple(args.size)
+    print('{}x{} uint16 frames, target {:g} fps'.format(shape[0], shape[1], args.fps))
+    print('{:<36} {:>10} {:>10} {:>8}'.format('method', 'ms/frame', 'max fps', 'keeps up'))
+    for name, t in run(shape, args.frames):
+        print('{:<36} {:>10.2f} {:>10.0f} {:>8}'.format(name, t * 1e3, 1 / t,
+                                                      'yes' if 1 / t >= args.fps else 'NO'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Nate Bogdanowicz
+"""
+Load-testing and latency benchmark for the Instrumental remote server.
+
+Starts a `ThreadedTCPServer` on loopback in a separate process (see ``bench_server.py``),
+serving simulated instruments instead of real hardware, then drives it with a number of
+concurrent client sessions. Each scenario reports throughput, latency percentiles and the CPU
+time used by the server process.
+
+Example::
+
+    python tools/remote_benchmark.py --clients 1 4 16 --sizes 0 1000 1000000 --json out.json
+
+The JSON output holds one record per (operation, array size, client count) scenario, so results
+from different protocol versions can be diffed or plotted to track regressions.
+"""
+from __future__ import division, print_function
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import threading
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+
+from instrumental import Q_
+from instrumental.drivers import Instrument, Facet
+from instrumental.drivers import remote
+from instrumental.drivers.remote import ClientSession, FAKE_LOCK
+
+from bench_server import BenchServerSession, BenchServer
+
+OPERATIONS = ('get', 'set', 'call')
+
+
+class SimulatedInstrument(Instrument):
+    """Stand-in instrument with scalar facets and an array-returning method"""
+    def _initialize(self, delay=0.):
+        self._delay = delay
+        self._voltage = 0.
+        self._arrays = {}
+
+    def _wait(self):
+        if self._delay:
+            time.sleep(self._delay)
+
+    @Facet(units='V')
+    def voltage(self):
+        self._wait()
+        return self._voltage
+
+    @voltage.setter
+    def voltage(self, voltage):
+        self._wait()
+        self._voltage = voltage
+
+    def get_array(self, n_samples):
+        """Return a float64 array of length `n_samples`"""
+        self._wait()
+        try:
+            return self._arrays[n_samples]
+        except KeyError:
+            arr = self._arrays[n_samples] = np.random.random(n_samples)
+            return arr
+
+
+def _new_sim_instrument(delay):
+    inst = object.__new__(SimulatedInstrument)  # Bypass instrument() and the driver machinery
+    inst._initialize(delay=delay)
+    return inst
+
+
+class InstrumentSession(BenchServerSession):
+    """Server session that creates SimulatedInstruments instead of looking up real drivers"""
+    def handle_create(self, request):
+        params = dict(request['params'])
+        delay = params.get('delay', 0.)
+
+        if params.get('share', False):
+            with self.shared_table_lock:
+                key = ('simulated', delay)
+                if key not in self.shared_obj_table:
+                    self.shared_obj_table[key] = _new_sim_instrument(delay)
+                    self.shared_obj_table[key, 'lock'] = threading.RLock()
+                inst = self.shared_obj_table[key]
+                lock = self.shared_obj_table[key, 'lock']
+        else:
+            inst = _new_sim_instrument(delay)
+            lock = FAKE_LOCK
+
+        return self.new_remote_obj(inst, lock), lock
+
+
+def _client_worker(port, op, size, delay, share, state, latencies, errors):
+    try:
+        session = ClientSession('127.0.0.1', port, 'bench')
+        inst = session.instrument({'delay': delay, 'share': share})
+    except remote.RemoteError:
+        errors.append(1)
+        return
+    finally:
+        state['ready'].release()
+
+    try:
+        voltage = Q_(1., 'V')
+        state['start'].wait()
+        deadline = state['deadline']
+
+        while time.time() < deadline:
+            t0 = time.time()
+            try:
+                if op == 'get':
+                    inst.voltage
+                elif op == 'set':
+                    inst.voltage = voltage
+                else:
+                    inst.get_array(size)
+            except remote.RemoteError:
+                errors.append(1)
+                continue
+            latencies.append(time.time() - t0)
+    finally:
+        session.close()
+
+
+def run_scenario(server, op, size, n_clients, duration, delay=0., share=False):
+    """Run a single load scenario and return its result record (a dict)"""
+    state = {'ready': threading.Semaphore(0), 'start': threading.Event(), 'deadline': None}
+    per_client = [[] for _ in range(n_clients)]
+    errors = []
+
+    threads = []
+    for latencies in per_client:
+        thread = threading.Thread(target=_client_worker,
+                                  args=(server.port, op, size, delay, share, state, latencies,
+                                        errors))
+        thread.daemon = True
+        threads.append(thread)
+        thread.start()
+
+    # Wait for all clients to connect, so connection setup isn't counted in the results
+    for _ in threads:
+        state['ready'].acquire()
+
+    cpu_start = server.cpu_time()
+    t_start = time.time()
+    state['deadline'] = t_start + duration
+    state['start'].set()
+
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - t_start
+    cpu_used = server.cpu_time() - cpu_start
+
+    latencies = np.concatenate([np.asarray(l, dtype=float) for l in per_client]) * 1e3
+    n_requests = len(latencies)
+    payload_bytes = 8 * size if op == 'call' else 0
+    result = {
+        'op': op,
+        'size': size if op == 'call' else 0,
+        'delay_s': delay,
+        'clients': n_clients,
+        'shared': share,
+        'duration_s': elapsed,
+        'n_requests': n_requests,
+        'n_errors': len(errors),
+        'throughput_per_s': n_requests / elapsed,
+        'payload_MB_per_s': n_requests * payload_bytes / elapsed / 1e6,
+        'server_cpu_s': cpu_used,
+        'server_cpu_frac': cpu_used / elapsed,
+    }
+
+    if n_requests:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        result['latency_ms'] = {
+            'mean': float(latencies.mean()),
+            'min': float(latencies.min()),
+            'p50': float(p50),
+            'p90': float(p90),
+            'p99': float(p99),
+            'max': float(latencies.max()),
+        }
+    else:
+        result['latency_ms'] = None
+    return result
+
+
+def _format_row(r):
+    lat = r['latency_ms'] or dict.fromkeys(('p50', 'p90', 'p99'), float('nan'))
+    return '{:<5} {:>9} {:>7} {:>10.1f} {:>9.2f} {:>9.3f} {:>9.3f} {:>9.3f} {:>8.0%}'.format(
+        r['op'], r['size'], r['clients'], r['throughput_per_s'], r['payload_MB_per_s'],
+        lat['p50'], lat['p90'], lat['p99'], r['server_cpu_frac'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Numbers of concurrent clients to test')
+    parser.add_argument('--ops', nargs='+', choices=OPERATIONS, default=list(OPERATIONS),
+                        help='Operations to test: facet get/set, or array-returning method call')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10000, 1000000],
+                        help='Array lengths (float64 samples) returned by the "call" operation')
+    parser.add_argument('--delay', type=float, default=0.,
+                        help='Simulated instrument delay per operation, in seconds')
+    parser.add_argument('--duration', type=float, default=3.,
+                        help='Duration of each scenario, in seconds')
+    parser.add_argument('--share', action='store_true',
+                        help='Have all clients share a single (locked) instrument')
+    parser.add_argument('--json', metavar='PATH',
+                        help="Write machine-readable results to PATH ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    scenarios = []
+    for op in args.ops:
+        for size in (args.sizes if op == 'call' else [0]):
+            for n_clients in args.clients:
+                scenarios.append((op, size, n_clients))
+
+    quiet = (args.json == '-')
+    if not quiet:
+        print('{:<5} {:>9} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9} {:>8}'.format(
+            'op', 'size', 'clients', 'req/s', 'MB/s', 'p50 ms', 'p90 ms', 'p99 ms', 'srv cpu'))
+
+    server = BenchServer(InstrumentSession)
+    results = []
+    try:
+        for op, size, n_clients in scenarios:
+            result = run_scenario(server, op, size, n_clients, args.duration, args.delay,
+                                  args.share)
+            results.append(result)
+            if not quiet:
+                print(_format_row(result))
+                sys.stdout.flush()
+    finally:
+        server.stop()
+
+    if args.json:
+        output = {
+            'meta': {
+                'timestamp': datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'hostname': socket.gethostname(),
+                'cpu_count': multiprocessing.cpu_count(),
+                'default_port': remote.DEFAULT_PORT,
+            },
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(output, sys.stdout, indent=2)
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(output, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()